@@ -6,9 +6,9 @@ def test_noauth(app, client, auth, admin_user):
     conf = app.config
     with app.app_context():
         bp = app.blueprints['admin_file']
-        assert len(app.blueprints) == 4
+        assert len(app.blueprints) == 6
         rules = list(app.url_map.iter_rules())
-        assert len(rules) == 62
+        assert len(rules) == 67
         getrules = 0
         for rule in rules:
             rstr = str(rule)
@@ -20,7 +20,7 @@ def test_noauth(app, client, auth, admin_user):
                 # all should redirect.
                 assert response.status_code == 302
                 assert response.location.startswith('{}/login'.format(conf['SECURITY_URL_PREFIX']))
-        assert getrules == 14
+        assert getrules == 15
                 
 def test_editor(client, auth, editor_user):
     """Test that login works for /admin/ for editor_user"""
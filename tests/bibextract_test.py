@@ -0,0 +1,208 @@
+import os
+from pathlib import Path
+import tempfile
+from webapp.metadata.bibextract import extract, read_aux, read_bcf, find_bibfile, EXPORT_TYPES, configure_index, get_index, BibIndex
+
+def test_style():
+    test_dir = Path('tests/testdata/bibtex/style')
+    citations, bibdata = read_aux(test_dir / Path('main.aux'))
+    assert len(citations) == 26
+    assert bibdata == ['alltypes']
+    bibtex, missing = extract(test_dir, search_path=[])
+    assert missing == []
+    # alltypes.bib has one @thesis, which wideexport.bst does not export.
+    assert bibtex.count('\n@') == 25
+    assert '@thesis' not in bibtex
+    assert bibtex.startswith('\n@')
+
+def test_nocite_all():
+    test_dir = Path('tests/testdata/bibtex/missing')
+    bibtex, missing = extract(test_dir, search_path=[])
+    assert missing == []
+    assert bibtex.count('\n@') == 56
+    assert bibtex.index('{Book6,') < bibtex.index('{booklet1,')
+
+def test_bcf():
+    test_dir = Path('tests/testdata/bibtex/output5')
+    citations, bibdata = read_bcf(test_dir / Path('main.bcf'))
+    assert bibdata == ['main.bib', 'refs_dblp.bib']
+    assert citations[0] == 'DBLP:conf/crypto/KocherJJ99'
+    bibtex, missing = extract(test_dir, search_path=[])
+    assert missing == bibdata
+    assert bibtex == '\n'
+
+def test_extract():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        tmpdir = Path(tmpdirpath)
+        Path(tmpdir, 'main.aux').write_text('\\relax\n'
+                                            '\\citation{Second,first}\n'
+                                            '\\@input{chapter.aux}\n'
+                                            '\\bibstyle{plain}\n'
+                                            '\\bibdata{abbrev,refs,../secret,nothere}\n')
+        Path(tmpdir, 'chapter.aux').write_text('\\citation{first}\n\\citation{online,third}\n')
+        search = tmpdir / Path('search')
+        search.mkdir()
+        Path(search, 'abbrev.bib').write_text('@String{CCS = "ACM CCS"}\n'
+                                              '@string(ccsyear = ccs # " 20")\n')
+        Path(tmpdir, 'refs.bib').write_text(r'''
+Text outside of entries is ignored.
+@comment{ jabref-meta: databaseType:bibtex; }
+@preamble{ "\newcommand{\noop}[1]{}" }
+@InProceedings{SECOND,
+  Author = "Alice {De Bob}
+            and  Carol",
+  title = {The   {"}quoted{"} title},
+  Booktitle = ccsyear # "23",
+  month = oct # "~30~--~" # nov # {~3,},
+  year = 2023,
+  note = {contact alice@example.com},
+  unknownfield = {dropped},
+  crossref = {proc23},
+}
+@article{first,
+  title = {First},
+  journal = jacm,
+  title = {Repeated field},
+  year = {2020}
+}
+@online{online, title = {Not exported}}
+@article{first, title = {Repeated entry}}
+@misc(third, title = "Third", crossref = "proc23")
+@proceedings{Proc23,
+  title = {Proceedings},
+  booktitle = {Proceedings booktitle},
+  publisher = {ACM},
+  year = 2023,
+}
+@article{unused, title = {Not cited}}
+''')
+        bibtex, missing = extract(tmpdir, search_path=[search])
+        assert missing == ['../secret', 'nothere']
+        assert bibtex == r'''
+,-------------------.
+|     PREAMBLE      |
+`-------------------'
+
+@preamble{ "\newcommand{\noop}[1]{}"
+}
+
+,-------------------.
+|  BIBTEX ENTRIES   |
+`-------------------'
+
+@inproceedings{Second,
+  author =        {Alice {De Bob} and Carol},
+  booktitle =     {ACM CCS 2023},
+  crossref =      {proc23},
+  month =         oct # {~30~--~} # nov # {~3,},
+  note =          {contact alice@example.com},
+  publisher =     {ACM},
+  title =         {The {"}quoted{"} title},
+  year =          {2023},
+}
+
+@article{first,
+  journal =       jacm,
+  title =         {First},
+  year =          {2020},
+}
+
+@misc{third,
+  booktitle =     {Proceedings booktitle},
+  crossref =      {proc23},
+  publisher =     {ACM},
+  title =         {Third},
+  year =          {2023},
+}
+
+@proceedings{Proc23,
+  booktitle =     {Proceedings booktitle},
+  publisher =     {ACM},
+  title =         {Proceedings},
+  year =          {2023},
+}
+
+'''
+
+def test_find_bibfile():
+    test_dir = Path('tests/testdata/bibtex/cc2-1-62')
+    citations, bibdata = read_aux(test_dir / Path('main.aux'))
+    assert bibdata == ['bibliography']
+    assert find_bibfile('bibliography', test_dir, []) is None
+    assert find_bibfile('bibliography', test_dir, [test_dir.parent]) == Path('tests/testdata/bibtex/bibliography.bib')
+    assert find_bibfile('../bibliography', test_dir, []) is None
+    assert find_bibfile(str(Path('tests/testdata/bibtex/bibliography.bib').resolve()), test_dir, []) is None
+    assert 'article' in EXPORT_TYPES
+
+def test_index():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        tmpdir = Path(tmpdirpath)
+        paper = tmpdir / Path('paper')
+        paper.mkdir()
+        Path(paper, 'main.aux').write_text('\\citation{CRYPTO:A20,crypto:b20,nothere}\n'
+                                           '\\bibdata{local,cryptobib/abbrev,cryptobib/crypto}\n')
+        Path(paper, 'local.bib').write_text('@string{lncs = "LNCS"}\n')
+        shared = tmpdir / Path('shared') / Path('cryptobib')
+        shared.mkdir(parents=True)
+        Path(shared, 'abbrev.bib').write_text('@string{crypto = "CRYPTO"}\n'
+                                              '@string{crypto20 = crypto # " 2020"}\n'
+                                              '@string{series = lncs # " " # crypto}\n')
+        bibfile = Path(shared, 'crypto.bib')
+        bibfile.write_text('@InProceedings{CRYPTO:A20,\n  title = {A},\n  booktitle = crypto20,\n'
+                           '  series = series,\n  crossref = {crypto20proc},\n}\n'
+                           '@inproceedings{CRYPTO:B20, title = "B", crossref = {crypto20proc}}\n'
+                           '@proceedings{crypto20proc, title = crypto20, year = 2020}\n')
+        search_path = [tmpdir / Path('shared')]
+        scanned, missing = extract(paper, search_path=search_path)
+        assert missing == []
+        assert 'series =        {LNCS CRYPTO},' in scanned
+        try:
+            configure_index(tmpdir / Path('index'))
+            indexed, missing = extract(paper, search_path=search_path)
+            assert indexed == scanned
+            index = get_index(bibfile)
+            assert index.num_entries == 3
+            assert index.entry('crypto:a20')[1].startswith('@InProceedings{CRYPTO:A20,')
+            assert index.entry('nothere') is None
+            abbrev = get_index(Path(shared, 'abbrev.bib'))
+            assert abbrev.macro('crypto20') == (True, 'CRYPTO 2020')
+            # This uses lncs from another file, so it is resolved when it is used.
+            assert abbrev.macro('series')[0] is False
+            # The index is rebuilt when the file changes.
+            with bibfile.open('a') as f:
+                f.write('@misc{nothere, title = {Now it is}}\n')
+            os.utime(bibfile, ns=(0, 0))
+            indexed, missing = extract(paper, search_path=search_path)
+            assert '@misc{nothere,' in indexed
+            assert get_index(bibfile) is not index
+            assert len(list((tmpdir / Path('index')).iterdir())) == 2
+            assert BibIndex(index.path).num_entries == 4
+        finally:
+            configure_index(None)
+
+def test_crossref_order():
+    # bibtex only finds a cross-referenced entry after the first entry
+    # that refers to it, with or without an index.
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        tmpdir = Path(tmpdirpath)
+        paper = tmpdir / Path('paper')
+        paper.mkdir()
+        Path(paper, 'main.aux').write_text('\\citation{late,early,second}\n'
+                                           '\\bibdata{cryptobib/crypto}\n')
+        shared = tmpdir / Path('shared') / Path('cryptobib')
+        shared.mkdir(parents=True)
+        Path(shared, 'crypto.bib').write_text('@proceedings{before, title = {Before}}\n'
+                                              '@inproceedings{late, title = {Late}, crossref = {before}}\n'
+                                              '@inproceedings{early, title = {Early}, crossref = {after}}\n'
+                                              '@proceedings{after, title = {After}}\n'
+                                              '@inproceedings{second, title = {Second}, crossref = {after}}\n')
+        search_path = [tmpdir / Path('shared')]
+        scanned, missing = extract(paper, search_path=search_path)
+        assert '@proceedings{after,' in scanned
+        assert '@proceedings{before,' not in scanned
+        try:
+            configure_index(tmpdir / Path('index'))
+            indexed, missing = extract(paper, search_path=search_path)
+            assert indexed == scanned
+        finally:
+            configure_index(None)
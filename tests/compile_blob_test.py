@@ -0,0 +1,152 @@
+from datetime import datetime
+import logging
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from webapp.metadata.compilation import Compilation, CompileError, ErrorType
+from webapp.metadata.db_models import Base, CompileRecord, CompileBlob, CompileRecordBlob, CompilationParts, PaperStatus, PaperStatusEnum, Version, migrate_compile_records, delete_unused_blobs
+
+def _session():
+    engine = create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(bind=engine)
+    session = Session(engine)
+    session.add(PaperStatus(paperid='paper1',
+                            email='author@example.com',
+                            hotcrp='none',
+                            hotcrp_id='none',
+                            status=PaperStatusEnum.PENDING,
+                            journal_key='cic',
+                            volume_key='1',
+                            issue_key='1',
+                            submitted='2024-01-01',
+                            accepted='2024-01-02'))
+    session.commit()
+    return session
+
+def _compilation(log):
+    return Compilation(paperid='paper1',
+                       venue='cic',
+                       email='author@example.com',
+                       submitted='2024-01-01 00:00:00',
+                       accepted='2024-01-02 00:00:00',
+                       compiled=datetime(2024, 1, 3),
+                       command='latexmk -pdf main',
+                       log=log,
+                       error_log=[CompileError(error_type=ErrorType.LATEX_ERROR, logline=1, text='Undefined')],
+                       warning_log=[],
+                       bibtex='@article{a, title = {A}}',
+                       zipfilename='main.zip')
+
+def test_parts():
+    compilation = _compilation('x' * 5000)
+    parts = CompilationParts(compilation)
+    # Only log is large enough for a blob.
+    assert list(parts.large) == ['log']
+    assert '"bibtex":' in parts.compact
+    assert '"log":' not in parts.compact
+    assert Compilation.model_validate_json(parts.json()) == compilation
+    assert parts.error_count == 1
+    assert parts.warning_count == 0
+
+def test_set_and_get():
+    session = _session()
+    candidate = CompileRecord(paperid='paper1', version=Version.CANDIDATE, started=datetime.now())
+    compilation = _compilation('first log ' * 1000)
+    candidate.set_result(session, CompilationParts(compilation))
+    session.add(candidate)
+    session.commit()
+    assert candidate.error_count == 1
+    assert candidate.get_result(session) == compilation
+    assert candidate.get_result(session, fields=[]).log is None
+    blob = session.execute(select(CompileBlob)).scalar_one()
+    assert blob.size > 10000
+    assert len(blob.data) < 1000
+    # Records with the same log share the blob.
+    final = CompileRecord(paperid='paper1', version=Version.FINAL, started=datetime.now())
+    final.copy_result(session, candidate)
+    session.add(final)
+    session.commit()
+    candidate.set_result(session, CompilationParts(_compilation('second log ' * 1000)))
+    session.commit()
+    assert len(session.execute(select(CompileBlob)).scalars().all()) == 2
+    final.set_result(session, CompilationParts(_compilation('short log')))
+    session.commit()
+    assert len(session.execute(select(CompileBlob)).scalars().all()) == 1
+    assert final.get_result(session).log == 'short log'
+    assert candidate.get_result(session).log.startswith('second log')
+    assert [link.field for link in candidate.blob_links] == ['log']
+    assert final.blob_links == []
+
+def test_same_blob_from_two_sessions(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'blobs.db'))
+    Base.metadata.create_all(bind=engine)
+    first = Session(engine)
+    second = Session(engine)
+    first.add(PaperStatus(paperid='paper1',
+                          email='author@example.com',
+                          hotcrp='none',
+                          hotcrp_id='none',
+                          status=PaperStatusEnum.PENDING,
+                          journal_key='cic',
+                          volume_key='1',
+                          issue_key='1',
+                          submitted='2024-01-01',
+                          accepted='2024-01-02'))
+    first.commit()
+    # Both insert the blob, and the second insert is ignored.
+    parts = CompilationParts(_compilation('same log ' * 1000))
+    for session, version in [(first, Version.CANDIDATE), (second, Version.FINAL)]:
+        comprec = CompileRecord(paperid='paper1', version=version, started=datetime.now())
+        comprec.set_result(session, parts)
+        session.add(comprec)
+        session.commit()
+    assert len(second.execute(select(CompileBlob)).scalars().all()) == 1
+    for comprec in second.execute(select(CompileRecord)).scalars():
+        assert comprec.get_result(second).log.startswith('same log')
+    first.close()
+    second.close()
+    engine.dispose()
+
+def test_missing_blob(caplog):
+    session = _session()
+    comprec = CompileRecord(paperid='paper1', version=Version.CANDIDATE, started=datetime.now())
+    comprec.set_result(session, CompilationParts(_compilation('lost log ' * 1000)))
+    session.add(comprec)
+    session.commit()
+    # SQLite does not enforce the foreign key, so the blob can vanish.
+    session.query(CompileBlob).delete()
+    session.commit()
+    with caplog.at_level(logging.ERROR):
+        assert comprec.get_result(session).log is None
+    assert 'missing the blob' in caplog.text
+
+def test_migrate():
+    session = _session()
+    compilation = _compilation('old log ' * 1000)
+    full = compilation.model_dump_json(indent=2, exclude_none=True)
+    session.add(CompileRecord(paperid='paper1', version=Version.CANDIDATE, started=datetime.now(), result=full))
+    session.add(CompileRecord(paperid='paper1', version=Version.FINAL, started=datetime.now(), result='{"paperid": "paper1"}'))
+    session.add(CompileBlob(digest='0' * 64, data=b'', size=0))
+    session.commit()
+    old = session.execute(select(CompileRecord).filter_by(version=Version.CANDIDATE)).scalar_one()
+    # Records that were not migrated yet can still be read.
+    assert old.get_result(session) == compilation
+    assert migrate_compile_records(session) == 1
+    assert [link.field for link in old.blob_links] == ['log']
+    assert old.error_count == 1
+    assert len(old.result) < len(full) // 2
+    assert old.get_result(session) == compilation
+    # The invalid one is left alone.
+    invalid = session.execute(select(CompileRecord).filter_by(version=Version.FINAL)).scalar_one()
+    assert invalid.error_count == 0
+    assert invalid.result == '{"paperid": "paper1"}'
+    assert migrate_compile_records(session) == 0
+    # The unused blob is deleted by delete_unused_blobs.
+    assert session.get(CompileBlob, '0' * 64) is not None
+    assert delete_unused_blobs(session) == 1
+    assert session.get(CompileBlob, '0' * 64) is None
+    # Also after the records of a paper are deleted without a cascade.
+    session.delete(old)
+    session.commit()
+    assert len(session.execute(select(CompileRecordBlob)).scalars().all()) == 1
+    assert delete_unused_blobs(session) == 1
+    assert session.execute(select(CompileBlob)).scalars().all() == []
@@ -0,0 +1,82 @@
+import os
+from pathlib import Path
+import threading
+import time
+from webapp.compiler import cache as cache_module
+from webapp.compiler.cache import CompileCache
+
+def _make_output(path, size):
+    path.mkdir()
+    Path(path, 'sub').mkdir()
+    Path(path, 'main.pdf').write_bytes(b'x' * size)
+    Path(path, 'sub', 'fig.png').write_bytes(b'y')
+
+def test_hit_and_miss(tmp_path):
+    cache = CompileCache(tmp_path / 'cache', 10000)
+    assert cache.get('abc', tmp_path / 'out1') is None
+    assert not (tmp_path / 'out1').exists()
+    _make_output(tmp_path / 'compiled', 100)
+    cache.put('abc', tmp_path / 'compiled', {'exit_code': 0, 'log': 'hello'})
+    data = cache.get('abc', tmp_path / 'out2')
+    assert data == {'exit_code': 0, 'log': 'hello'}
+    assert Path(tmp_path, 'out2', 'main.pdf').read_bytes() == b'x' * 100
+    assert Path(tmp_path, 'out2', 'sub', 'fig.png').is_file()
+    # output_dir must not already exist.
+    assert cache.get('abc', tmp_path / 'out2') is None
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['entries'] == 1
+    assert stats['bytes'] == 101
+
+def test_lru_eviction(tmp_path):
+    cache = CompileCache(tmp_path / 'cache', 2500)
+    for key in ['a', 'b']:
+        _make_output(tmp_path / key, 1000)
+        cache.put(key, tmp_path / key, {'key': key})
+    # Make 'a' the most recently used.
+    payload = tmp_path / 'cache' / 'entries' / 'b' / 'payload.json'
+    os.utime(payload, (time.time() - 100, time.time() - 100))
+    assert cache.get('a', tmp_path / 'out') == {'key': 'a'}
+    _make_output(tmp_path / 'c', 1000)
+    cache.put('c', tmp_path / 'c', {'key': 'c'})
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['evictions'] == 1
+    assert cache.get('b', tmp_path / 'outb') is None
+    assert cache.get('c', tmp_path / 'outc') == {'key': 'c'}
+
+def test_no_eviction_during_get(tmp_path, monkeypatch):
+    cache = CompileCache(tmp_path / 'cache', 10000)
+    _make_output(tmp_path / 'compiled', 100)
+    cache.put('abc', tmp_path / 'compiled', {'key': 'abc'})
+    cache.max_bytes = 0
+    evictions = []
+    copy_tree = cache_module._copy_tree
+    def evict_while_copying(src_dir, dst_dir):
+        t = threading.Thread(target=cache.evict)
+        t.start()
+        evictions.append(t)
+        # The eviction waits until the copy is finished.
+        t.join(0.5)
+        assert t.is_alive()
+        return copy_tree(src_dir, dst_dir)
+    monkeypatch.setattr(cache_module, '_copy_tree', evict_while_copying)
+    assert cache.get('abc', tmp_path / 'out') == {'key': 'abc'}
+    evictions[0].join()
+    assert Path(tmp_path, 'out', 'sub', 'fig.png').is_file()
+    assert cache.stats()['entries'] == 0
+
+def test_entries_are_not_shared(tmp_path):
+    cache = CompileCache(tmp_path / 'cache', 10000)
+    _make_output(tmp_path / 'compiled', 100)
+    cache.put('abc', tmp_path / 'compiled', {'key': 'abc'})
+    # Neither the output that was stored nor an output that was a hit
+    # can change the entry.
+    Path(tmp_path, 'compiled', 'main.pdf').write_bytes(b'changed')
+    assert cache.get('abc', tmp_path / 'out1') == {'key': 'abc'}
+    with open(Path(tmp_path, 'out1', 'main.pdf'), 'r+b') as f:
+        f.write(b'changed')
+    assert cache.get('abc', tmp_path / 'out2') == {'key': 'abc'}
+    assert Path(tmp_path, 'out2', 'main.pdf').read_bytes() == b'x' * 100
+    assert Path(tmp_path, 'cache', 'entries', 'abc', 'output', 'main.pdf').read_bytes() == b'x' * 100
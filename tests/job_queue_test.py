@@ -0,0 +1,257 @@
+from datetime import datetime, timedelta
+import random
+from webapp import db
+from types import SimpleNamespace
+from webapp.job_queue import compile_queue, QueueFull, schedule, score, admission_wait, CompileTimeEstimator, QueueSnapshot, PRIORITY_ADMIN, PRIORITY_CANDIDATE
+from webapp.metadata.compilation import Compilation
+from webapp.metadata.db_models import CompileJob, CompilationParts, JobStatus, PaperStatus, PaperStatusEnum, Version
+from sqlalchemy import select
+
+def _add_paper(paperid):
+    db.session.add(PaperStatus(paperid=paperid,
+                               email='author@example.com',
+                               hotcrp='none',
+                               hotcrp_id='none',
+                               status=PaperStatusEnum.PENDING,
+                               journal_key='cic',
+                               volume_key='1',
+                               issue_key='1',
+                               submitted='2024-01-01',
+                               accepted='2024-01-02'))
+    db.session.commit()
+
+def _compilation_json(paperid):
+    """The compilation.json that submit_version writes for an upload."""
+    return CompilationParts(Compilation(paperid=paperid,
+                                        venue='cic',
+                                        email='author@example.com',
+                                        submitted='2024-01-01 00:00:00',
+                                        accepted='2024-01-02 00:00:00',
+                                        compiled=datetime.now(),
+                                        command='latexmk main',
+                                        error_log=[],
+                                        warning_log=[],
+                                        zipfilename='paper.zip')).json()
+
+def _enqueue(paperid):
+    return compile_queue.enqueue(paperid + '/candidate', paperid, Version.CANDIDATE.value,
+                                 'latexmk main', '/tmp/' + paperid + '/candidate', '10.1729/x')
+
+def test_enqueue_once(app):
+    with app.app_context():
+        _add_paper('p1')
+        assert _enqueue('p1')
+        # A second compilation is rejected while the first is queued.
+        assert not _enqueue('p1')
+        assert compile_queue.is_active('p1/candidate')
+        assert compile_queue.stats()['QUEUED'] == 1
+
+def test_claim_and_finish(app):
+    with app.app_context():
+        _add_paper('p1')
+        _add_paper('p2')
+        assert _enqueue('p1')
+        assert _enqueue('p2')
+        job = compile_queue.get_job('p2/candidate')
+        assert compile_queue.position(job) == (2, 2)
+        job = compile_queue.claim('worker-a')
+        assert job.task_key == 'p1/candidate'
+        assert job.status == JobStatus.RUNNING
+        assert job.attempts == 1
+        # The running job is not claimed again.
+        other = compile_queue.claim('worker-b')
+        assert other.task_key == 'p2/candidate'
+        assert compile_queue.claim('worker-c') is None
+        assert compile_queue.heartbeat(job.id, 'worker-a')
+        assert not compile_queue.heartbeat(job.id, 'worker-b')
+        compile_queue.finish(job.id, 'worker-a')
+        assert not compile_queue.is_active('p1/candidate')
+        # The row is reused for the next compilation.
+        assert _enqueue('p1')
+        assert len(db.session.execute(select(CompileJob)).scalars().all()) == 2
+
+def test_expired_lease(app):
+    with app.app_context():
+        _add_paper('p1')
+        assert _enqueue('p1')
+        job = compile_queue.claim('worker-a')
+        # Simulate a worker that died.
+        job.lease_expires = datetime.now() - timedelta(seconds=1)
+        db.session.commit()
+        job = compile_queue.claim('worker-b')
+        assert job.worker_id == 'worker-b'
+        assert job.attempts == 2
+        assert not compile_queue.heartbeat(job.id, 'worker-a')
+        for i in range(compile_queue.max_attempts):
+            job.lease_expires = datetime.now() - timedelta(seconds=1)
+            db.session.commit()
+            compile_queue.claim('worker-c')
+        job = compile_queue.get_job('p1/candidate')
+        db.session.refresh(job)
+        assert job.status == JobStatus.FAILED
+
+def _job(id, priority, journal_key, minutes_ago, now):
+    return SimpleNamespace(id=id, priority=priority, journal_key=journal_key,
+                           enqueued_at=now - timedelta(minutes=minutes_ago))
+
+def test_schedule():
+    now = datetime.now()
+    # An admin recompile goes ahead of older candidate uploads.
+    jobs = [_job(1, PRIORITY_CANDIDATE, 'cic', 3, now),
+            _job(2, PRIORITY_CANDIDATE, 'cic', 2, now),
+            _job(3, PRIORITY_ADMIN, 'cic', 1, now)]
+    assert [j.id for j in schedule(jobs, {}, now, 300, 0.5)] == [3, 1, 2]
+    # Journals take turns.
+    jobs = [_job(1, PRIORITY_CANDIDATE, 'cic', 3, now),
+            _job(2, PRIORITY_CANDIDATE, 'cic', 2, now),
+            _job(3, PRIORITY_CANDIDATE, 'tosc', 1, now)]
+    assert [j.id for j in schedule(jobs, {}, now, 300, 0.5)] == [1, 3, 2]
+    assert [j.id for j in schedule(jobs, {'cic': 2}, now, 300, 0.5)] == [3, 1, 2]
+    # A candidate that waited long enough is not starved by new admin jobs.
+    jobs = [_job(1, PRIORITY_CANDIDATE, 'cic', 30, now),
+            _job(2, PRIORITY_ADMIN, 'cic', 0, now)]
+    assert [j.id for j in schedule(jobs, {}, now, 300, 0.5)] == [1, 2]
+    assert [j.id for j in schedule(jobs, {}, now, 300, 0.5, limit=1)] == [1]
+
+def test_schedule_matches_greedy():
+    """schedule is the same as picking the job with the lowest score each time."""
+    now = datetime.now()
+    rng = random.Random(1)
+    # Waits are not whole minutes, so that no two scores are equal.
+    jobs = [_job(i, rng.choice([0, 1, 2]), rng.choice(['cic', 'tosc', 'tches', None]), rng.uniform(0, 60), now)
+            for i in range(200)]
+    running = {'cic': 2}
+    expected = []
+    pending = list(jobs)
+    counts = dict(running)
+    while pending:
+        best = min(pending, key=lambda j: (score(j.priority, j.journal_key, j.enqueued_at, counts, now, 300, 0.5),
+                                           j.enqueued_at, j.id))
+        pending.remove(best)
+        expected.append(best.id)
+        counts[best.journal_key] = counts.get(best.journal_key, 0) + 1
+    assert [j.id for j in schedule(jobs, running, now, 300, 0.5)] == expected
+
+def test_estimator():
+    records = [('pdflatex', 1000, t) for t in range(1, 11)] + [('lualatex', 1000, 100)]
+    estimator = CompileTimeEstimator(records)
+    assert estimator.estimate('pdflatex', 2000) == (5, 9)
+    # Too few lualatex compilations, so it falls back to all of them.
+    assert estimator.estimate('lualatex', 1000) == (6, 10)
+    assert CompileTimeEstimator([]).estimate('pdflatex', 1000) == (60, 60)
+
+def test_snapshot():
+    now = datetime.now()
+    estimator = CompileTimeEstimator([('pdflatex', 1000, 10)] * 5)
+    order = [SimpleNamespace(id=i, enqueued_at=now - timedelta(seconds=10 * i), journal_key='cic',
+                             engine='pdflatex', input_size=1000) for i in [1, 2, 3]]
+    running = [SimpleNamespace(journal_key='cic', started_at=now - timedelta(seconds=4),
+                               engine='pdflatex', input_size=1000)]
+    snapshot = QueueSnapshot(order, running, estimator, [5, 15], 2, now)
+    assert snapshot.depth == 4
+    assert snapshot.position(3) == 3
+    assert snapshot.position(99) == 4
+    # Two workers, one of which is busy for 6 more seconds.
+    assert snapshot.eta(1) == (10, 10)
+    assert snapshot.eta(2) == (16, 16)
+    assert snapshot.eta(3) == (20, 20)
+    assert snapshot.oldest_wait == 30
+
+def test_admission_wait():
+    now = datetime.now()
+    estimator = CompileTimeEstimator([('pdflatex', 1000, 10)] * 5)
+    order = [SimpleNamespace(id=i, enqueued_at=now, journal_key=journal,
+                             engine='pdflatex', input_size=1000) for i, journal in [(1, 'cic'), (2, 'tosc'), (3, 'cic')]]
+    running = [SimpleNamespace(journal_key='cic', started_at=now - timedelta(seconds=4),
+                               engine='pdflatex', input_size=1000)]
+    # The running cic job finishes after 6 seconds, and the queued jobs
+    # after 10 (cic), 16 (tosc), and 20 (cic) seconds.
+    snapshot = QueueSnapshot(order, running, estimator, [], 2, now)
+    assert admission_wait(snapshot, 'cic', 500) is None
+    assert admission_wait(snapshot, 'cic', 500, max_queued=5) is None
+    assert admission_wait(snapshot, 'cic', 500, max_queued=4) == 6
+    assert admission_wait(snapshot, 'cic', 500, max_queued=2) == 16
+    # An upload that replaces a job is not limited by the number of jobs.
+    assert admission_wait(snapshot, 'cic', 500, max_queued=2, superseding=True) is None
+    assert admission_wait(snapshot, 'tosc', 500, max_per_journal=1) == 16
+    assert admission_wait(snapshot, 'tosc', 500, max_per_journal=2) is None
+    assert admission_wait(snapshot, 'cic', 500, max_per_journal=2) == 10
+    assert admission_wait(snapshot, 'cic', 500, max_per_journal=3) == 6
+    # 4000 bytes are pending.
+    assert admission_wait(snapshot, 'cic', 500, max_bytes=4500) is None
+    assert admission_wait(snapshot, 'cic', 1500, max_bytes=4500) == 6
+    assert admission_wait(snapshot, 'cic', 1500, max_bytes=2500) == 16
+    assert admission_wait(snapshot, 'cic', 5000, max_bytes=4500) == float('inf')
+    # The longest wait of all limits applies.
+    assert admission_wait(snapshot, 'cic', 1500, max_queued=4, max_bytes=2500) == 16
+
+def test_enqueue_limited(app):
+    with app.app_context():
+        _add_paper('p1')
+        _add_paper('p2')
+        compile_queue.max_queued = 1
+        try:
+            assert compile_queue.enqueue('p1/candidate', 'p1', Version.CANDIDATE.value,
+                                         'latexmk main', '/tmp/p1/candidate', '10.1729/x', limited=True)
+            try:
+                compile_queue.enqueue('p2/candidate', 'p2', Version.CANDIDATE.value,
+                                      'latexmk main', '/tmp/p2/candidate', '10.1729/x', limited=True)
+                assert False
+            except QueueFull:
+                pass
+            # A second upload of p1 is a duplicate rather than a new job.
+            assert not compile_queue.enqueue('p1/candidate', 'p1', Version.CANDIDATE.value,
+                                             'latexmk main', '/tmp/p1/candidate', '10.1729/x', limited=True)
+            # Admin recompiles are not limited.
+            assert _enqueue('p2')
+        finally:
+            compile_queue.max_queued = None
+
+def test_supersede(app, tmp_path):
+    with app.app_context():
+        _add_paper('p1')
+        version_dir = tmp_path / 'candidate'
+        (version_dir / 'input').mkdir(parents=True)
+        # Without a job, the caller must enqueue.
+        assert not compile_queue.supersede('p1/candidate', 'latexmk main', str(version_dir), '10.1729/x',
+                                           str(tmp_path / 'unused'))
+        assert compile_queue.enqueue('p1/candidate', 'p1', Version.CANDIDATE.value,
+                                     'latexmk main', str(version_dir), '10.1729/x')
+        for i in [1, 2]:
+            staging = tmp_path / 'candidate.next-{}'.format(i)
+            (staging / 'input').mkdir(parents=True)
+            (staging / 'input' / 'main.tex').write_text(str(i))
+            (staging / 'compilation.json').write_text(_compilation_json('paper1'))
+            assert compile_queue.supersede('p1/candidate', 'latexmk main', str(version_dir), '10.1729/x',
+                                           str(staging))
+        # Only the newest upload is kept.
+        assert not (tmp_path / 'candidate.next-1').exists()
+        job = compile_queue.claim('worker-a')
+        args = compile_queue._take_next(job.id, 'worker-a', 'p1', Version.CANDIDATE.value)
+        assert args['paper_path'] == str(version_dir)
+        assert (version_dir / 'input' / 'main.tex').read_text() == '2'
+        assert compile_queue._take_next(job.id, 'worker-a', 'p1', Version.CANDIDATE.value) is None
+        assert not compile_queue.finish(job.id, 'worker-a')
+        assert not compile_queue.is_active('p1/candidate')
+
+def test_enqueue_staging(app, tmp_path):
+    with app.app_context():
+        _add_paper('p1')
+        version_dir = tmp_path / 'candidate'
+        (version_dir / 'input').mkdir(parents=True)
+        (version_dir / 'input' / 'main.tex').write_text('old')
+        staging = tmp_path / 'candidate.next-1'
+        (staging / 'input').mkdir(parents=True)
+        (staging / 'input' / 'main.tex').write_text('new')
+        (staging / 'compilation.json').write_text(_compilation_json('paper1'))
+        assert compile_queue.enqueue('p1/candidate', 'p1', Version.CANDIDATE.value,
+                                     'latexmk main', str(version_dir), '10.1729/x', staging=str(staging))
+        # The previous upload is left alone until a worker takes the job.
+        assert (version_dir / 'input' / 'main.tex').read_text() == 'old'
+        assert not compile_queue.enqueue('p1/candidate', 'p1', Version.CANDIDATE.value,
+                                         'latexmk main', str(version_dir), '10.1729/x', staging=str(tmp_path / 'other'))
+        job = compile_queue.claim('worker-a')
+        args = compile_queue._take_next(job.id, 'worker-a', 'p1', Version.CANDIDATE.value)
+        assert args['paper_path'] == str(version_dir)
+        assert (version_dir / 'input' / 'main.tex').read_text() == 'new'
+        assert not staging.exists()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+from pathlib import Path
+from webapp.manifest import build_manifest, write_manifest, read_manifest, remove_manifest, get_files, get_file
+
+def _make_version(path):
+    Path(path, 'input', 'figs').mkdir(parents=True)
+    Path(path, 'input', 'main.tex').write_text('\\documentclass{iacrcc}\n')
+    Path(path, 'input', 'figs', 'a.png').write_bytes(b'png')
+    Path(path, 'output').mkdir()
+    Path(path, 'output', 'main.pdf').write_bytes(b'%PDF')
+    os.symlink('/etc/passwd', Path(path, 'output', 'link'))
+
+def test_write_and_read(tmp_path):
+    _make_version(tmp_path)
+    # Without a manifest the directory is scanned, but not hashed.
+    files = get_files(tmp_path, 'input')
+    assert [f['path'] for f in files] == ['figs/a.png', 'main.tex']
+    assert files[0]['sha256'] is None
+    manifest = write_manifest(tmp_path)
+    assert read_manifest(tmp_path) == manifest
+    assert get_files(tmp_path, 'input') == manifest['input']
+    pdf = get_file(tmp_path, 'output', 'main.pdf')
+    assert pdf['size'] == 4
+    assert pdf['mime'] == 'application/pdf'
+    assert pdf['sha256'] == hashlib.sha256(b'%PDF').hexdigest()
+    # Symlinks and paths outside of the tree are not listed.
+    assert get_file(tmp_path, 'output', 'link') is None
+    assert get_file(tmp_path, 'output', '../input/main.tex') is None
+
+def test_reuse_hashes(tmp_path):
+    _make_version(tmp_path)
+    write_manifest(tmp_path)
+    previous = remove_manifest(tmp_path)
+    assert read_manifest(tmp_path) is None
+    # A hash is reused if the size and mtime did not change, so this one
+    # is stale on purpose.
+    previous['input'][1]['sha256'] = 'reused'
+    Path(tmp_path, 'input', 'figs', 'a.png').write_bytes(b'PNG')
+    os.utime(Path(tmp_path, 'input', 'figs', 'a.png'), (0, 0))
+    manifest = write_manifest(tmp_path, previous)
+    assert manifest['input'][1]['sha256'] == 'reused'
+    assert manifest['input'][0]['sha256'] == hashlib.sha256(b'PNG').hexdigest()
+
+def test_build_before_write(tmp_path):
+    _make_version(tmp_path)
+    Path(tmp_path, 'output.new').mkdir()
+    Path(tmp_path, 'output.new', 'main.log').write_text('log')
+    manifest = build_manifest(tmp_path, output_dir=Path(tmp_path, 'output.new'))
+    assert read_manifest(tmp_path) is None
+    assert [f['path'] for f in manifest['output']] == ['main.log']
+    assert write_manifest(tmp_path, manifest=manifest) == manifest
+    assert read_manifest(tmp_path) == manifest
@@ -0,0 +1,26 @@
+from webapp.metrics import Metrics, MetricsStore
+
+def test_render(tmp_path):
+    metrics = Metrics()
+    metrics.store = MetricsStore(tmp_path / 'metrics.sqlite')
+    metrics.inc('latex_submit_uploads_total', {'version': 'candidate', 'outcome': 'queued'})
+    metrics.inc('latex_submit_uploads_total', {'version': 'candidate', 'outcome': 'queued'})
+    metrics.observe('latex_submit_compile_seconds', 7.5, {'engine': 'pdflatex'})
+    # A second store on the same file sees the same values, as another process would.
+    other = Metrics()
+    other.store = MetricsStore(tmp_path / 'metrics.sqlite')
+    other.observe('latex_submit_compile_seconds', 0.5, {'engine': 'pdflatex'})
+    text = metrics.render()
+    assert 'latex_submit_uploads_total{outcome="queued",version="candidate"} 2\n' in text
+    assert 'latex_submit_compile_seconds_bucket{engine="pdflatex",le="1"} 1\n' in text
+    assert 'latex_submit_compile_seconds_bucket{engine="pdflatex",le="10"} 2\n' in text
+    assert 'latex_submit_compile_seconds_count{engine="pdflatex"} 2\n' in text
+    assert 'latex_submit_compile_seconds_sum{engine="pdflatex"} 8\n' in text
+
+def test_access(app, client):
+    assert client.get('/metrics').status_code == 403
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert b'# TYPE latex_submit_compile_seconds histogram' in response.data
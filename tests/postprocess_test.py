@@ -0,0 +1,36 @@
+import threading
+from webapp.postprocess import Stage, StageFailed, run_stages
+
+def test_dependencies():
+    both = threading.Barrier(2, timeout=5)
+    def independent(value):
+        # Both stages must be running at the same time to pass the barrier.
+        both.wait()
+        return value
+    stages = [Stage('a', lambda: independent(1)),
+              Stage('b', lambda: independent(2)),
+              Stage('sum', lambda a, b: a + b, deps=['a', 'b'])]
+    results, timings = run_stages(stages)
+    assert results == {'a': 1, 'b': 2, 'sum': 3}
+    assert set(timings) == {'a', 'b', 'sum'}
+
+def test_failure():
+    def fail():
+        raise ValueError('broken')
+    stages = [Stage('a', fail),
+              Stage('b', lambda: 2),
+              Stage('c', lambda a: a, deps=['a'])]
+    results, timings = run_stages(stages)
+    assert isinstance(results['a'], StageFailed)
+    assert str(results['a'].error) == 'broken'
+    # c is skipped because a failed.
+    assert isinstance(results['c'], StageFailed)
+    assert 'c' not in timings
+    assert results['b'] == 2
+
+def test_unknown_dependency():
+    try:
+        run_stages([Stage('a', lambda b: b, deps=['b'])])
+        assert False
+    except ValueError:
+        pass
@@ -78,3 +78,28 @@ def test_submit_form(app, client):
     assert pubtype_input.attrs.get('value') == 'ERRATA'
     doi_input = soup.body.find('input', id='errata_doi')
     assert doi_input.attrs.get('value') == '10.1729/feebar'
+
+def test_progress(app, client, tmp_path):
+    """The progress endpoint returns the log of latexmk incrementally."""
+    app.config['DATA_DIR'] = str(tmp_path)
+    paperid = 'progresstest'
+    version = Version.CANDIDATE.value
+    auth = create_hmac([paperid, version])
+    url = '/tasks/{}/{}/{}/progress'.format(paperid, version, auth)
+    response = client.get(url)
+    assert response.json['running'] == False
+    version_dir = tmp_path / paperid / version
+    version_dir.mkdir(parents=True)
+    log_file = version_dir / 'latexmk.log'
+    log_file.write_text("Run number 1 of rule 'pdflatex'\nThis is pdfTeX\n")
+    response = client.get(url)
+    assert response.json['running'] == True
+    assert response.json['pass'] == "Run number 1 of rule 'pdflatex'"
+    offset = response.json['offset']
+    with log_file.open('a') as f:
+        f.write("Run number 2 of rule 'pdflatex'\n")
+    response = client.get(url + '?offset={}'.format(offset))
+    assert response.json['text'] == "Run number 2 of rule 'pdflatex'\n"
+    assert response.json['pass'] == "Run number 2 of rule 'pdflatex'"
+    response = client.get('/tasks/{}/{}/{}/progress'.format(paperid, version, 'bad'))
+    assert response.status_code == 403
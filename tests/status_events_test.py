@@ -0,0 +1,27 @@
+import queue
+from webapp.status_events import StatusBroker
+
+def test_publish_subscribe():
+    broker = StatusBroker()
+    events = broker.subscribe('p1/candidate')
+    other = broker.subscribe('p2/candidate')
+    broker.publish('p1/candidate', 'RUNNING', 'running', 'Compilation is running')
+    event = events.get(timeout=1)
+    assert event.stage == 'running'
+    assert other.empty()
+    broker.unsubscribe('p1/candidate', events)
+    broker.unsubscribe('p2/candidate', other)
+    assert broker.subscriber_count() == 0
+
+def test_late_subscriber():
+    broker = StatusBroker()
+    broker.publish('p1/candidate', 'PENDING', 'queued', 'Queued')
+    broker.publish('p1/candidate', 'RUNNING', 'postprocessing', 'Processing the output')
+    # A subscriber sees only the last event.
+    events = broker.subscribe('p1/candidate')
+    assert events.get(timeout=1).stage == 'postprocessing'
+    try:
+        events.get_nowait()
+        assert False
+    except queue.Empty:
+        pass
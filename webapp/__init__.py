@@ -1,4 +1,3 @@
-from collections import OrderedDict
 from datetime import datetime
 from flask import Flask, request, render_template, current_app
 from flask_mail import Mail
@@ -10,7 +9,6 @@ from flask_sqlalchemy_lite import SQLAlchemy
 from sqlalchemy import create_engine, event, select
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import scoped_session, sessionmaker
-from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import hashlib, hmac
 import os
@@ -62,16 +60,6 @@ def get_pdf_url(paperid, version):
 # Globally accessible SMTP client. This can be used in unit tests as well.
 mail = Mail()
 
-# Used to keep track of compilations by paperid. When a task is
-# submitted, then the paperid key is added to this with a value of the Future
-# that will run the compilation.. When a task is finished it removes the paperid
-# from the task_queue. This allows us to keep track of which
-# papers are queued for processing so that we don't enqueue a paper
-# twice and monitor the status of the queue in the admin interface.
-task_queue = OrderedDict()
-
-executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compiler')
-
 class Scheduler(BackgroundScheduler):
     """A simple wrapper around apscheduler. Much simpler than flask_apscheduler."""
     def init_app(self, app):
@@ -176,7 +164,7 @@ def create_app(config):
     mail.init_app(app)
     security = flask_security.Security(app, user_datastore)
     db.init_app(app)
-    from webapp.metadata.db_models import Base
+    from webapp.metadata.db_models import Base, upgrade_schema
     if config.DEMO_INSTANCE and config.DEBUG:
         from .cleanup import cleanup_task
         scheduler.init_app(app)
@@ -201,12 +189,18 @@ def create_app(config):
         app.jinja_env.filters['obfuscate_email'] = obfuscate_email
         # Create database tables if they don't already exist.
         Base.metadata.create_all(bind=db.engine)
+        upgrade_schema(db.engine)
         from . import routes
         from . import admin
         from . import ojs_admin
         app.register_blueprint(routes.home_bp)
         app.register_blueprint(admin.admin_bp)
         app.register_blueprint(ojs_admin.ojs_bp)
+        from .metrics import metrics, metrics_bp
+        metrics.init_app(app)
+        app.register_blueprint(metrics_bp)
+        from .remote_workers import remote_bp
+        app.register_blueprint(remote_bp)
         #if config.DEBUG:
         #    for rule in app.url_map.iter_rules():
         #        print(rule.rule, '=> ', rule.endpoint)
@@ -218,6 +212,8 @@ def create_app(config):
         limiter.limit("5/minute", error_message='Too many requests. Rate limiting is in effect.')(app.blueprints[config.SECURITY_BLUEPRINT_NAME])
         limiter.exempt(routes.home_bp)
         limiter.exempt(ojs_admin.ojs_bp)
+        limiter.exempt(metrics_bp)
+        limiter.exempt(remote_bp)
         admin_role =  user_datastore.find_role(Role.ADMIN)
         if not admin_role:
             admin_role = user_datastore.create_role(name=Role.ADMIN,
@@ -227,9 +223,31 @@ def create_app(config):
         if config.INIT_FILE:
             initialize_data(config.INIT_FILE, admin_role, db, user_datastore)
         db.session.commit()
-        # This makes it possible for bibexport to find cryptobib.
+        # This makes it possible for bibextract to find cryptobib.
         os.environ['BIBINPUTS'] = '.:{}'.format(os.path.join(app.root_path,
                                                              'metadata/latex/iacrcc'))
+        if config.BIBTEX_INDEX:
+            from .metadata import bibextract
+            bibextract.configure_index(Path(config.DATA_DIR) / Path('bibindex'))
+        # Compilations are queued in the database (see job_queue.py). They
+        # are run by this process unless COMPILER_IN_PROCESS is false, in
+        # which case they are run by webapp/worker.py.
+        if config.COMPILER_IN_PROCESS and not config.TESTING:
+            from .compiler import runner
+            runner.configure_limits(cpu_shares=config.COMPILER_CPU_SHARES,
+                                    cpusets=config.COMPILER_CPUSETS,
+                                    mem_limit=config.COMPILER_MEM_LIMIT,
+                                    pids_limit=config.COMPILER_PIDS_LIMIT)
+            if config.COMPILER_FONT_CACHE:
+                runner.configure_font_cache()
+            if config.COMPILER_POOL_SIZE > 0:
+                if config.COMPILER_POOL_SIZE < config.COMPILER_WORKERS:
+                    app.logger.warning('COMPILER_POOL_SIZE is smaller than COMPILER_WORKERS')
+                runner.configure_pool(size=config.COMPILER_POOL_SIZE,
+                                      max_uses=config.COMPILER_POOL_MAX_USES,
+                                      idle_timeout=config.COMPILER_POOL_IDLE_TIMEOUT)
+        from .job_queue import compile_queue
+        compile_queue.init_app(app)
         return app
 
 
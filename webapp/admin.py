@@ -19,14 +19,18 @@ import logging
 import os
 from pathlib import Path
 import time
-from . import db, create_hmac, mail, generate_password, task_queue, paper_key, executor, user_datastore
+from . import db, create_hmac, mail, generate_password, paper_key, user_datastore
 from .metadata.compilation import Compilation, CompileStatus
 from .metadata import validate_paperid
-from .metadata.db_models import Role, User, validate_version, PaperStatus, PaperStatusEnum, Discussion, Version, LogEvent, DiscussionStatus, Discussion, Journal, Issue, Volume, CompileRecord, TaskStatus, log_event, NO_HOTCRP
+from .metadata.db_models import Role, User, validate_version, PaperStatus, PaperStatusEnum, Discussion, Version, LogEvent, DiscussionStatus, Discussion, Journal, Issue, Volume, CompileRecord, TaskStatus, log_event, NO_HOTCRP, CompilationParts
 from .forms import AdminUserForm, MoreChangesForm, PublishIssueForm, ChangeIssueForm, ChangePaperNumberForm, CopyeditClaimForm, DeletePaperForm
-from .tasks import run_latex_task
-from .routes import context_wrap
+from .tasks import get_compile_cache, TRACE_FILE, LIVE_LOG
+from .manifest import get_files, MANIFEST_FILE
+from .compiler.tracing import read_traces, span_tree
+from .job_queue import compile_queue, new_staging_dir, PRIORITY_ADMIN
+from .metrics import metrics
 from .bibmarkup import mark_bibtex
+from .compiler import runner
 
 from functools import wraps
 import shutil
@@ -97,8 +101,18 @@ def show_admin_home():
     if view_only:
         for j in journals:
             j['ojs_view'] = url_for('ojs_file.show_ojs_journal', hotcrp_key=j['hotcrp_key'])
+    pool_stats = None
+    cache_stats = None
+    queue_stats = None
+    queue_snapshot = None
     if current_user.has_role(Role.ADMIN):
         papers = db.session.execute(select(PaperStatus).order_by(PaperStatus.lastmodified.desc())).scalars().all()
+        queue_stats = compile_queue.stats()
+        queue_snapshot = compile_queue.snapshot()
+        pool_stats = runner.pool_stats()
+        cache = get_compile_cache()
+        if cache:
+            cache_stats = cache.stats()
     else:
         # we could just select the papers that the user has access to, but it's not necessary for the UX.
         papers = []
@@ -107,9 +121,27 @@ def show_admin_home():
             'errors': errors,
             'journal_name': app.config['SITE_SHORTNAME'],
             'papers': papers,
+            'queue_stats': queue_stats,
+            'queue_snapshot': queue_snapshot,
+            'pool_stats': pool_stats,
+            'cache_stats': cache_stats,
             'journals': journals}
     return render_template('admin/home.html', **data)
 
+# Number of compile traces shown for each version of a paper.
+MAX_TRACES = 3
+
+def _version_traces(version_dir):
+    """The latest compile traces of a version, newest first, with their
+    spans in the order to show them."""
+    traces = []
+    for t in read_traces(version_dir / Path(TRACE_FILE), limit=MAX_TRACES):
+        try:
+            traces.append(dict(t, spans=span_tree(t), started=datetime.fromtimestamp(t['started'])))
+        except Exception as e:
+            logging.warning('Bad trace in {}: {}'.format(str(version_dir), str(e)))
+    return traces
+
 @admin_bp.route('/admin/view/<paperid>')
 @auth_required()
 def show_admin_paper(paperid):
@@ -152,7 +184,8 @@ def show_admin_paper(paperid):
             try:
                 cstr = (v / Path('compilation.json')).read_text(encoding='UTF-8')
                 versions[v.name] = {'url': url,
-                                    'comp': Compilation.model_validate_json(cstr)}
+                                    'comp': Compilation.model_validate_json(cstr),
+                                    'traces': _version_traces(v)}
             except Exception as e:
                 flash('Error: {}:{}'.format(str(v), str(e)))
     data = {'title': 'Paper status: {}'.format(paperid),
@@ -172,6 +205,43 @@ def all_users():
             'all_users': db.session.execute(select(User)).scalars().all()}
     return render_template('admin/all_users.html', **data)
 
+# Thresholds for explaining why a compilation was expensive.
+MANY_PASSES = 4
+HIGH_MEMORY = 2**30
+HIGH_IO = 500 * 2**20
+
+def _expense_reasons(comprec: CompileRecord) -> list[str]:
+    reasons = []
+    if comprec.latex_passes and comprec.latex_passes >= MANY_PASSES:
+        reasons.append('{} latex passes'.format(comprec.latex_passes))
+    if comprec.peak_memory and comprec.peak_memory >= HIGH_MEMORY:
+        reasons.append('high memory')
+    if comprec.io_bytes and comprec.io_bytes >= HIGH_IO:
+        reasons.append('heavy I/O')
+    if comprec.engine and comprec.engine != 'pdflatex':
+        reasons.append(comprec.engine)
+    return reasons
+
+@admin_bp.route('/admin/compile_stats', methods=['GET'])
+@auth_required()
+@roles_required(Role.ADMIN)
+def compile_stats():
+    """Show the most expensive compilations, to help with capacity planning."""
+    sort_columns = {'cpu_time': CompileRecord.cpu_time,
+                    'compile_time': CompileRecord.compile_time,
+                    'peak_memory': CompileRecord.peak_memory,
+                    'io_bytes': CompileRecord.io_bytes}
+    sort = request.args.get('sort', 'cpu_time')
+    if sort not in sort_columns:
+        sort = 'cpu_time'
+    column = sort_columns[sort]
+    sql = select(CompileRecord).where(column != None).order_by(column.desc()).limit(100)
+    comprecs = db.session.execute(sql).scalars().all()
+    data = {'title': 'Expensive compilations',
+            'sort': sort,
+            'records': [(c, _expense_reasons(c)) for c in comprecs]}
+    return render_template('admin/compile_stats.html', **data)
+
 @admin_bp.route('/admin/user', methods=['GET', 'POST'])
 @auth_required()
 @roles_required(Role.ADMIN)
@@ -294,8 +364,7 @@ def copyedit(paperid):
         logging.critical(msg)
         return redirect(url_for('admin_file.show_admin_home'))
     paper_path = Path(app.config['DATA_DIR']) / Path(paperid) / Path(Version.CANDIDATE.value)
-    input_dir = paper_path / Path('input')
-    input_files = sorted([str(p.relative_to(str(input_dir))) for p in input_dir.rglob('*') if p.is_file()])
+    input_files = [f['path'] for f in get_files(paper_path, 'input')]
     comp_path = paper_path / Path('compilation.json')
     compilation = Compilation.model_validate_json(comp_path.read_text(encoding='UTF-8'))
     claimform = CopyeditClaimForm(paperid=paperid,
@@ -583,9 +652,9 @@ def finish_copyedit():
         candidate_comprec = db.session.execute(candidate_sql).scalar_one_or_none()
         final_comprec = CompileRecord(paperid=paperid,
                                       version=Version.FINAL,
-                                      result=candidate_comprec.result,
                                       task_status=TaskStatus.FINISHED,
                                       started=datetime.now())
+        final_comprec.copy_result(db.session, candidate_comprec)
         db.session.add(final_comprec)
         paper_status.status = PaperStatusEnum.COPY_EDIT_ACCEPT.value
         paper_status.lastmodified = datetime.now()
@@ -641,6 +710,18 @@ def finish_copyedit():
     flash('Author of {} was notified to review the copy editor suggestions'.format(paperid));
     return redirect(url_for('admin_file.copyedit_home'), code=302)
 
+def _stage_recompile(version_dir):
+    """Copy version_dir to a new staging directory for enqueue, without
+    the output of its last compilation. returns the staging directory."""
+    version_dir = Path(version_dir)
+    def ignore(path, names):
+        if Path(path) != version_dir:
+            return []
+        return [name for name in names if name.split('.')[0] == 'output' or name in (MANIFEST_FILE, LIVE_LOG)]
+    staging_dir = new_staging_dir(version_dir)
+    shutil.copytree(version_dir, staging_dir, ignore=ignore)
+    return staging_dir
+
 ## This method is used if a paper is being sent back to the author for
 ## further changes after their first round of responses. In this case
 ## 1. The candidate version is replaced by the final version and the
@@ -666,6 +747,9 @@ def request_more_changes():
         flash(msg)
         logging.critical(msg)
         return redirect(url_for('admin_file.show_admin_home'))
+    task_key = paper_key(paperid, Version.COPYEDIT.value)
+    if compile_queue.is_active(task_key):
+        return admin_message('At most one compilation may be queued on each paper.')
     paper_status.status = PaperStatusEnum.EDIT_REVISED
     now = datetime.now()
     paper_status.lastmodified = now
@@ -692,26 +776,22 @@ def request_more_changes():
     comprec = db.session.execute(sql).scalar_one_or_none()
     # change the version of comprec to CANDIDATE
     comprec.version = Version.CANDIDATE
-    last_compilation = Compilation.model_validate_json(comprec.result)
+    last_compilation = comprec.get_result(db.session, fields=[])
     db.session.add(comprec)
     db.session.commit()
     copyedit_dir = paper_dir / Path(Version.COPYEDIT.value)
-    if copyedit_dir.is_dir():
-        shutil.rmtree(copyedit_dir)
-    copyedit_dir.mkdir(parents=True)
+    # As for an upload, this is staged next to copyedit_dir and the worker
+    # moves it into place, so copyedit_dir is left alone if it is not queued.
+    staging_dir = new_staging_dir(copyedit_dir)
+    staging_dir.mkdir(parents=True)
     # copy everything from candidate input_dir
     candidate_input_dir = candidate_dir / Path('input')
-    copyedit_input_dir = copyedit_dir / Path('input')
+    copyedit_input_dir = staging_dir / Path('input')
     shutil.copytree(candidate_input_dir,
                     copyedit_input_dir)
     copyedit_file = copyedit_input_dir / Path('main.copyedit')
     copyedit_file.touch() # this iacrcc.cls to add line numbers.
 
-    copyedit_comprec_sql = select(CompileRecord).where(and_(CompileRecord.paperid == paperid,
-                                                            CompileRecord.version == Version.COPYEDIT))
-    copyedit_comprec = db.session.execute(copyedit_comprec_sql).scalar_one_or_none()
-    copyedit_comprec.task_status = TaskStatus.PENDING
-    copyedit_comprec.started = now
     compilation = Compilation(**{'paperid': paperid,
                                  'venue': paper_status.journal_key,
                                  'status': CompileStatus.COMPILING,
@@ -728,23 +808,16 @@ def request_more_changes():
                                  'warning_log': [],
                                  'zipfilename': last_compilation.zipfilename})
     command = last_compilation.command
-    compstr = compilation.model_dump_json(indent=2, exclude_none=True)
-    copyedit_comprec.result = compstr
-    db.session.add(copyedit_comprec)
-    db.session.commit()
-    compilation_file = copyedit_dir / Path('compilation.json')
-    compilation_file.write_text(compstr, encoding='UTF-8')
-    # fire off a separate task to compile. We wrap run_latex_task so it
-    # can have the flask context to use sqlalchemy on the database.
-    task_key = paper_key(paperid, Version.COPYEDIT.value)
-    task_queue[task_key] = executor.submit(context_wrap(run_latex_task),
-                                           app.root_path,
-                                           command,
-                                           str(copyedit_dir.absolute()),
-                                           paperid,
-                                           last_compilation.meta.DOI,
-                                           Version.COPYEDIT.value,
-                                           task_key)
+    parts = CompilationParts(compilation)
+    # The CompileRecord is updated from this file when it is moved into place.
+    compilation_file = staging_dir / Path('compilation.json')
+    compilation_file.write_text(parts.json(), encoding='UTF-8')
+    # Queue the compilation for a worker.
+    if not compile_queue.enqueue(task_key, paperid, Version.COPYEDIT.value, command,
+                                 str(copyedit_dir.absolute()), last_compilation.meta.DOI, PRIORITY_ADMIN,
+                                 staging=str(staging_dir.absolute())):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return admin_message('At most one compilation may be queued on each paper.')
     status_url = url_for('home_bp.get_status',
                          paperid=paperid,
                          version=Version.COPYEDIT.value,
@@ -753,6 +826,10 @@ def request_more_changes():
                          _external=True)
     data = {'title': 'Recompiling copy editor version',
             'status_url': status_url,
+            'progress_url': url_for('home_bp.get_progress',
+                                    paperid=paperid,
+                                    version=Version.COPYEDIT.value,
+                                    auth=create_hmac([paperid, Version.COPYEDIT.value])),
             'headline': 'Recompiling your paper with line numbers for the copy editor'}
     log_event(db, paperid, 'Another round of copy edit initiated')
     return render_template('running.html', **data)
@@ -866,6 +943,7 @@ def publish_issue():
                                                                   journal.name)
         logging.critical(msg)
         return admin_message(msg)
+    start_time = time.time()
     try:
         now = export_issue(app.config['DATA_DIR'], app.config['EXPORT_PATH'], issue)
         issue.exported = now
@@ -874,7 +952,10 @@ def publish_issue():
     except Exception as e:
         msg = 'Failure to export issue {}: {}'.format(issue.name, str(e))
         logging.critical(msg)
+        metrics.inc('latex_submit_exports_total', {'outcome': 'failed'})
         return admin_message(msg)
+    metrics.inc('latex_submit_exports_total', {'outcome': 'exported'})
+    metrics.observe('latex_submit_export_seconds', time.time() - start_time)
     logging.info('Issue was exported {} to {}'.format(issue.name,
                                                       str(app.config['EXPORT_PATH'])))
     flash('Issue was exported to {}'.format(str(app.config['EXPORT_PATH'])))
@@ -931,7 +1012,7 @@ def change_issue():
     journal = volume.journal
     paperid = paper_status.paperid
     task_key = paper_key(paperid, Version.FINAL.value)
-    if task_queue.get(task_key):
+    if compile_queue.is_active(task_key):
         log_event(db, paperid, 'Attempt to recompile while already compiling')
         return render_template('message.html',
                                title='Another one is running',
@@ -945,17 +1026,13 @@ def change_issue():
     compilation.warning_log = []
     compilation.compiled = now
     compilation.status = CompileStatus.COMPILING
-    input_dir = final_dir / Path('input')
-    output_dir = final_dir / Path('output')
-    sql = select(CompileRecord).filter_by(paperid=paperid).filter_by(version='final')
-    comprec = db.session.execute(sql).scalar_one_or_none()
-    comprec.task_status = TaskStatus.PENDING
-    comprec.started = now
-    compstr = compilation.model_dump_json(indent=2, exclude_none=True)
-    compilation_file.write_text(compstr, encoding='UTF-8')
-    comprec.result = compstr
-    db.session.add(comprec)
-    db.session.commit()
+    # As for an upload, this is staged next to final_dir and the worker
+    # moves it into place, so final_dir is left alone if it is not queued.
+    staging_dir = _stage_recompile(final_dir)
+    input_dir = staging_dir / Path('input')
+    parts = CompilationParts(compilation)
+    # The CompileRecord is updated from this file when it is moved into place.
+    Path(staging_dir, 'compilation.json').write_text(parts.json(), encoding='UTF-8')
     publishedDate = date.today().strftime('%Y-%m-%d')
     doi = compilation.meta.DOI
     metadata = '\\def\\IACR@DOI{' + doi + '}\n'
@@ -971,20 +1048,15 @@ def change_issue():
     metadata += '\\def\\IACR@CROSSMARKURL{https://crossmark.crossref.org/dialog/?doi=' + doi + '\\&domain=pdf\\&date\\_stamp=' + publishedDate + '}\n'
     metadata_file = input_dir / Path('main.iacrmetadata')
     metadata_file.write_text(metadata)
-    # Remove output from any previous run.
-    if output_dir.is_dir():
-        shutil.rmtree(output_dir)
-    # fire off a separate task to compile. We wrap run_latex_task so it
-    # can have the flask context to use sqlalchemy on the database.
+    # Queue the compilation for a worker.
+    if not compile_queue.enqueue(task_key, paperid, Version.FINAL.value, compilation.command,
+                                 str(final_dir.absolute()), compilation.meta.DOI, PRIORITY_ADMIN,
+                                 staging=str(staging_dir.absolute())):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return render_template('message.html',
+                               title='Another one is running',
+                               error='At most one compilation may be queued on each paper.')
     log_event(db, paperid, 'Recompiled for volume {} issue {}'.format(volume.name, issue.name))
-    task_queue[task_key] = executor.submit(context_wrap(run_latex_task),
-                                           app.root_path,
-                                           compilation.command,
-                                           str(final_dir.absolute()),
-                                           paperid,
-                                           compilation.meta.DOI,
-                                           Version.FINAL.value,
-                                           task_key)
     if form.nexturl.data:
         next_url = form.nexturl.data
     else:
@@ -997,6 +1069,10 @@ def change_issue():
                          _external=True)
     data = {'title': 'Recompiling final version',
             'status_url': status_url,
+            'progress_url': url_for('home_bp.get_progress',
+                                    paperid=paperid,
+                                    version=Version.FINAL.value,
+                                    auth=create_hmac([paperid, Version.FINAL.value])),
             'headline': 'Recompiling final version with volume and issue'}
     return render_template('running.html', **data)
 
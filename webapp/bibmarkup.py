@@ -101,6 +101,11 @@ try:
 except Exception as e:
     from .bibstyle import BibStyle
 
+try:
+    from compiler.tracing import span, annotate
+except Exception as e:
+    from .compiler.tracing import span, annotate
+
 import logging
 from io import StringIO
 import sys
@@ -497,7 +502,9 @@ def bibtex_to_html(compilation, cite_map: OrderedDict):
                                                   text='No bibtex extracted'))
         return
     parser = BibTeXParser(cite_map)
-    bibdata = parser.parse_bibtex(compilation.bibtex)
+    with span('parse_bibtex', bytes=len(compilation.bibtex)):
+        bibdata = parser.parse_bibtex(compilation.bibtex)
+        annotate(entries=len(bibdata.entries))
     style = BibStyle(compilation)
     # a map from bibtex key to BibItem so we can assign labels.
     lookup = {}
@@ -0,0 +1,48 @@
+"""Maintenance of the compile_blob table (see CompileRecord in
+metadata/db_models.py). Run this once after upgrading to convert the
+compile records that were written before compile_blob existed, and from
+time to time (e.g. daily from cron) to delete the blobs of papers that
+were deleted:
+
+   python3 -m webapp.compact_records --config webapp/debug_config.json
+
+This is not done by the web server, because it reads the whole
+compile_record table. Records that were not converted yet can still be
+read, so it is safe to run while the web server is running.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from webapp import config
+from webapp.metadata.db_models import Base, upgrade_schema, migrate_compile_records, delete_unused_blobs
+
+def main():
+    argparser = argparse.ArgumentParser(description='Convert old compile records and delete unused blobs')
+    argparser.add_argument('--config',
+                           default='webapp/debug_config.json',
+                           help='JSON file with the Config, as in run.py.')
+    argparser.add_argument('--batch_size', type=int, default=50,
+                           help='number of records converted in each transaction.')
+    args = argparser.parse_args()
+    config_file = Path(args.config)
+    if config_file.is_file():
+        conf = config.Config.model_validate_json(config_file.read_text(encoding='UTF-8'))
+    else: # in case the secrets are in the default file.
+        conf = config.Config()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    engine = create_engine(conf.SQLALCHEMY_ENGINES['default'], **conf.SQLALCHEMY_ENGINE_OPTIONS)
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+    with Session(engine) as session:
+        converted = migrate_compile_records(session, args.batch_size)
+        logging.info('converted {} compile records'.format(converted))
+        deleted = delete_unused_blobs(session)
+        logging.info('deleted {} unused blobs'.format(deleted))
+    engine.dispose()
+
+if __name__ == '__main__':
+    main()
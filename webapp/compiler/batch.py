@@ -0,0 +1,170 @@
+"""
+Compile a corpus of papers in parallel and record the results, for
+example to check that a new texlive image still compiles past papers.
+The corpus is a directory with one subdirectory per paper, each with a
+main.tex. Results are written as JSON lines, one per paper, and can be
+compared with the results of a previous run.
+
+Example:
+   python3 batch.py --corpus /data/past_papers --workers 4 --results new.jsonl --compare old.jsonl
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+from pathlib import Path
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    from . import runner
+    from .engines import ENGINES
+except ImportError:
+    import runner
+    from engines import ENGINES
+
+_pages_re = re.compile(r'^Output written on \S+ \((\d+) pages?', re.MULTILINE)
+_warning_re = re.compile(r'^(?:LaTeX|Package \S+|Class \S+|pdfTeX|LaTeX Font) Warning', re.MULTILINE)
+# Fields that are compared between runs.
+COMPARED_FIELDS = ['exit_code', 'pages', 'errors', 'warnings', 'overfull', 'underfull']
+
+def summarize_log(log):
+    """Return counts from the text of main.log."""
+    pages = _pages_re.findall(log)
+    return {'pages': int(pages[-1]) if pages else None,
+            'errors': len(re.findall(r'^! ', log, re.MULTILINE)),
+            'warnings': len(_warning_re.findall(log)),
+            'overfull': len(re.findall(r'^Overfull \\', log, re.MULTILINE)),
+            'underfull': len(re.findall(r'^Underfull \\', log, re.MULTILINE))}
+
+def compile_paper(paper_dir, output_dir, cmd, wall_limit=None):
+    """Compile one paper and return its result dict."""
+    result = {'paper': paper_dir.name}
+    start = time.monotonic()
+    try:
+        output = runner.run_latex(cmd, paper_dir, output_dir, wall_limit=wall_limit)
+    except Exception as e:
+        result['exit_code'] = None
+        result['exception'] = str(e)
+        return result
+    result['seconds'] = round(time.monotonic() - start, 2)
+    result['exit_code'] = output['exit_code']
+    result['latex_passes'] = output['latex_passes']
+    result['phases'] = output['phases']
+    if output['budget_exceeded']:
+        result['budget_exceeded'] = output['budget_exceeded']['budget']
+    logfile = Path(output_dir) / Path('main.log')
+    if logfile.is_file():
+        result.update(summarize_log(logfile.read_text(encoding='UTF-8', errors='replace')))
+    return result
+
+def compile_corpus(corpus_dir, output_root, cmd, workers, wall_limit=None):
+    """Compile every paper in corpus_dir. Outputs are left in
+    output_root/<paper>. Yields result dicts as papers finish."""
+    papers = sorted([p for p in Path(corpus_dir).iterdir() if Path(p, 'main.tex').is_file()])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(compile_paper, p, Path(output_root) / Path(p.name), cmd, wall_limit)
+                   for p in papers]
+        for future in as_completed(futures):
+            yield future.result()
+
+def read_results(filename):
+    """Read a JSONL file of results into a dict keyed by paper."""
+    results = {}
+    with open(filename, encoding='UTF-8') as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                results[result['paper']] = result
+    return results
+
+def diff_results(old, new):
+    """Compare two dicts from read_results.
+    returns: a dict with lists of papers that are missing from new, added in
+    new, and changed, where each item of changed is (paper, field, old, new).
+    It also has the ratio of total compile time of new to old for papers in both."""
+    diff = {'missing': sorted(set(old) - set(new)),
+            'added': sorted(set(new) - set(old)),
+            'changed': []}
+    old_time = 0
+    new_time = 0
+    for paper in sorted(set(old) & set(new)):
+        for field in COMPARED_FIELDS:
+            if old[paper].get(field) != new[paper].get(field):
+                diff['changed'].append((paper, field, old[paper].get(field), new[paper].get(field)))
+        old_time += old[paper].get('seconds') or 0
+        new_time += new[paper].get('seconds') or 0
+    diff['time_ratio'] = round(new_time / old_time, 3) if old_time else None
+    return diff
+
+def print_diff(diff):
+    for paper in diff['missing']:
+        print('missing: {}'.format(paper))
+    for paper in diff['added']:
+        print('added: {}'.format(paper))
+    if diff['changed']:
+        print('{:<30} {:<12} {:>10} {:>10}'.format('paper', 'field', 'old', 'new'))
+        for paper, field, old, new in diff['changed']:
+            print('{:<30} {:<12} {:>10} {:>10}'.format(paper, field, str(old), str(new)))
+    if diff['time_ratio'] is not None:
+        print('total compile time ratio (new/old): {:.3f}'.format(diff['time_ratio']))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Compile a corpus of papers and compare with a previous run')
+    argparser.add_argument('--corpus',
+                           help='directory with one subdirectory per paper')
+    argparser.add_argument('--results',
+                           default='results.jsonl',
+                           help='file to write results to')
+    argparser.add_argument('--compare',
+                           help='results of a previous run to compare with')
+    argparser.add_argument('--workers', type=int, default=2)
+    argparser.add_argument('--engine', choices=ENGINES.keys(), default='pdflatex')
+    argparser.add_argument('--wall_limit', type=int, default=None,
+                           help='seconds after which a compilation is killed')
+    argparser.add_argument('--output_dir', default=None,
+                           help='directory to keep outputs in. By default they are discarded.')
+    argparser.add_argument('--pool', action='store_true',
+                           help='lease containers from a pool of size workers')
+    argparser.add_argument('--font_cache', action='store_true',
+                           help='mount the shared font cache volume')
+    args = argparser.parse_args()
+    if not args.corpus:
+        if not args.compare:
+            argparser.error('--corpus or --compare is required')
+        # Only compare two existing sets of results.
+        print_diff(diff_results(read_results(args.compare), read_results(args.results)))
+        sys.exit(0)
+    if args.font_cache:
+        runner.configure_font_cache()
+    if args.pool:
+        runner.configure_pool(size=args.workers)
+    output_root = args.output_dir or tempfile.mkdtemp()
+    if Path(output_root).exists() and list(Path(output_root).iterdir()):
+        print('output_dir should be empty')
+        sys.exit(1)
+    count = 0
+    failed = 0
+    start = time.monotonic()
+    try:
+        with open(args.results, 'w', encoding='UTF-8') as f:
+            for result in compile_corpus(args.corpus, output_root, ENGINES[args.engine],
+                                         args.workers, args.wall_limit):
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                count += 1
+                if result.get('exit_code') != 0:
+                    failed += 1
+                print('{:>5} {:<30} exit_code={} seconds={}'.format(count,
+                                                                    result['paper'],
+                                                                    result.get('exit_code'),
+                                                                    result.get('seconds')))
+    finally:
+        if not args.output_dir:
+            shutil.rmtree(output_root, ignore_errors=True)
+    print('compiled {} papers in {:.1f} seconds, {} failed'.format(count, time.monotonic() - start, failed))
+    if args.compare:
+        print_diff(diff_results(read_results(args.compare), read_results(args.results)))
@@ -0,0 +1,115 @@
+"""
+Compare the in-process extraction of cited bibtex entries in
+metadata/bibextract.py with running bibexport and wideexport.bst, which
+is what the web server did before. Each subdirectory of the corpus with
+main.aux (or main.bcf) is extracted with both, and the entries are
+compared after parsing. bibexport is only run if it is installed, so
+without texlive this only times bibextract. bibextract is timed with
+and without indexes for the files in BIBINPUTS (see configure_index in
+bibextract.py). This does not need docker.
+
+Example:
+   python3 bibexport.py --corpus ../../../tests/testdata/bibtex --bibinputs ../../metadata/latex/iacrcc
+"""
+
+import argparse
+import os
+from pathlib import Path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+METADATA_DIR = Path(__file__).resolve().parent.parent.parent / Path('metadata')
+sys.path.insert(0, str(METADATA_DIR))
+
+import bibextract
+
+def run_bibexport(paper_dir, tmpdirpath):
+    """Run bibexport the way that extract_bibtex used to, on a copy of
+    paper_dir. returns the exported bibtex or None if it failed."""
+    work_dir = Path(tmpdirpath) / Path('work')
+    shutil.copytree(paper_dir, work_dir)
+    shutil.copy(METADATA_DIR / Path('wideexport.bst'), work_dir / Path('wideexport.bst'))
+    auxfilename = 'main.aux'
+    bcf_file = work_dir / Path('main.bcf')
+    if bcf_file.is_file():
+        citations, bibdata = bibextract.read_bcf(bcf_file)
+        auxfilename = 'bcf.aux'
+        lines = ['\\citation{' + key + '}' for key in citations]
+        lines.append('\\bibstyle{plain}')
+        lines.append('\\bibdata{' + ','.join([b[:-4] for b in bibdata]) + '}')
+        Path(work_dir, auxfilename).write_text('\n'.join(lines) + '\n', encoding='UTF-8')
+    outfile = Path(tmpdirpath) / Path('export.bib')
+    subprocess.run(['bibexport', '-b', 'wideexport', '-o', str(outfile), auxfilename],
+                   cwd=work_dir,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    shutil.rmtree(work_dir)
+    if not outfile.is_file():
+        return None
+    bibtex = outfile.read_text(encoding='UTF-8', errors='replace')
+    outfile.unlink()
+    return bibtex
+
+def parse_export(bibtex):
+    """returns {key: (entry_type, fields)} for exported bibtex."""
+    reader = bibextract.BibReader([], all_entries=True)
+    reader.read(bibtex)
+    return {key: (entry_type, fields) for entry_type, key, fields in reader.entries.values()}
+
+def best_time(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark bibextract against bibexport')
+    argparser.add_argument('--corpus', default=str(METADATA_DIR.parent.parent / Path('tests/testdata/bibtex')),
+                           help='directory with one subdirectory per paper')
+    argparser.add_argument('--bibinputs', default=None,
+                           help='BIBINPUTS for both, e.g. the directory with cryptobib')
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args()
+    if args.bibinputs:
+        os.environ['BIBINPUTS'] = '.:{}'.format(Path(args.bibinputs).resolve())
+    have_bibexport = shutil.which('bibexport') is not None
+    if not have_bibexport:
+        print('bibexport is not installed, so only bibextract is timed.')
+    print('{:<16} {:>8} {:>14} {:>11} {:>14} {:>6}'.format('paper', 'entries', 'bibextract ms',
+                                                             'indexed ms', 'bibexport ms', 'same'))
+    ratios = []
+    index_dir = tempfile.TemporaryDirectory()
+    for paper_dir in sorted(Path(args.corpus).iterdir()):
+        if not (paper_dir / Path('main.aux')).is_file():
+            continue
+        bibextract.configure_index(None)
+        elapsed, (bibtex, missing) = best_time(lambda: bibextract.extract(paper_dir), args.repeat)
+        entries = parse_export(bibtex)
+        # The first extraction builds the indexes.
+        bibextract.configure_index(index_dir.name)
+        bibextract.extract(paper_dir)
+        indexed_elapsed, _ = best_time(lambda: bibextract.extract(paper_dir), args.repeat)
+        export_ms = same = ''
+        if have_bibexport:
+            with tempfile.TemporaryDirectory() as tmpdirpath:
+                export_elapsed, exported = best_time(lambda: run_bibexport(paper_dir, tmpdirpath), args.repeat)
+            if exported is not None:
+                export_ms = '{:.1f}'.format(1000 * export_elapsed)
+                same = 'yes' if parse_export(exported) == entries else 'NO'
+                ratios.append(export_elapsed / elapsed)
+            else:
+                export_ms = 'failed'
+        print('{:<16} {:>8} {:>14.1f} {:>11.1f} {:>14} {:>6}'.format(paper_dir.name[:16], len(entries),
+                                                                     1000 * elapsed, 1000 * indexed_elapsed,
+                                                                     export_ms, same))
+        if missing:
+            print('    missing bibtex files:', ', '.join(missing))
+    index_dir.cleanup()
+    if ratios:
+        print('bibextract is {:.1f}x faster (median)'.format(statistics.median(ratios)))
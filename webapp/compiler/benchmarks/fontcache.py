@@ -0,0 +1,68 @@
+"""
+Compare lualatex compiles with and without the shared font cache volume
+(see fontcache.py). Without it, every container starts with an empty
+luaotfload cache. The volume is populated before the warm runs start,
+so the time to populate it is reported separately. Containers are not
+pooled, since a pooled container would keep its own cache between
+compiles and hide the difference.
+
+Example:
+   python3 fontcache.py --runs 5
+"""
+
+import argparse
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import runner
+
+cmd = 'latexmk -g -recorder -pdflua -lualatex="lualatex --disable-write18 --nosocket --no-shell-escape" main'
+
+PAPER = r'''\documentclass{article}
+\usepackage{fontspec}
+\setmainfont{TeX Gyre Termes}
+\setsansfont{TeX Gyre Heros}
+\begin{document}
+Hello \textsf{world}.
+\end{document}
+'''
+
+def compile_runs(input_dir, tmpdirpath, name, runs):
+    """returns a list of (seconds, latex phase seconds) for each run."""
+    times = []
+    for i in range(runs):
+        output_dir = Path(tmpdirpath) / Path('{}-{}'.format(name, i))
+        start = time.monotonic()
+        output = runner.run_latex(cmd, input_dir, output_dir)
+        elapsed = time.monotonic() - start
+        if output['exit_code'] != 0:
+            print(output['log'])
+            sys.exit(1)
+        times.append((elapsed, output['phases'].get('latex', 0)))
+    return times
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark lualatex with and without the font cache volume')
+    argparser.add_argument('--runs', type=int, default=3)
+    args = argparser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        input_dir = Path(tmpdirpath) / Path('input')
+        input_dir.mkdir()
+        Path(input_dir, 'main.tex').write_text(PAPER)
+        runner.configure_font_cache(False)
+        cold = compile_runs(input_dir, tmpdirpath, 'cold', args.runs)
+        runner.configure_font_cache(True)
+        start = time.monotonic()
+        runner._font_cache.ensure(runner.image_digest())
+        print('populating the volume took {:.1f} seconds'.format(time.monotonic() - start))
+        warm = compile_runs(input_dir, tmpdirpath, 'warm', args.runs)
+    print('{:>6} {:>12} {:>12}'.format('cache', 'median (s)', 'latex (s)'))
+    for name, times in [('cold', cold), ('warm', warm)]:
+        print('{:>6} {:>12.2f} {:>12.2f}'.format(name,
+                                                 statistics.median([t[0] for t in times]),
+                                                 statistics.median([t[1] for t in times])))
@@ -0,0 +1,81 @@
+"""
+Compare the cost of staging inputs and collecting outputs in run_latex
+for a paper with large figures. The old approach copied the input
+tree into the staging directory, walked it again to chmod and sanitize,
+then copied the staging directory to the output directory and removed
+it. The new approach links inputs in a single pass and moves the
+outputs. This does not run docker, since the compile itself is the
+same in both cases.
+
+Example:
+   python3 staging.py --figures 40 --figure_mb 10
+"""
+
+import argparse
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import runner
+
+def make_paper(input_dir, figures, figure_mb):
+    """Create a paper with main.tex and random figure files."""
+    input_dir.mkdir()
+    Path(input_dir, 'main.tex').write_text('\\documentclass{article}\\begin{document}x\\end{document}\n')
+    figdir = input_dir / Path('figures')
+    figdir.mkdir()
+    for i in range(figures):
+        Path(figdir, 'fig{}.pdf'.format(i)).write_bytes(os.urandom(figure_mb * 1024 * 1024))
+
+def tree_size(dirname):
+    return sum(p.stat().st_size for p in Path(dirname).rglob('*') if p.is_file())
+
+def old_staging(input_dir, staging_dir, output_dir):
+    """The approach used before, without the docker step. returns bytes copied."""
+    shutil.copytree(input_dir, staging_dir, symlinks=False)
+    for dirpath, dirnames, filenames in os.walk(staging_dir):
+        Path(dirpath).chmod(0o775)
+        for filename in filenames:
+            file_path = Path(os.path.join(dirpath, filename))
+            if file_path.name.endswith('.cls') or file_path.name.endswith('.bst'):
+                file_path.unlink()
+            else:
+                file_path.chmod(0o644)
+    copied = tree_size(staging_dir)
+    shutil.copytree(staging_dir, output_dir, symlinks=False)
+    copied += tree_size(output_dir)
+    shutil.rmtree(staging_dir)
+    return copied
+
+def new_staging(input_dir, staging_dir, output_dir):
+    """The approach in runner.py. returns bytes copied."""
+    warnings, stats = runner._stage_inputs(input_dir, staging_dir)
+    runner._move_outputs(staging_dir, output_dir)
+    shutil.rmtree(staging_dir)
+    return stats['bytes_copied']
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark staging of inputs for run_latex')
+    argparser.add_argument('--figures', type=int, default=20)
+    argparser.add_argument('--figure_mb', type=int, default=10)
+    argparser.add_argument('--tmpdir', default=None,
+                           help='directory to work in. Use the filesystem of DATA_DIR for realistic numbers.')
+    args = argparser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdirpath:
+        input_dir = Path(tmpdirpath) / Path('input')
+        make_paper(input_dir, args.figures, args.figure_mb)
+        print('input size: {:.1f} MB'.format(tree_size(input_dir) / 2**20))
+        print('{:>6} {:>12} {:>10}'.format('method', 'MB copied', 'seconds'))
+        for name, method in [('old', old_staging), ('new', new_staging)]:
+            staging_dir = Path(tmpdirpath) / Path('staging')
+            output_dir = Path(tmpdirpath) / Path('output-' + name)
+            os.sync()
+            start = time.monotonic()
+            copied = method(input_dir, staging_dir, output_dir)
+            elapsed = time.monotonic() - start
+            print('{:>6} {:>12.1f} {:>10.3f}'.format(name, copied / 2**20, elapsed))
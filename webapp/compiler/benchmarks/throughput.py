@@ -0,0 +1,73 @@
+"""
+Measure how compile throughput scales with the number of workers.
+This compiles every paper in a corpus directory (each subdirectory
+containing a main.tex) with 1, 2, ..., N concurrent compilations and
+reports papers per minute. Make sure the docker image is built first.
+
+Example:
+   python3 throughput.py --corpus ../../metadata/latex/iacrcc/tests --max_workers 4 --mem_limit 4g
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import runner
+
+cmd = 'latexmk -g -recorder -pdf -pdflatex="pdflatex -interaction=nonstopmode -disable-write18 -no-shell-escape" main'
+
+def compile_corpus(papers, workers):
+    """Compile all papers with the given number of concurrent workers.
+    returns: (elapsed seconds, number of failed compiles)"""
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        def compile_one(i):
+            output = runner.run_latex(cmd, papers[i], Path(tmpdirpath) / Path(str(i)))
+            return output.get('exit_code')
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            codes = list(executor.map(compile_one, range(len(papers))))
+        elapsed = time.monotonic() - start
+    return elapsed, len([c for c in codes if c != 0])
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark compile throughput against the number of workers')
+    argparser.add_argument('--corpus',
+                           required=True,
+                           help='directory with one subdirectory per paper')
+    argparser.add_argument('--max_workers', type=int, default=4)
+    argparser.add_argument('--repeat', type=int, default=1,
+                           help='number of times to compile each paper per run')
+    argparser.add_argument('--pool', action='store_true',
+                           help='lease containers from a pool of size max_workers')
+    argparser.add_argument('--cpu_shares', type=int, default=None)
+    argparser.add_argument('--cpusets', default=None,
+                           help='comma-separated list of cpusets, e.g., 0-1,2-3')
+    argparser.add_argument('--mem_limit', default=None)
+    argparser.add_argument('--pids_limit', type=int, default=None)
+    args = argparser.parse_args()
+    papers = sorted([p for p in Path(args.corpus).iterdir() if Path(p, 'main.tex').is_file()]) * args.repeat
+    if not papers:
+        print('no papers found in', args.corpus)
+        sys.exit(1)
+    runner.configure_limits(cpu_shares=args.cpu_shares,
+                            cpusets=args.cpusets.split(',') if args.cpusets else None,
+                            mem_limit=args.mem_limit,
+                            pids_limit=args.pids_limit)
+    if args.pool:
+        runner.configure_pool(size=args.max_workers)
+    print('{:>8} {:>10} {:>12} {:>8} {:>8}'.format('workers', 'seconds', 'papers/min', 'speedup', 'failed'))
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        elapsed, failed = compile_corpus(papers, workers)
+        if baseline is None:
+            baseline = elapsed
+        print('{:>8} {:>10.1f} {:>12.1f} {:>8.2f} {:>8}'.format(workers,
+                                                                elapsed,
+                                                                60 * len(papers) / elapsed,
+                                                                baseline / elapsed,
+                                                                failed))
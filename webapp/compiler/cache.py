@@ -0,0 +1,177 @@
+"""
+A content-addressed cache of compilation results. Authors often upload
+the same zip file twice, and admins may recompile identical inputs, so
+the output directory and a JSON payload of parsed results are stored
+under a key derived from the inputs (see runner.input_digest). The cache
+is bounded in size, and the least recently used entries are evicted.
+
+The cache directory may be shared by several processes, so updates to
+the hit/miss counters and eviction are done under a file lock. Reading
+an entry holds the same lock shared, so that an entry cannot be evicted
+while it is being copied.
+
+Entries are copied in and out rather than hardlinked, because a hardlink
+would let a later write to the output of one paper change the entry for
+every other paper. On btrfs or xfs the copies are reflinks, so they share
+blocks without sharing the file.
+
+Like runner.py, this does not depend on flask.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+import random
+import shutil
+import string
+
+# ioctl to share the blocks of a file on btrfs or xfs (a reflink).
+_FICLONE = 0x40049409
+
+class CompileCache:
+    """args:
+       cache_dir: directory to hold the cache. It is created if necessary.
+       max_bytes: approximate bound on the size of the cache.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.entries_dir = self.cache_dir / Path('entries')
+        self.entries_dir.mkdir(parents=True, exist_ok=True)
+        self.stats_file = self.cache_dir / Path('stats.json')
+        self.lock_file = self.cache_dir / Path('lock')
+
+    @contextmanager
+    def _locked(self, shared=False):
+        """This is not reentrant, since flock on a second descriptor for
+        the same file would wait for the first."""
+        with open(self.lock_file, 'a') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def _count(self, name):
+        with self._locked():
+            counts = self._read_counts()
+            counts[name] = counts.get(name, 0) + 1
+            self.stats_file.write_text(json.dumps(counts))
+
+    def _read_counts(self):
+        try:
+            return json.loads(self.stats_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key, output_dir):
+        """If key is in the cache, then populate output_dir (which should not
+        exist) with the cached output and return the payload dict.
+        Otherwise return None."""
+        if Path(output_dir).exists():
+            return None
+        entry_dir = self.entries_dir / Path(key)
+        payload_file = entry_dir / Path('payload.json')
+        try:
+            with self._locked(shared=True):
+                payload = json.loads(payload_file.read_text(encoding='UTF-8'))
+                _copy_tree(entry_dir / Path('output'), Path(output_dir))
+                # The mtime of payload.json records when it was last used.
+                os.utime(payload_file)
+        except (OSError, ValueError):
+            if Path(output_dir).is_dir():
+                shutil.rmtree(output_dir)
+            self._count('misses')
+            return None
+        self._count('hits')
+        return payload['data']
+
+    def put(self, key, output_dir, data):
+        """Store a copy of output_dir and the JSON-serializable data under
+        key, then evict old entries until the cache is under max_bytes."""
+        entry_dir = self.entries_dir / Path(key)
+        if entry_dir.is_dir():
+            return
+        tmpname = 'tmp-' + ''.join(random.choice(string.ascii_lowercase) for n in range(12))
+        tmp_dir = self.cache_dir / Path(tmpname)
+        try:
+            size = _copy_tree(Path(output_dir), tmp_dir / Path('output'))
+            payload = {'size': size, 'data': data}
+            Path(tmp_dir, 'payload.json').write_text(json.dumps(payload), encoding='UTF-8')
+            # The rename makes the entry visible atomically.
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            logging.warning('unable to store cache entry {}: {}'.format(key, str(e)))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def _entries(self):
+        """returns a list of (last_used, size, entry_dir)."""
+        entries = []
+        for entry in os.scandir(self.entries_dir):
+            payload_file = Path(entry.path, 'payload.json')
+            try:
+                last_used = payload_file.stat().st_mtime
+                size = json.loads(payload_file.read_text(encoding='UTF-8'))['size']
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((last_used, size, Path(entry.path)))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the total size is at most max_bytes."""
+        with self._locked():
+            entries = sorted(self._entries(), key=lambda e: e[0])
+            total = sum([e[1] for e in entries])
+            evicted = 0
+            while entries and total > self.max_bytes:
+                last_used, size, entry_dir = entries.pop(0)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                evicted += 1
+            if evicted:
+                counts = self._read_counts()
+                counts['evictions'] = counts.get('evictions', 0) + evicted
+                self.stats_file.write_text(json.dumps(counts))
+
+    def stats(self):
+        """returns a dict with hits, misses, evictions, entries, and bytes."""
+        counts = self._read_counts()
+        entries = self._entries()
+        return {'hits': counts.get('hits', 0),
+                'misses': counts.get('misses', 0),
+                'evictions': counts.get('evictions', 0),
+                'entries': len(entries),
+                'bytes': sum([e[1] for e in entries]),
+                'max_bytes': self.max_bytes}
+
+def _copy_file(src, dst):
+    """Copy src to dst as a reflink where possible. Unlike a hardlink, dst
+    is a separate file."""
+    try:
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+    except OSError:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+def _copy_tree(src_dir, dst_dir):
+    """Recreate src_dir as dst_dir with copies of its files.
+    returns the total size of files."""
+    size = 0
+    dst_dir.mkdir(parents=True)
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            dst = dst_dir / Path(entry.name)
+            if entry.is_dir():
+                size += _copy_tree(Path(entry.path), dst)
+            elif entry.is_file():
+                _copy_file(entry.path, dst)
+                size += entry.stat().st_size
+    return size
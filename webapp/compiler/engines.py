@@ -0,0 +1,11 @@
+"""
+The latexmk command for each engine that authors may choose. These are
+used by the web server (routes.py) and by batch.py, so that a batch run
+compiles papers the same way that the server does.
+
+Like runner.py, this does not depend on flask.
+"""
+
+ENGINES = {'lualatex': 'latexmk -g -recorder -pdflua -lualatex="lualatex --disable-write18 --nosocket --no-shell-escape" main',
+           'pdflatex': 'latexmk -g -recorder -pdf -pdflatex="pdflatex -interaction=nonstopmode -disable-write18 -no-shell-escape" main',
+           'xelatex': 'latexmk -g -recorder -pdfxe -xelatex="xelatex -interaction=nonstopmode -file-line-error -no-shell-escape" main'}
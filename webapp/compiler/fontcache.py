@@ -0,0 +1,154 @@
+"""
+A docker volume with font and format caches that is shared by compile
+containers. Without it, the first lualatex run in every container
+rebuilds the luaotfload font name database, which takes tens of
+seconds, and fontconfig rescans the fonts.
+
+The volume is populated once per texlive image, since the caches
+depend on the fonts and formats in the image. It holds a copy of the
+image's TEXMFSYSVAR (which has the formats) together with the
+luaotfload and fontconfig caches, and compile containers mount it read
+only with TEXMFSYSVAR pointing at it. TEXMFVAR stays inside the
+container, so anything that a compilation writes is discarded with the
+container and concurrent compilations cannot interfere with each other.
+
+Like runner.py, this does not depend on flask.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import logging
+from pathlib import Path
+import threading
+import time
+
+from docker.errors import APIError, ContainerError, NotFound
+from docker.types import Mount
+
+MOUNT_POINT = '/texcache'
+# Volumes are labeled so that those for old images can be removed.
+LABEL = 'org.iacr.latex-submit.texcache'
+# Seconds before trying again after a failure to populate the volume.
+RETRY_INTERVAL = 600
+
+POPULATE_SCRIPT = '''set -e
+sysvar=$(kpsewhich -var-value TEXMFSYSVAR)
+mkdir -p {mount}/texmf-var {mount}/xdg
+cp -a "$sysvar/." {mount}/texmf-var/
+export TEXMFSYSVAR={mount}/texmf-var TEXMFVAR={mount}/texmf-var XDG_CACHE_HOME={mount}/xdg
+luaotfload-tool --update --force
+fc-cache
+chmod -R a+rX {mount}
+touch {mount}/complete
+'''.format(mount=MOUNT_POINT)
+
+def volume_name(digest):
+    """The name of the volume for an image with the given id."""
+    return 'latex-submit-texcache-' + digest.split(':')[-1][:16]
+
+class FontCache:
+    """args:
+       client: a docker client.
+       image: the docker image to run.
+       lock_dir: host directory for a lock file, so that only one process
+          populates the volume.
+    """
+    def __init__(self, client, image, lock_dir):
+        self.client = client
+        self.image = image
+        self.lock_file = Path(lock_dir) / Path('texcache.lock')
+        self._lock = threading.Lock()
+        self._ready = set()
+        self._failed = {}
+
+    @contextmanager
+    def _locked(self):
+        self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.lock_file, 'a') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def _run(self, name, command, read_only, user=None):
+        """Run command in a throwaway container with the volume mounted.
+        raises ContainerError if the command fails."""
+        mount = Mount(MOUNT_POINT, name, type='volume', read_only=read_only)
+        kwargs = {'user': user} if user else {}
+        self.client.containers.run(self.image,
+                                   entrypoint=['/bin/bash', '-c', command],
+                                   network_disabled=True,
+                                   mounts=[mount],
+                                   remove=True,
+                                   **kwargs)
+
+    def _is_complete(self, name):
+        try:
+            self.client.volumes.get(name)
+        except NotFound:
+            return False
+        try:
+            self._run(name, 'test -f {}/complete'.format(MOUNT_POINT), True)
+            return True
+        except ContainerError:
+            return False
+
+    def _populate(self, name, digest):
+        logging.info('populating font cache volume ' + name)
+        start = time.monotonic()
+        try:
+            self.client.volumes.get(name).remove(force=True)
+        except NotFound:
+            pass
+        self.client.volumes.create(name, labels={LABEL: digest})
+        # The volume is owned by root when it is created, and the caches
+        # should be built by the same user that runs compilations.
+        self._run(name, 'chown texlive {}'.format(MOUNT_POINT), False, user='root')
+        self._run(name, POPULATE_SCRIPT, False)
+        logging.info('populated {} in {:.1f} seconds'.format(name, time.monotonic() - start))
+
+    def ensure(self, digest):
+        """Make sure the volume for the image with id digest is populated.
+        This blocks while it is populated, which may take a minute or two.
+        returns: the volume name, or None if it could not be populated."""
+        name = volume_name(digest)
+        if name in self._ready:
+            return name
+        if time.monotonic() - self._failed.get(name, -RETRY_INTERVAL) < RETRY_INTERVAL:
+            return None
+        with self._locked():
+            if name in self._ready:
+                return name
+            try:
+                if not self._is_complete(name):
+                    self._populate(name, digest)
+                self._ready.add(name)
+            except (APIError, ContainerError) as e:
+                logging.error('unable to populate font cache {}: {}'.format(name, str(e)))
+                self._failed[name] = time.monotonic()
+                return None
+        self.prune(keep=name)
+        return name
+
+    def container_args(self, digest):
+        """kwargs for client.containers.run that mount the cache. If it is
+        unavailable, then this is empty and containers use their own caches."""
+        name = self.ensure(digest)
+        if name is None:
+            return {}
+        return {'mounts': [Mount(MOUNT_POINT, name, type='volume', read_only=True)],
+                'environment': {'TEXMFSYSVAR': MOUNT_POINT + '/texmf-var',
+                                'XDG_CACHE_HOME': MOUNT_POINT + '/xdg'}}
+
+    def prune(self, keep):
+        """Remove cache volumes for other images. Volumes that are still
+        mounted by a container are left for next time."""
+        for volume in self.client.volumes.list(filters={'label': LABEL}):
+            if volume.name == keep:
+                continue
+            try:
+                volume.remove()
+                logging.info('removed font cache volume ' + volume.name)
+            except APIError as e:
+                pass
@@ -0,0 +1,384 @@
+"""
+A pool of pre-started docker containers that run_latex can lease
+instead of starting a fresh container for every compilation. Starting
+and stopping a debian-slim-texlive container takes longer than many
+short compiles, so the web server keeps a few of them warm.
+
+Docker cannot change the mounts of a running container, so every
+pooled container is created with its own slot directory on the host
+that is bind-mounted as /data. The slot directory is the staging
+directory for whoever holds the lease, and it is scrubbed before the
+container is handed to the next lease. Containers are retired after
+max_uses leases, when they have been idle for idle_timeout seconds,
+when they fail a health check, when a lease ends with an exception,
+or when the holder of the lease sets discard.
+
+Pooled containers run with a read-only root filesystem, so a
+compilation can only write to /data and /tmp, and both are emptied
+between leases. Nothing that one author's compilation writes under
+$HOME (such as TEXMFVAR) can change the next author's output.
+
+Pooled containers outlive the image's 500 second entrypoint, so they
+are labeled with the process that owns them. A process that dies
+without closing its pool leaves them behind, and they are removed with
+their slot directories when the next pool is created on the host.
+
+Like runner.py, this does not depend on flask.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+from pathlib import Path
+import random
+import shutil
+import socket
+import string
+import threading
+import time
+import uuid
+
+import docker
+from docker.errors import APIError, NotFound
+from docker.types import Mount
+
+DEFAULT_IMAGE = 'debian-slim-texlive'
+
+# The image has an entrypoint that kills the container after 500
+# seconds. Pooled containers live longer than that, so they get their
+# own entrypoint and each command is run under timeout instead.
+EXEC_TIMEOUT = 500
+
+# Containers are labeled with POOL_LABEL=host:pid:token of the process
+# that owns them, and SLOT_LABEL=their slot directory. The token tells a
+# process apart from an earlier one with the same pid, as happens when
+# the web server runs as pid 1 in a container.
+POOL_LABEL = 'latex-submit-pool'
+SLOT_LABEL = 'latex-submit-pool.slot'
+_owner_token = uuid.uuid4().hex[:12]
+
+# Slot directories without a container are only removed when they are
+# this old, since a pool may be about to start a container with them.
+ORPHAN_SLOT_SECONDS = 3600
+
+# /tmp is the only writable place in a pooled container besides /data.
+TMPFS_OPTIONS = 'rw,exec,nosuid,nodev,size=1g,mode=1777'
+
+def _owner():
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), _owner_token)
+
+def _owner_is_alive(owner):
+    """returns False if owner is a process on this host that has exited."""
+    parts = owner.split(':')
+    if len(parts) != 3 or parts[0] != socket.gethostname():
+        return True # it may be another host that uses the same docker.
+    try:
+        pid = int(parts[1])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return parts[2] == _owner_token
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class PooledContainer:
+    """A container together with the host directory mounted as /data."""
+    def __init__(self, container, slot_dir):
+        self.container = container
+        self.slot_dir = slot_dir
+        self.uses = 0
+        self.last_used = time.monotonic()
+        # Set by the holder of the lease if the container should not be reused.
+        self.discard = False
+
+    def timed(self, cmd):
+        """Return cmd wrapped so that it runs for at most EXEC_TIMEOUT seconds."""
+        return 'timeout {} {}'.format(EXEC_TIMEOUT, cmd)
+
+    def exec_run(self, cmd):
+        """Run cmd in /data of the container, subject to EXEC_TIMEOUT."""
+        return self.container.exec_run(self.timed(cmd), workdir='/data')
+
+class ContainerPool:
+    """Leases warm containers to callers. This is thread-safe, since the
+    compile executor may run several compilations at once.
+
+    args:
+       size: maximum number of containers in the pool.
+       max_uses: number of leases before a container is retired.
+       idle_timeout: seconds that a container may sit idle before it is reaped.
+       staging_root: directory where slot directories are created.
+       image: the docker image to run.
+       client: a docker client. If None then docker.from_env() is used.
+       container_args: a function returning extra kwargs for client.containers.run,
+          such as resource limits. It is called for each new container. Any
+          mounts it returns are added to the mount of the slot directory.
+    """
+    def __init__(self, size=2, max_uses=50, idle_timeout=600,
+                 staging_root=None, image=DEFAULT_IMAGE, client=None,
+                 container_args=None):
+        if size < 1:
+            raise ValueError('pool size must be positive')
+        self.size = size
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        if staging_root is None:
+            staging_root = Path(os.path.dirname(os.path.abspath(__file__))) / Path('staging')
+        self.staging_root = Path(staging_root)
+        self.image = image
+        self.client = client or docker.from_env()
+        self.container_args = container_args
+        self._cond = threading.Condition()
+        self._idle = []      # PooledContainer objects available for lease.
+        self._live = 0       # containers that exist or are being started.
+        self._closed = False
+        self._metrics = {'leases': 0,
+                         'reused_leases': 0,
+                         'containers_started': 0,
+                         'containers_retired': 0,
+                         'health_check_failures': 0,
+                         'scrub_failures': 0,
+                         'total_wait': 0.0,
+                         'max_wait': 0.0}
+        try:
+            self.remove_orphans()
+        except Exception as e:
+            logging.warning('unable to remove orphaned containers: ' + str(e))
+        self._reaper = threading.Thread(target=self._reap_loop,
+                                        name='container-reaper',
+                                        daemon=True)
+        self._reaper.start()
+
+    def _start_container(self):
+        """Create a slot directory and start a container with it mounted as /data."""
+        slotname = 'pool-' + ''.join(random.choice(string.ascii_lowercase) for n in range(12))
+        slot_dir = self.staging_root / Path(slotname)
+        slot_dir.mkdir(parents=True)
+        # The texlive user in the container is in the same group as us.
+        slot_dir.chmod(0o775)
+        try:
+            mount = Mount('/data', str(slot_dir.absolute()), type='bind')
+            extra_args = self.container_args() if self.container_args else {}
+            mounts = [mount] + extra_args.pop('mounts', [])
+            # TEXMFVAR is normally under $HOME, which is read-only here.
+            environment = {'TEXMFVAR': '/tmp/texmf-var'}
+            environment.update(extra_args.pop('environment', {}))
+            container = self.client.containers.run(self.image,
+                                                   entrypoint=['tail', '-f', '/dev/null'],
+                                                   detach=True,
+                                                   network_disabled=True,
+                                                   mounts=mounts,
+                                                   read_only=True,
+                                                   tmpfs={'/tmp': TMPFS_OPTIONS},
+                                                   environment=environment,
+                                                   labels={POOL_LABEL: _owner(),
+                                                           SLOT_LABEL: str(slot_dir.absolute())},
+                                                   **extra_args)
+        except Exception as e:
+            shutil.rmtree(slot_dir, ignore_errors=True)
+            raise e
+        with self._cond:
+            self._metrics['containers_started'] += 1
+        return PooledContainer(container, slot_dir)
+
+    def remove_orphans(self):
+        """Remove the containers of processes on this host that exited
+        without closing their pool, and slot directories that no container
+        uses. returns the number of containers removed."""
+        staging_root = self.staging_root.absolute()
+        used = set()
+        removed = 0
+        for container in self.client.containers.list(all=True, filters={'label': POOL_LABEL}):
+            slot = container.labels.get(SLOT_LABEL)
+            if _owner_is_alive(container.labels.get(POOL_LABEL, '')):
+                if slot:
+                    used.add(slot)
+                continue
+            logging.info('removing orphaned container {}'.format(container.short_id))
+            try:
+                container.remove(force=True)
+                removed += 1
+            except (APIError, NotFound) as e:
+                logging.warning('unable to remove container {}: {}'.format(container.short_id, str(e)))
+                if slot:
+                    used.add(slot)
+                continue
+            if slot and Path(slot).parent == staging_root:
+                shutil.rmtree(slot, ignore_errors=True)
+        if staging_root.is_dir():
+            cutoff = time.time() - ORPHAN_SLOT_SECONDS
+            for slot_dir in staging_root.glob('pool-*'):
+                try:
+                    if str(slot_dir) not in used and slot_dir.stat().st_mtime < cutoff:
+                        shutil.rmtree(slot_dir, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def _is_healthy(self, pc):
+        """Check that the container is still running and can execute a command."""
+        try:
+            pc.container.reload()
+            if pc.container.status != 'running':
+                return False
+            code, _ = pc.container.exec_run('true')
+            return code == 0
+        except (APIError, NotFound) as e:
+            logging.warning('health check failed for {}: {}'.format(pc.container.short_id, str(e)))
+            return False
+
+    def _scrub(self, pc):
+        """Remove everything the last lease left behind, both in /data and /tmp.
+        These are the only places that a compilation can write to.
+        Returns False if the container should not be used again."""
+        try:
+            for entry in os.scandir(pc.slot_dir):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+            code, _ = pc.container.exec_run(['find', '/tmp', '-mindepth', '1', '-delete'])
+            return code == 0
+        except Exception as e:
+            logging.warning('unable to scrub {}: {}'.format(str(pc.slot_dir), str(e)))
+            return False
+
+    def _retire(self, pc):
+        """Remove the container and its slot directory."""
+        try:
+            pc.container.remove(force=True)
+        except Exception as e:
+            logging.warning('unable to remove container: ' + str(e))
+        shutil.rmtree(pc.slot_dir, ignore_errors=True)
+        with self._cond:
+            self._live -= 1
+            self._metrics['containers_retired'] += 1
+            self._cond.notify()
+
+    def _acquire(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._live >= self.size and not self._closed:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError('no container available after {} seconds'.format(timeout))
+                    self._cond.wait(remaining)
+                if self._closed:
+                    raise RuntimeError('container pool is closed')
+                if self._idle:
+                    pc = self._idle.pop()
+                else:
+                    pc = None
+                    self._live += 1
+            if pc is None:
+                try:
+                    return self._start_container()
+                except Exception as e:
+                    with self._cond:
+                        self._live -= 1
+                        self._cond.notify()
+                    raise e
+            if self._is_healthy(pc):
+                return pc
+            with self._cond:
+                self._metrics['health_check_failures'] += 1
+            self._retire(pc)
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """Context manager that yields a PooledContainer with an empty
+        slot_dir. The slot directory is scrubbed when the lease ends.
+        raises TimeoutError if no container becomes available in time."""
+        start = time.monotonic()
+        pc = self._acquire(timeout)
+        wait = time.monotonic() - start
+        with self._cond:
+            self._metrics['leases'] += 1
+            if pc.uses > 0:
+                self._metrics['reused_leases'] += 1
+            self._metrics['total_wait'] += wait
+            self._metrics['max_wait'] = max(self._metrics['max_wait'], wait)
+        pc.uses += 1
+        reusable = False
+        try:
+            yield pc
+            reusable = True
+        finally:
+            pc.last_used = time.monotonic()
+            self._release(pc, reusable)
+
+    def _release(self, pc, reusable):
+        if reusable and not pc.discard and pc.uses < self.max_uses and not self._closed:
+            if self._scrub(pc):
+                with self._cond:
+                    self._idle.append(pc)
+                    self._cond.notify()
+                return
+            with self._cond:
+                self._metrics['scrub_failures'] += 1
+        self._retire(pc)
+
+    def warm(self):
+        """Start containers until the pool is full. Errors are logged, since
+        this is usually called in the background at startup."""
+        while True:
+            with self._cond:
+                if self._closed or self._live >= self.size:
+                    return
+                self._live += 1
+            try:
+                pc = self._start_container()
+            except Exception as e:
+                logging.error('unable to start pooled container: ' + str(e))
+                with self._cond:
+                    self._live -= 1
+                    self._cond.notify()
+                return
+            with self._cond:
+                self._idle.append(pc)
+                self._cond.notify()
+
+    def _reap_loop(self):
+        interval = max(1, min(self.idle_timeout, 30))
+        while not self._closed:
+            time.sleep(interval)
+            self.reap()
+
+    def reap(self):
+        """Retire containers that have been idle longer than idle_timeout."""
+        now = time.monotonic()
+        with self._cond:
+            expired = [pc for pc in self._idle if now - pc.last_used > self.idle_timeout]
+            self._idle = [pc for pc in self._idle if pc not in expired]
+        for pc in expired:
+            self._retire(pc)
+
+    def stats(self):
+        """Return a dict of metrics about lease wait times and reuse."""
+        with self._cond:
+            stats = dict(self._metrics)
+            stats['size'] = self.size
+            stats['live'] = self._live
+            stats['idle'] = len(self._idle)
+        if stats['leases']:
+            stats['avg_wait'] = stats['total_wait'] / stats['leases']
+        else:
+            stats['avg_wait'] = 0.0
+        return stats
+
+    def close(self):
+        """Retire all idle containers and refuse further leases. Containers
+        that are leased out are retired when their lease ends."""
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._cond.notify_all()
+        for pc in idle:
+            self._retire(pc)
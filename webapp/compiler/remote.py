@@ -0,0 +1,339 @@
+"""
+Run compilations on other hosts, when the docker daemon of one host is
+not enough. A compile worker service runs on each host:
+
+   python3 remote.py --port 8700 --capacity 2 --token SECRET \
+        --url http://thishost:8700 --register https://publish.example.org/compiler/register
+
+It announces itself to the web server every REGISTER_INTERVAL seconds
+with its capacity and the number of compilations it is running. The web
+server keeps the workers it heard from recently, and sends each
+compilation to the one with the lowest load.
+
+The protocol is plain HTTP with the shared token as a bearer token:
+
+   POST /compile   The body is a zip of the input directory, and the
+                   X-Compile-Request header is JSON with cmd, and
+                   optionally wall_limit and cpu_limit. The response is a
+                   gzipped tar with result.json (the dict returned by
+                   runner.run_latex) and the output directory under
+                   output/. It returns 503 when the worker is full.
+   GET /status     JSON with capacity and active.
+
+The service takes the compile function as an argument, so it can be
+tested with a stand-in that does not need docker.
+"""
+
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import hmac
+import io
+import json
+import logging
+from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+import requests
+try:
+    from .tracing import annotate
+except ImportError:
+    from tracing import annotate
+
+REGISTER_INTERVAL = 20
+# Workers that have not registered for this long are not used.
+WORKER_TIMEOUT = 3 * REGISTER_INTERVAL
+# Seconds that a worker is skipped after a request to it failed.
+FAILURE_BACKOFF = 60
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024
+
+class RemoteError(Exception):
+    """A compilation could not be run on any remote worker."""
+
+def zip_dir(input_dir) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for path in sorted(Path(input_dir).rglob('*')):
+            if path.is_file():
+                zf.write(path, str(path.relative_to(input_dir)))
+    return buf.getvalue()
+
+def _safe_extract_zip(data, target_dir):
+    target_dir = Path(target_dir).resolve()
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for name in zf.namelist():
+            if not (target_dir / name).resolve().is_relative_to(target_dir):
+                raise ValueError('unsafe path in zip: ' + name)
+        zf.extractall(target_dir)
+
+def tar_result(result, output_dir) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        data = json.dumps(result).encode('UTF-8')
+        info = tarfile.TarInfo('result.json')
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+        if Path(output_dir).is_dir():
+            tf.add(str(output_dir), arcname='output')
+    return buf.getvalue()
+
+def untar_result(data, output_dir) -> dict:
+    """Extract the output of a remote compilation into output_dir, and
+    return the result dict."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    result = None
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tf:
+        for member in tf.getmembers():
+            if member.name == 'result.json':
+                result = json.loads(tf.extractfile(member).read().decode('UTF-8'))
+            elif member.name.startswith('output/') and (member.isfile() or member.isdir()):
+                target = (output_dir / member.name[len('output/'):]).resolve()
+                if not target.is_relative_to(output_dir.resolve()):
+                    raise ValueError('unsafe path in tar: ' + member.name)
+                if member.isdir():
+                    target.mkdir(parents=True, exist_ok=True)
+                else:
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    with tf.extractfile(member) as src, target.open('wb') as dst:
+                        shutil.copyfileobj(src, dst)
+    if result is None:
+        raise ValueError('no result.json in response')
+    return result
+
+class WorkerService:
+    """The HTTP service on a compile host. compile_fn is called as
+    compile_fn(cmd, input_dir, output_dir, wall_limit=, cpu_limit=) and
+    returns the dict from runner.run_latex."""
+    def __init__(self, compile_fn, capacity, token, host='0.0.0.0', port=8700):
+        self.compile_fn = compile_fn
+        self.capacity = capacity
+        self.token = token
+        self.active = 0
+        self._lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logging.info('remote worker: ' + format % args)
+
+            def _reply(self, code, body, content_type='application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _authorized(self):
+                if hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + service.token):
+                    return True
+                self._reply(403, b'{"error": "forbidden"}')
+                return False
+
+            def do_GET(self):
+                if not self._authorized():
+                    return
+                if self.path != '/status':
+                    return self._reply(404, b'{"error": "not found"}')
+                self._reply(200, json.dumps(service.status()).encode('UTF-8'))
+
+            def do_POST(self):
+                if not self._authorized():
+                    return
+                if self.path != '/compile':
+                    return self._reply(404, b'{"error": "not found"}')
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    request = json.loads(self.headers.get('X-Compile-Request', '{}'))
+                    cmd = request['cmd']
+                except (ValueError, KeyError):
+                    return self._reply(400, b'{"error": "bad request"}')
+                if length > MAX_UPLOAD_BYTES:
+                    return self._reply(413, b'{"error": "too large"}')
+                body = self.rfile.read(length)
+                if not service._acquire():
+                    return self._reply(503, b'{"error": "busy"}')
+                try:
+                    data = service.compile(body, cmd, request.get('wall_limit'), request.get('cpu_limit'))
+                except Exception as e:
+                    logging.error('remote compile failed: ' + str(e))
+                    return self._reply(500, json.dumps({'error': str(e)}).encode('UTF-8'))
+                finally:
+                    service._release()
+                self._reply(200, data, 'application/gzip')
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def status(self):
+        with self._lock:
+            return {'capacity': self.capacity, 'active': self.active}
+
+    def _acquire(self):
+        with self._lock:
+            if self.active >= self.capacity:
+                return False
+            self.active += 1
+            return True
+
+    def _release(self):
+        with self._lock:
+            self.active -= 1
+
+    def compile(self, body, cmd, wall_limit, cpu_limit) -> bytes:
+        with tempfile.TemporaryDirectory() as tmpdirpath:
+            input_dir = Path(tmpdirpath) / Path('input')
+            output_dir = Path(tmpdirpath) / Path('output')
+            input_dir.mkdir()
+            _safe_extract_zip(body, input_dir)
+            result = self.compile_fn(cmd, input_dir, output_dir, wall_limit=wall_limit, cpu_limit=cpu_limit)
+            return tar_result(result, output_dir)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def register_loop(service, register_url, own_url, token, stop):
+    """Announce the service to the web server until stop is set."""
+    while not stop.is_set():
+        try:
+            requests.post(register_url,
+                          json=dict(service.status(), url=own_url),
+                          headers={'Authorization': 'Bearer ' + token},
+                          timeout=10).raise_for_status()
+        except Exception as e:
+            logging.warning('unable to register with {}: {}'.format(register_url, str(e)))
+        stop.wait(REGISTER_INTERVAL)
+
+class Dispatcher:
+    """Sends compilations to remote workers. Workers are dicts with url,
+    capacity, and active, as they were last registered. The load of a
+    worker also counts the compilations that this process sent to it."""
+    def __init__(self, token, attempts=3, timeout=900):
+        self.token = token
+        self.attempts = attempts
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._failed = {}
+
+    def choose(self, workers, exclude=()):
+        """returns the worker with the lowest load, or None."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [w for w in workers
+                          if w['url'] not in exclude and
+                          now - self._failed.get(w['url'], -FAILURE_BACKOFF) >= FAILURE_BACKOFF and
+                          w['capacity'] > 0]
+            if not candidates:
+                return None
+            return min(candidates,
+                       key=lambda w: ((w['active'] + self._inflight.get(w['url'], 0)) / w['capacity'], w['url']))
+
+    def run_latex(self, workers, cmd, input_dir, output_dir, wall_limit=None, cpu_limit=None):
+        """Compile input_dir on a remote worker, and put the output in
+        output_dir. A worker that is full or fails is retried with another.
+        returns the dict from runner.run_latex on the worker.
+        raises RemoteError if no worker could run it."""
+        body = zip_dir(input_dir)
+        header = json.dumps({'cmd': cmd, 'wall_limit': wall_limit, 'cpu_limit': cpu_limit})
+        tried = set()
+        errors = []
+        for attempt in range(self.attempts):
+            worker = self.choose(workers, tried)
+            if worker is None:
+                break
+            url = worker['url']
+            tried.add(url)
+            annotate(url=url, attempts=attempt + 1)
+            with self._lock:
+                self._inflight[url] = self._inflight.get(url, 0) + 1
+            try:
+                response = requests.post(url.rstrip('/') + '/compile',
+                                         data=body,
+                                         headers={'Authorization': 'Bearer ' + self.token,
+                                                  'X-Compile-Request': header,
+                                                  'Content-Type': 'application/zip'},
+                                         timeout=self.timeout)
+                if response.status_code == 503:
+                    errors.append('{} is busy'.format(url))
+                    continue
+                response.raise_for_status()
+                shutil.rmtree(output_dir, ignore_errors=True)
+                return untar_result(response.content, output_dir)
+            except Exception as e:
+                logging.warning('remote compile on {} failed: {}'.format(url, str(e)))
+                errors.append('{}: {}'.format(url, str(e)))
+                with self._lock:
+                    self._failed[url] = time.monotonic()
+            finally:
+                with self._lock:
+                    self._inflight[url] -= 1
+        raise RemoteError('no remote worker could compile: ' + '; '.join(errors or ['no workers']))
+
+if __name__ == '__main__':
+    try:
+        from . import runner
+    except ImportError:
+        import runner
+    argparser = argparse.ArgumentParser(description='Run compilations for a remote web server')
+    argparser.add_argument('--port', type=int, default=8700)
+    argparser.add_argument('--capacity', type=int, default=2,
+                           help='number of compilations at the same time')
+    argparser.add_argument('--token', required=True,
+                           help='shared secret, the same as COMPILER_REMOTE_TOKEN on the web server')
+    argparser.add_argument('--url',
+                           help='url at which the web server reaches this worker')
+    argparser.add_argument('--register',
+                           help='url of /compiler/register on the web server')
+    argparser.add_argument('--pool', action='store_true',
+                           help='lease containers from a pool of size capacity')
+    argparser.add_argument('--pool_max_uses', type=int, default=50,
+                           help='compilations before a pooled container is replaced, as COMPILER_POOL_MAX_USES')
+    argparser.add_argument('--pool_idle_timeout', type=int, default=600,
+                           help='seconds that a pooled container may be idle, as COMPILER_POOL_IDLE_TIMEOUT')
+    argparser.add_argument('--font_cache', action='store_true',
+                           help='mount the shared font cache volume')
+    # The same limits on containers as on the web server.
+    argparser.add_argument('--cpu_shares', type=int, default=None,
+                           help='relative CPU weight of a container, as COMPILER_CPU_SHARES')
+    argparser.add_argument('--cpusets', nargs='*', default=[],
+                           help='CPU sets assigned to containers in rotation, as COMPILER_CPUSETS')
+    argparser.add_argument('--mem_limit', default='4g',
+                           help='memory limit of a container, as COMPILER_MEM_LIMIT. Use "" for no limit.')
+    argparser.add_argument('--pids_limit', type=int, default=256,
+                           help='maximum number of processes in a container, as COMPILER_PIDS_LIMIT. Use 0 for no limit.')
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    runner.configure_limits(cpu_shares=args.cpu_shares,
+                            cpusets=args.cpusets,
+                            mem_limit=args.mem_limit,
+                            pids_limit=args.pids_limit)
+    if args.font_cache:
+        runner.configure_font_cache()
+    if args.pool:
+        runner.configure_pool(size=args.capacity,
+                              max_uses=args.pool_max_uses,
+                              idle_timeout=args.pool_idle_timeout)
+    service = WorkerService(runner.run_latex, args.capacity, args.token, port=args.port)
+    stop = threading.Event()
+    if args.register:
+        if not args.url:
+            argparser.error('--url is required with --register')
+        threading.Thread(target=register_loop,
+                         args=(service, args.register, args.url, args.token, stop),
+                         daemon=True).start()
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        runner.close_pool()
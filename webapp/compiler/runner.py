@@ -4,38 +4,549 @@ also be used from the command line.
 """
 
 import argparse
+from collections import deque
+import fcntl
+import hashlib
+import itertools
 import json
 import os
 from pathlib import Path
 import random
+import re
 import shutil
 import string
 import sys
 import stat
+import threading
+import time
 
 import docker
-from docker.errors import APIError
+from docker.errors import APIError, InvalidVersion
 from docker.types import Mount
-_container = None
+try:
+    from .pool import ContainerPool
+    from .fontcache import FontCache
+    from .tracing import span, annotate
+except ImportError:
+    from pool import ContainerPool
+    from fontcache import FontCache
+    from tracing import span, annotate
 
-def run_latex(cmd, input_dirname, output_dirname):
+# These are created on first use. The pool is only used if
+# configure_pool has been called.
+_client = None
+_pool = None
+# Resource limits applied to every container. See configure_limits.
+_limits = {}
+_cpusets = None
+_cpuset_lock = threading.Lock()
+# Shared font and format caches. See configure_font_cache.
+_font_cache = None
 
-    """Run latexmk safely in a docker container.
+def _get_client():
+    global _client
+    if _client is None:
+        _client = docker.from_env()
+    return _client
+
+def configure_limits(cpu_shares=None, cpusets=None, mem_limit=None, pids_limit=None):
+    """Set cgroup limits for compile containers so that several
+    compilations can run at once without starving each other.
+    args:
+       cpu_shares: relative CPU weight (docker default is 1024).
+       cpusets: a list of cpuset strings like '0-1'. Containers are assigned these in rotation.
+       mem_limit: memory limit like '4g'. Swap beyond this is not allowed.
+       pids_limit: maximum number of processes in the container.
+    Any argument that is None is not limited."""
+    global _limits, _cpusets
+    limits = {}
+    if cpu_shares:
+        limits['cpu_shares'] = cpu_shares
+    if mem_limit:
+        limits['mem_limit'] = mem_limit
+        limits['memswap_limit'] = mem_limit
+    if pids_limit:
+        limits['pids_limit'] = pids_limit
+    _limits = limits
+    _cpusets = itertools.cycle(cpusets) if cpusets else None
+
+def configure_font_cache(enabled=True, image='debian-slim-texlive'):
+    """Mount a shared volume of font and format caches in compile containers,
+    so that lualatex does not rebuild its font database in every container.
+    The volume is populated when the first container is started."""
+    global _font_cache
+    if enabled:
+        lock_dir = Path(os.path.dirname(os.path.abspath(__file__))) / Path('staging')
+        _font_cache = FontCache(_get_client(), image, lock_dir)
+    else:
+        _font_cache = None
+
+def _container_args():
+    """kwargs for client.containers.run with the limits from configure_limits,
+    and mounts for the font cache if configure_font_cache was called."""
+    args = dict(_limits)
+    if _cpusets is not None:
+        with _cpuset_lock:
+            args['cpuset_cpus'] = next(_cpusets)
+    if _font_cache is not None:
+        args.update(_font_cache.container_args(image_digest(_font_cache.image)))
+    return args
+
+def configure_pool(**kwargs):
+    """Make run_latex lease warm containers from a ContainerPool. The
+    kwargs are passed to ContainerPool. Containers are started in the
+    background so that this does not block startup."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _pool = ContainerPool(client=_get_client(), container_args=_container_args, **kwargs)
+    threading.Thread(target=_pool.warm, name='container-warmup', daemon=True).start()
+    return _pool
+
+def close_pool():
+    """Remove the idle containers of the pool, if there is one. Leased
+    containers are removed when their lease ends."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+def pool_stats():
+    """Return metrics from the container pool, or None if there is no pool."""
+    if _pool is None:
+        return None
+    return _pool.stats()
+
+# Files left over from LaTeX or latexmk runs by the author. These are
+# not staged, since they would confuse latexmk.
+_RUN_FILES = set(['main.' + i for i in ['aux', 'bcf', 'out', 'bbl', 'pdf', 'blg', 'log', 'fls', 'fdb_latexmk', 'meta', 'abstract', 'toc', 'run.xml', 'pdfsync']])
+# Configuration files that could change how TeX or latexmk behaves.
+_CONFIG_FILES = ['texmf.cnf', 'latexmkrc', '.latexmkrc']
+# Files that LaTeX or its tools may rewrite in place. These are always
+# copied rather than linked, so that a compilation can never modify
+# the file in the input directory.
+_REWRITTEN_SUFFIXES = ('.aux', '.bbl', '.blg', '.log', '.out', '.toc', '.lof', '.lot',
+                       '.idx', '.ind', '.ilg', '.glo', '.gls', '.nav', '.snm', '.vrb',
+                       '.bcf', '.xml', '.fls', '.fdb_latexmk', '.synctex.gz', '.xdv')
+# Files produced by the server's own compilation that may seed the next
+# compilation of the same paper, so that latexmk can skip passes.
+WARM_START_FILES = ['main.' + i for i in ['aux', 'bbl', 'bcf', 'run.xml', 'fdb_latexmk', 'toc', 'out', 'lof', 'lot']]
+# latexmk prints this for every run of a rule.
+_latex_pass_re = re.compile(r"Run number \d+ of rule '(?:pdf|lua|xe)?latex")
+# latexmk prints this whenever it runs a rule, such as 'pdflatex' or 'bibtex main'.
+_rule_re = re.compile(r"Run number \d+ of rule '([^']+)'")
+# ioctl to share the blocks of a file on btrfs or xfs (a reflink).
+_FICLONE = 0x40049409
+# uid of the texlive user that runs latexmk in debian-slim-texlive. This
+# is www-data on the host, which may also be the uid of the web server.
+CONTAINER_UID = 33
+
+def _stage_file(src, dst, stats):
+    """Place src at dst as a hardlink, a reflink, or as a last resort a copy.
+    A hardlink is only possible if the staging directory is on the same
+    filesystem as the input directory. A hardlink shares the owner and mode
+    of src, so it is only used if the texlive user can read src but not
+    write it or change its mode: src must not be owned by CONTAINER_UID,
+    and must be readable by the group and not writable by the group or
+    others. Otherwise the mode of the copy is set, since changing the mode
+    of a hardlink would change the file in the input directory."""
+    st = os.stat(src)
+    mode = stat.S_IMODE(st.st_mode)
+    if (st.st_uid != CONTAINER_UID and not src.endswith(_REWRITTEN_SUFFIXES) and
+        mode & 0o040 and not mode & 0o022):
+        try:
+            os.link(src, dst)
+            stats['linked'] += 1
+            return
+        except OSError:
+            pass
+    try:
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+        stats['reflinked'] += 1
+    except OSError:
+        shutil.copyfile(src, dst)
+        stats['copied'] += 1
+        stats['bytes_copied'] += os.path.getsize(src)
+    os.chmod(dst, 0o644)
+
+def _walk_inputs(input_dir, warnings):
+    """Generator over the files and directories of input_dir that should be
+    staged for compilation, in a single pass. Yields tuples (is_dir, relpath,
+    path) where relpath is relative to input_dir. Symlinks are ignored.
+    Warnings about removed or suspicious files are appended to warnings."""
+    todo = [(str(input_dir), '')]
+    while todo:
+        src_dir, reldir = todo.pop()
+        with os.scandir(src_dir) as entries:
+            # sorted so that the order is deterministic for input_digest.
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_symlink():
+                    continue
+                relpath = os.path.join(reldir, entry.name)
+                if entry.is_dir():
+                    yield True, relpath, entry.path
+                    todo.append((entry.path, relpath))
+                    continue
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith('.cls') or entry.name.endswith('.bst'):
+                    warnings.append('File {} was removed before compiling'.format(entry.name))
+                    continue
+                if not reldir and entry.name in _RUN_FILES:
+                    continue
+                if not reldir and entry.name in _CONFIG_FILES:
+                    warnings.append('File {} was removed before compiling'.format(entry.name))
+                    continue
+                if entry.name.endswith('.sty') and entry.name != 'after-hyperref.sty':
+                    # .sty files can conflict with installed packages.
+                    warnings.append('You should avoid uploading style files. Style file {} may result in copy editing problems if you violate the journal style.'.format(entry.name))
+                yield False, relpath, entry.path
+
+def _stage_inputs(input_dir, staging_dir):
+    """Stage inputs into staging_dir and sanitize them for compilation
+    in a single pass over input_dir. Files are hardlinked or reflinked
+    where possible, so large figures are not copied. Symlinks are ignored.
+    staging_dir may already exist, but should be empty.
+    returns: an array of string warnings for the author, and a dict of
+       statistics about how files were staged."""
+    warnings = []
+    stats = {'files': 0, 'linked': 0, 'reflinked': 0, 'copied': 0, 'bytes_copied': 0}
+    # Ensure the texlive user in the Docker can write to the staging folder.
+    # Files are only readable, so authors' temporary files generated by latex
+    # must be replaced rather than overwritten.
+    Path(staging_dir).mkdir(mode=0o775, parents=True, exist_ok=True)
+    Path(staging_dir).chmod(0o775)
+    for is_dir, relpath, path in _walk_inputs(input_dir, warnings):
+        dst = os.path.join(staging_dir, relpath)
+        if is_dir:
+            os.mkdir(dst)
+            os.chmod(dst, 0o775)
+        else:
+            _stage_file(path, dst, stats)
+            stats['files'] += 1
+    return warnings, stats
+
+def input_digest(input_dirname, cmd, *extra):
+    """Return a hex digest that identifies the result of compiling
+    input_dirname with cmd. It covers the names and contents of the files
+    that would be staged, the command, the digest of the docker image,
+    and any extra strings supplied by the caller."""
+    h = hashlib.sha256()
+    for item in (cmd, image_digest()) + extra:
+        h.update(str(item).encode('UTF-8'))
+        h.update(b'\0')
+    for is_dir, relpath, path in _walk_inputs(input_dirname, []):
+        h.update(('D:' if is_dir else 'F:').encode('UTF-8'))
+        h.update(relpath.encode('UTF-8', errors='surrogateescape'))
+        h.update(b'\0')
+        if not is_dir:
+            with open(path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    h.update(chunk)
+            h.update(b'\0')
+    return h.hexdigest()
+
+_image_digest = None
+
+def image_digest(image='debian-slim-texlive'):
+    """The id of the docker image, which changes whenever it is rebuilt.
+    It is cached for a few minutes."""
+    global _image_digest
+    now = time.monotonic()
+    if _image_digest is None or _image_digest[0] != image or now - _image_digest[2] > 300:
+        _image_digest = (image, _get_client().images.get(image).id, now)
+    return _image_digest[1]
+
+def _seed_staging(seed_dir, staging_dir):
+    """Copy the WARM_START_FILES from seed_dir into staging_dir. These
+    replace any of the author's run files, which are never staged. They
+    are writable by the container, since latex rewrites them.
+    returns: True if any files were copied."""
+    seeded = False
+    for name in WARM_START_FILES:
+        src = Path(seed_dir, name)
+        if src.is_file() and not src.is_symlink():
+            dst = Path(staging_dir, name)
+            shutil.copyfile(src, dst)
+            dst.chmod(0o664)
+            seeded = True
+    return seeded
+
+def count_latex_passes(log):
+    """Return the number of times latexmk ran the latex engine."""
+    return len(_latex_pass_re.findall(log))
+
+def _cpu_ns(stats):
+    return stats.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage', 0)
+
+def _io_bytes(stats, op):
+    entries = stats.get('blkio_stats', {}).get('io_service_bytes_recursive') or []
+    return sum([e.get('value', 0) for e in entries if e.get('op', '').lower() == op])
+
+class _ResourceMonitor:
+    """Samples the docker stats API for a container while a command runs.
+    CPU time and block I/O are the difference between the first and last
+    sample, so this also works for pooled containers that are reused.
+    Peak memory is the maximum of the sampled memory usage. For a fresh
+    container the max_usage reported by cgroup v1 is also used, since it
+    covers the whole life of the container.
+
+    If wall_limit or cpu_limit (in seconds) is exceeded, then the
+    container is killed and exceeded describes which budget it was."""
+    def __init__(self, container, fresh, interval=0.5, wall_limit=None, cpu_limit=None):
+        self.container = container
+        self.fresh = fresh
+        self.interval = interval
+        self.wall_limit = wall_limit
+        self.cpu_limit = cpu_limit
+        self.peak_memory = 0
+        self.exceeded = None
+        self._stopped = threading.Event()
+        self._first = None
+        self._thread = None
+        self._start_time = None
+
+    def _sample(self):
+        try:
+            try:
+                stats = self.container.stats(stream=False, one_shot=True)
+            except InvalidVersion:
+                stats = self.container.stats(stream=False)
+        except Exception as e:
+            return None
+        memory = stats.get('memory_stats', {})
+        self.peak_memory = max(self.peak_memory, memory.get('usage', 0))
+        if self.fresh:
+            self.peak_memory = max(self.peak_memory, memory.get('max_usage', 0))
+        return stats
+
+    def _check_budgets(self, stats):
+        elapsed = time.monotonic() - self._start_time
+        if self.wall_limit and elapsed > self.wall_limit:
+            self.exceeded = {'budget': 'wall', 'limit': self.wall_limit, 'used': round(elapsed, 1)}
+        elif self.cpu_limit and stats and self._first:
+            cpu_seconds = (_cpu_ns(stats) - _cpu_ns(self._first)) / 1e9
+            if cpu_seconds > self.cpu_limit:
+                self.exceeded = {'budget': 'cpu', 'limit': self.cpu_limit, 'used': round(cpu_seconds, 1)}
+        if self.exceeded:
+            try:
+                self.container.kill()
+            except Exception as e:
+                pass
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            stats = self._sample()
+            if not self.exceeded:
+                self._check_budgets(stats)
+
+    def start(self):
+        self._start_time = time.monotonic()
+        self._first = self._sample()
+        self._thread = threading.Thread(target=self._run, name='resource-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling. returns a dict with cpu_seconds, peak_memory,
+        io_read_bytes and io_write_bytes, or None if stats were unavailable."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        last = self._sample()
+        if not self._first or not last:
+            return None
+        return {'cpu_seconds': round((_cpu_ns(last) - _cpu_ns(self._first)) / 1e9, 2),
+                'peak_memory': self.peak_memory,
+                'io_read_bytes': _io_bytes(last, 'read') - _io_bytes(self._first, 'read'),
+                'io_write_bytes': _io_bytes(last, 'write') - _io_bytes(self._first, 'write')}
+
+def _phase_name(rule):
+    """Map a latexmk rule such as 'pdflatex' or 'bibtex main' to a phase."""
+    words = rule.strip('*').split()
+    name = words[0] if words else rule
+    if name.endswith('latex'):
+        return 'latex'
+    if name in ('bibtex', 'biber', 'makeindex'):
+        return name
+    return 'other'
+
+class _PhaseTimer:
+    """Splits the time of a latexmk run into phases, using the time at
+    which each 'Run number' line appears in the streamed output. Time
+    before the first rule and between rules is attributed to 'other'."""
+    def __init__(self):
+        self.phases = {}
+        self.latex_passes = 0
+        self._current = 'other'
+        self._since = time.monotonic()
+        self._tail = b''
+
+    def _switch(self, phase):
+        now = time.monotonic()
+        self.phases[self._current] = self.phases.get(self._current, 0) + now - self._since
+        self._current = phase
+        self._since = now
+
+    def feed(self, chunk):
+        lines = (self._tail + chunk).split(b'\n')
+        self._tail = lines.pop()
+        for line in lines:
+            text = line.decode('iso-8859-1')
+            m = _rule_re.search(text)
+            if m:
+                self._switch(_phase_name(m.group(1)))
+                if _latex_pass_re.search(text):
+                    self.latex_passes += 1
+
+    def finish(self):
+        """returns a dict from phase to seconds."""
+        self.feed(b'\n')
+        self._switch(None)
+        return {phase: round(seconds, 2) for phase, seconds in self.phases.items()}
+
+# At most this many bytes from the end of the output of latexmk are kept
+# in the log of the compilation.
+MAX_LOG_BYTES = 1 << 20
+
+class _OutputTail:
+    """Keeps the last max_bytes of a stream of chunks."""
+    def __init__(self, max_bytes=MAX_LOG_BYTES):
+        self.max_bytes = max_bytes
+        self._chunks = deque()
+        self._size = 0
+        self.truncated = False
+
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size - len(self._chunks[0]) >= self.max_bytes:
+            self._size -= len(self._chunks.popleft())
+            self.truncated = True
+
+    def value(self) -> bytes:
+        data = b''.join(self._chunks)
+        if len(data) > self.max_bytes:
+            data = data[-self.max_bytes:]
+            self.truncated = True
+        if self.truncated:
+            data = b'[earlier output was omitted]\n' + data
+        return data
+
+def _exec(container, cmd, log_path, timer):
+    """Run cmd in /data of the container. The output is passed to timer
+    as it is produced. If log_path is given, then the output is also
+    streamed to that file, so that progress can be watched. Only the last
+    MAX_LOG_BYTES of the output are kept in memory.
+    returns: the exit code and the tail of the output as bytes."""
+    api = container.client.api
+    exec_id = api.exec_create(container.id, cmd, workdir='/data')['Id']
+    tail = _OutputTail()
+    logf = open(log_path, 'wb') if log_path else None
+    try:
+        for chunk in api.exec_start(exec_id, stream=True):
+            timer.feed(chunk)
+            tail.feed(chunk)
+            if logf:
+                logf.write(chunk)
+                logf.flush()
+    finally:
+        if logf:
+            logf.close()
+    code = api.exec_inspect(exec_id)['ExitCode']
+    return code, tail.value()
+
+def _compile_in(container, staging_dir, cmd, input_dir, seed_dir, log_path,
+                fresh, wall_limit, cpu_limit):
+    """Stage the inputs in staging_dir (mounted as /data in container) and
+    run cmd there. returns the result dict for run_latex, without outputs
+    having been moved."""
+    start = time.monotonic()
+    with span('stage_inputs'):
+        warnings, staging_stats = _stage_inputs(input_dir, staging_dir)
+        annotate(**staging_stats)
+    with span('seed'):
+        warm_start = bool(seed_dir) and _seed_staging(seed_dir, staging_dir)
+    staging_time = round(time.monotonic() - start, 2)
+    monitor = _ResourceMonitor(container, fresh=fresh,
+                               wall_limit=wall_limit, cpu_limit=cpu_limit)
+    timer = _PhaseTimer()
+    with span('latexmk', fresh=fresh):
+        monitor.start()
+        try:
+            code, output = _exec(container, cmd, log_path, timer)
+        finally:
+            resources = monitor.stop()
+        phases = timer.finish()
+        annotate(exit_code=code, phases=phases)
+    phases['staging'] = staging_time
+    log = _decode(output)
+    if monitor.exceeded and code == 0:
+        code = -1
+    return {'log': log,
+            'resources': resources,
+            'budget_exceeded': monitor.exceeded,
+            'phases': phases,
+            'warnings': warnings,
+            'staging': staging_stats,
+            'latex_passes': timer.latex_passes,
+            'warm_start': warm_start,
+            'exit_code': code}
+
+def _move_outputs(staging_dir, output_dir):
+    """Move the contents of staging_dir into output_dir, which should not
+    exist yet. This is a rename unless they are on different filesystems."""
+    output_dir.mkdir()
+    with os.scandir(staging_dir) as entries:
+        for entry in entries:
+            shutil.move(entry.path, os.path.join(output_dir, entry.name))
+
+def _decode(output):
+    # Warning: the output may be malformed bytes with mixed character encodings
+    # if it was run with pdflatex. We first try to read as UTF-8 strict, and
+    # then read it as iso-8859-1 with an error handler to replace it with the
+    # official replacement character of � (U+FFFD).
+    try:
+        return output.decode(encoding='UTF-8')
+    except Exception as e:
+        return output.decode(encoding='iso-8859-1', errors='replace')
+
+def run_latex(cmd, input_dirname, output_dirname, seed_dir=None, log_path=None,
+              wall_limit=None, cpu_limit=None):
+
+    """Run latexmk safely in a docker container. If configure_pool was
+       called, then the container is leased from the pool. Otherwise a
+       container is started for this compilation and removed afterward.
 
        args:
            input_dirname: directory where user-uploaded latex sources are. symlinks
                in this directory are ignored but subdirectories are allowed.
            output_dirname:
                path to where resulting output should be deposited. Should not already exist.
-       returns: A dict with exit_code, log, and warnings. The exit_code is the return code
-                from running latexmk, and log is the output from running latexmk. warnings
-                is an array of string warnings. Fatal errors will raise an exception instead.
+           seed_dir: optional directory containing WARM_START_FILES from a previous
+               compilation by the server. These are used to save latexmk passes.
+           log_path: optional file where the output of latexmk is streamed while
+               it runs. It should not be in output_dirname.
+           wall_limit: optional seconds of wall clock time after which the container is killed.
+           cpu_limit: optional seconds of CPU time after which the container is killed.
+       returns: A dict with exit_code, log, warnings, staging, latex_passes, warm_start,
+                resources, budget_exceeded, and phases.
+                The exit_code is the return code
+                from running latexmk, and log is the output from running latexmk (at most the
+                last MAX_LOG_BYTES). warnings
+                is an array of string warnings. staging has statistics on how many files were
+                linked or copied. latex_passes is the number of runs of the latex engine, and
+                warm_start is True if files from seed_dir were used. resources has
+                cpu_seconds, peak_memory, io_read_bytes, and io_write_bytes from the docker
+                stats API, or is None if they were unavailable. budget_exceeded is None
+                unless the container was killed, in which case it has budget ('wall' or 'cpu'),
+                limit, and used. phases maps staging, latex, bibtex, biber, and other to
+                seconds. Fatal errors will raise an exception instead.
        raises: 
           ValueError if some conditions are not satisfied.
           APIError if there is an error from the docker API.
 
           """
-    warnings = []
     input_dir = Path(input_dirname)
     if not input_dir.is_dir():
         raise ValueError('input directory not found: {}'.format(str(input_dir)))
@@ -46,83 +557,53 @@ def run_latex(cmd, input_dirname, output_dirname):
     main_tex_file = Path(input_dir, 'main.tex')
     if not main_tex_file.is_file():
         raise ValueError('missing main.tex')
-    # Create a temporary staging_dir for inputs, and copy inputs to
+    if _pool is not None:
+        # The slot directory of the leased container is the staging
+        # directory. It is scrubbed when the lease ends.
+        with _pool.lease() as pc:
+            result = _compile_in(pc.container, pc.slot_dir, pc.timed(cmd), input_dir,
+                                 seed_dir, log_path, False, wall_limit, cpu_limit)
+            if result['budget_exceeded']:
+                # The container was killed.
+                pc.discard = True
+            with span('move_outputs'):
+                _move_outputs(pc.slot_dir, output_dir)
+        return result
+    # Create a temporary staging_dir for inputs, and stage inputs in
     # staging_dir.  This directory will be mounted as /data in the
     # docker container.
     tmpdirname = ''.join(random.choice(string.ascii_lowercase+string.ascii_uppercase) for n in range(12))
     staging_dir = Path(os.path.dirname(os.path.abspath(__file__))) / Path('staging') / Path(tmpdirname)
     if staging_dir.is_dir():
         raise ValueError('staging directory {} already exists'.format(str(staging_dir.absolute())))
-    shutil.copytree(input_dir, staging_dir, symlinks=False)
-    # Ensure the texlive user in the Docker can write to the staging folder
-    # Moreover, authors might submit temporary files generated by latex 
-    # which need to get overwritten so make all files writeable
-    for dirpath, dirnames, filenames in os.walk(staging_dir):
-        dir_path = Path(dirpath)
-        dir_path.chmod(0o775)
-        for filename in filenames:
-            file_path = Path(os.path.join(dirpath, filename))
-            # remove any .sty files, since they can conflict with installed packages.
-            if file_path.name.endswith('.cls') or file_path.name.endswith('.bst'):
-                warnings.append('File {} was removed before compiling'.format(file_path.name))
-                file_path.unlink()
-            elif file_path.name.endswith('.sty') and file_path.name != 'after-hyperref.sty':
-                warnings.append('You should avoid uploading style files. Style file {} may result in copy editing problems if you violate the journal style.'.format(file_path.name))
-            else:
-                file_path.chmod(0o644)
-    # Remove any leftover files from LaTeX or latexmk runs by the author
-    for i in ['aux', 'bcf', 'out', 'bbl', 'pdf', 'blg', 'log', 'fls', 'fdb_latexmk', 'meta', 'abstract', 'toc', 'run.xml', 'pdfsync']:
-        if Path(staging_dir, 'main.' + i).is_file():
-            os.remove(str(staging_dir.absolute()) + '/main.' + i)
-    # Remove any texmf.cnf
-    texmf_cnf_file = Path(staging_dir, 'texmf.cnf')
-    if texmf_cnf_file.is_file():
-        warnings.append('File {} was removed before compiling'.format(texmf_cnf_file.name))
-        texmf_cnf_file.unlink()
-    # Remove any latexmkrc or .latexmkrc file.
-    latexmkrc_file = Path(staging_dir, 'latexmkrc')
-    if latexmkrc_file.is_file():
-        warnings.append('File {} was removed before compiling'.format(latexmkrc_file.name))
-        latexmkrc_file.unlink()
-    latexmkdr_file = Path(staging_dir, '.latexmkrc')
-    if latexmkrc_file.is_file():
-        warnings.append('File {} was removed before compiling'.format(latexmkrc_file.name))
-        latexmkrc_file.unlink()
-    client = docker.from_env()
+    container = None
     try:
+        staging_dir.mkdir(parents=True)
         # We mount the staging_dir as /data in the container.
         mount = Mount('/data', str(staging_dir.absolute()), type='bind')
-        container = client.containers.run('debian-slim-texlive',
-                                          detach=True,                  # Detach the container
-                                          network_disabled=True,        # Disable networking
-                                          mounts=[mount])               # Specify our mount point = the staging dir
-        code, output = container.exec_run(cmd, workdir='/data')
-        shutil.copytree(staging_dir, output_dir, symlinks=False)
-        container.kill()
-        # Warning: the output may be malformed bytes with mixed character encodings
-        # if it was run with pdflatex. We first try to read as UTF-8 strict, and
-        # then read it as iso-8859-1 with an error handler to replace it with the
-        # official replacement character of � (U+FFFD).
-        try:
-            log = output.decode(encoding='UTF-8')
-        except Exception as e:
-            log = output.decode(encoding='iso-8859-1', errors='replace')
-        return {'log': log,
-                'warnings': warnings,
-                'exit_code': code}
+        extra_args = _container_args()
+        mounts = [mount] + extra_args.pop('mounts', [])
+        with span('start_container'):
+            container = _get_client().containers.run('debian-slim-texlive',
+                                                     detach=True,                  # Detach the container
+                                                     network_disabled=True,        # Disable networking
+                                                     mounts=mounts,                # the staging dir and font cache
+                                                     **extra_args)                 # cgroup limits
+        result = _compile_in(container, staging_dir, cmd, input_dir,
+                             seed_dir, log_path, True, wall_limit, cpu_limit)
+        if not result['budget_exceeded']:
+            container.kill()
+        with span('move_outputs'):
+            _move_outputs(staging_dir, output_dir)
+        return result
     except APIError as e:
         raise(e)
     finally:
-        shutil.rmtree(staging_dir)
-        container.stop()
-        container.remove()
-    try:
-        log = output.decode(encoding='UTF-8')
-    except Exception as e:
-        log = output.decode(encoding='iso-8859-1', errors='replace')
-    return {'exit_code': 999,
-            'warnings': warnings,
-            'log': log}
+        with span('cleanup'):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if container is not None:
+                container.stop()
+                container.remove()
 
 
 if __name__ == '__main__':
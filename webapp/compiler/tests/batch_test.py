@@ -0,0 +1,39 @@
+import json
+from pathlib import Path
+import sys
+import tempfile
+
+sys.path.insert(0, '../')
+
+import batch
+
+LOG = r"""This is pdfTeX, Version 3.141592653-2.6-1.40.26 (TeX Live 2024) (preloaded format=pdflatex)
+LaTeX Warning: Reference `foo' on page 1 undefined on input line 12.
+Package hyperref Warning: Token not allowed in a PDF string (Unicode):
+Overfull \hbox (12.0pt too wide) in paragraph at lines 20--21
+Underfull \hbox (badness 10000) in paragraph at lines 30--31
+Underfull \vbox (badness 10000) has occurred while \output is active
+! Undefined control sequence.
+Output written on main.pdf (12 pages, 345678 bytes).
+"""
+
+def test_summarize_log():
+    summary = batch.summarize_log(LOG)
+    assert summary == {'pages': 12, 'errors': 1, 'warnings': 2, 'overfull': 1, 'underfull': 2}
+    assert batch.summarize_log('')['pages'] is None
+
+def test_diff_results():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        old_file = Path(tmpdirpath) / Path('old.jsonl')
+        old_file.write_text('\n'.join([json.dumps({'paper': 'a', 'exit_code': 0, 'pages': 10, 'seconds': 10}),
+                                       json.dumps({'paper': 'b', 'exit_code': 0, 'pages': 5, 'seconds': 10}),
+                                       json.dumps({'paper': 'c', 'exit_code': 0, 'pages': 5, 'seconds': 10})]))
+        new_file = Path(tmpdirpath) / Path('new.jsonl')
+        new_file.write_text('\n'.join([json.dumps({'paper': 'a', 'exit_code': 0, 'pages': 10, 'seconds': 5}),
+                                       json.dumps({'paper': 'b', 'exit_code': 12, 'pages': None, 'seconds': 5}),
+                                       json.dumps({'paper': 'd', 'exit_code': 0, 'pages': 1, 'seconds': 1})]))
+        diff = batch.diff_results(batch.read_results(old_file), batch.read_results(new_file))
+        assert diff['missing'] == ['c']
+        assert diff['added'] == ['d']
+        assert diff['changed'] == [('b', 'exit_code', 0, 12), ('b', 'pages', 5, None)]
+        assert diff['time_ratio'] == 0.5
@@ -0,0 +1,28 @@
+from pathlib import Path
+import sys
+import tempfile
+
+sys.path.insert(0, '../')
+
+import fontcache
+import runner
+
+cmd = 'latexmk -g -recorder -pdflua -lualatex="lualatex --disable-write18 --nosocket --no-shell-escape" main'
+
+def test_volume_name():
+    assert fontcache.volume_name('sha256:0123456789abcdef0123') == 'latex-submit-texcache-0123456789abcdef'
+
+def test_lualatex_with_font_cache():
+    runner.configure_font_cache(True)
+    try:
+        name = runner._font_cache.ensure(runner.image_digest())
+        assert name == fontcache.volume_name(runner.image_digest())
+        with tempfile.TemporaryDirectory() as tmpdirpath:
+            input_dir = Path(tmpdirpath) / Path('input')
+            input_dir.mkdir()
+            Path(input_dir, 'main.tex').write_text('\\documentclass{article}\\usepackage{fontspec}\\begin{document}x\\end{document}\n')
+            output = runner.run_latex(cmd, input_dir, Path(tmpdirpath) / Path('output'))
+            assert output['exit_code'] == 0
+            assert Path(tmpdirpath, 'output', 'main.pdf').is_file()
+    finally:
+        runner.configure_font_cache(False)
@@ -0,0 +1,103 @@
+import os
+from pathlib import Path
+import pytest
+import socket
+import sys
+import tempfile
+
+sys.path.insert(0, '../')
+
+from pool import ContainerPool, POOL_LABEL, SLOT_LABEL
+import runner
+
+cmd = 'latexmk -g -recorder -pdf -pdflatex="pdflatex -interaction=nonstopmode -disable-write18 -no-shell-escape" main'
+
+def test_lease_reuse():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        pool = ContainerPool(size=1, max_uses=3, staging_root=tmpdirpath)
+        try:
+            for i in range(4):
+                with pool.lease() as pc:
+                    # Each lease starts with an empty /data.
+                    assert not list(os.scandir(pc.slot_dir))
+                    Path(pc.slot_dir, 'junk.txt').write_text('leftover')
+                    code, output = pc.exec_run('ls /data')
+                    assert code == 0
+                    assert output.decode('UTF-8').strip() == 'junk.txt'
+            stats = pool.stats()
+            assert stats['leases'] == 4
+            # The container is retired after its third lease.
+            assert stats['reused_leases'] == 2
+            assert stats['containers_started'] == 2
+            assert stats['containers_retired'] == 1
+        finally:
+            pool.close()
+
+def test_exception_retires():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        pool = ContainerPool(size=1, staging_root=tmpdirpath)
+        try:
+            with pytest.raises(ValueError):
+                with pool.lease() as pc:
+                    raise ValueError('failed')
+            stats = pool.stats()
+            assert stats['containers_retired'] == 1
+            assert stats['live'] == 0
+        finally:
+            pool.close()
+
+def test_isolation():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        pool = ContainerPool(size=1, staging_root=tmpdirpath)
+        try:
+            with pool.lease() as pc:
+                # Only /data and /tmp are writable.
+                code, output = pc.exec_run('touch /home/texlive/leftover')
+                assert code != 0
+                code, output = pc.exec_run('kpsewhich -var-value TEXMFVAR')
+                assert output.decode('UTF-8').strip() == '/tmp/texmf-var'
+                code, output = pc.exec_run('touch /tmp/leftover')
+                assert code == 0
+            with pool.lease() as pc:
+                code, output = pc.exec_run('ls /tmp')
+                assert output.decode('UTF-8').strip() == ''
+        finally:
+            pool.close()
+
+def test_remove_orphans():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        pool = ContainerPool(size=1, staging_root=tmpdirpath)
+        slot_dir = Path(tmpdirpath, 'pool-orphan')
+        slot_dir.mkdir()
+        # A container from a process that no longer exists.
+        orphan = pool.client.containers.run(pool.image,
+                                            entrypoint=['tail', '-f', '/dev/null'],
+                                            detach=True,
+                                            labels={POOL_LABEL: '{}:999999999:gone'.format(socket.gethostname()),
+                                                    SLOT_LABEL: str(slot_dir)})
+        try:
+            with pool.lease() as pc:
+                assert pool.remove_orphans() == 1
+                # The container of a live pool is kept.
+                pc.container.reload()
+                assert pc.container.status == 'running'
+            assert not slot_dir.exists()
+        finally:
+            pool.close()
+            try:
+                orphan.remove(force=True)
+            except Exception:
+                pass
+
+def test_pooled_compile():
+    runner.configure_pool(size=1)
+    try:
+        for i in range(2):
+            with tempfile.TemporaryDirectory() as tmpdirpath:
+                output_path = tmpdirpath + '/output'
+                output = runner.run_latex(cmd, '../../metadata/latex/iacrcc/tests/test1', output_path)
+                assert output.get('exit_code') == 0
+        assert runner.pool_stats()['reused_leases'] == 1
+    finally:
+        runner._pool.close()
+        runner._pool = None
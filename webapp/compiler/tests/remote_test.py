@@ -0,0 +1,132 @@
+from pathlib import Path
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, '../')
+
+import remote
+
+TOKEN = 'secret'
+
+def fake_compile(cmd, input_dir, output_dir, wall_limit=None, cpu_limit=None):
+    """A stand-in for runner.run_latex that does not need docker."""
+    time.sleep(0.2)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    main = (input_dir / Path('main.tex')).read_text()
+    (output_dir / Path('main.pdf')).write_text('PDF of ' + main)
+    (output_dir / Path('sub')).mkdir()
+    (output_dir / Path('sub/main.aux')).write_text('aux')
+    return {'exit_code': 0, 'log': cmd, 'warnings': [], 'wall_limit': wall_limit}
+
+def start_worker(capacity=1):
+    service = remote.WorkerService(fake_compile, capacity, TOKEN, host='127.0.0.1', port=0)
+    threading.Thread(target=service.serve_forever, daemon=True).start()
+    host, port = service.server.server_address
+    return service, 'http://{}:{}'.format(host, port)
+
+def unused_url():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:{}'.format(s.getsockname()[1])
+
+def make_input(tmpdirpath):
+    input_dir = Path(tmpdirpath) / Path('input')
+    input_dir.mkdir()
+    (input_dir / Path('main.tex')).write_text('hello')
+    (input_dir / Path('main.iacrmetadata')).write_text('title: x')
+    return input_dir
+
+def test_round_trip():
+    service, url = start_worker()
+    try:
+        dispatcher = remote.Dispatcher(TOKEN)
+        with tempfile.TemporaryDirectory() as tmpdirpath:
+            input_dir = make_input(tmpdirpath)
+            output_dir = Path(tmpdirpath) / Path('output')
+            output_dir.mkdir()
+            (output_dir / Path('stale.pdf')).write_text('old')
+            workers = [{'url': url, 'capacity': 1, 'active': 0}]
+            result = dispatcher.run_latex(workers, 'latexmk -pdf main', input_dir, output_dir, wall_limit=300)
+            assert result == {'exit_code': 0, 'log': 'latexmk -pdf main', 'warnings': [], 'wall_limit': 300}
+            assert (output_dir / Path('main.pdf')).read_text() == 'PDF of hello'
+            assert (output_dir / Path('sub/main.aux')).read_text() == 'aux'
+            assert not (output_dir / Path('stale.pdf')).exists()
+        assert service.status() == {'capacity': 1, 'active': 0}
+    finally:
+        service.shutdown()
+
+def test_bad_token():
+    service, url = start_worker()
+    try:
+        dispatcher = remote.Dispatcher('wrong', attempts=1)
+        with tempfile.TemporaryDirectory() as tmpdirpath:
+            input_dir = make_input(tmpdirpath)
+            try:
+                dispatcher.run_latex([{'url': url, 'capacity': 1, 'active': 0}],
+                                     'latexmk', input_dir, Path(tmpdirpath) / Path('output'))
+                assert False, 'expected RemoteError'
+            except remote.RemoteError as e:
+                assert '403' in str(e)
+    finally:
+        service.shutdown()
+
+def test_choose():
+    dispatcher = remote.Dispatcher(TOKEN)
+    workers = [{'url': 'http://a', 'capacity': 4, 'active': 2},
+               {'url': 'http://b', 'capacity': 1, 'active': 0},
+               {'url': 'http://c', 'capacity': 2, 'active': 2}]
+    assert dispatcher.choose(workers)['url'] == 'http://b'
+    assert dispatcher.choose(workers, exclude={'http://b'})['url'] == 'http://a'
+    dispatcher._inflight['http://b'] = 1
+    assert dispatcher.choose(workers)['url'] == 'http://a'
+    dispatcher._failed['http://a'] = time.monotonic()
+    assert dispatcher.choose(workers)['url'] == 'http://b'
+    assert dispatcher.choose([]) is None
+
+def test_retry():
+    service, url = start_worker()
+    try:
+        dispatcher = remote.Dispatcher(TOKEN)
+        dead = unused_url()
+        # The dead worker looks idle, so it is tried first.
+        workers = [{'url': dead, 'capacity': 8, 'active': 0},
+                   {'url': url, 'capacity': 1, 'active': 0}]
+        with tempfile.TemporaryDirectory() as tmpdirpath:
+            input_dir = make_input(tmpdirpath)
+            output_dir = Path(tmpdirpath) / Path('output')
+            result = dispatcher.run_latex(workers, 'latexmk', input_dir, output_dir)
+            assert result['exit_code'] == 0
+            assert (output_dir / Path('main.pdf')).is_file()
+        # The dead worker is skipped until FAILURE_BACKOFF passes.
+        assert dispatcher.choose(workers)['url'] == url
+    finally:
+        service.shutdown()
+
+def test_busy():
+    service, url = start_worker(capacity=1)
+    try:
+        dispatcher = remote.Dispatcher(TOKEN, attempts=1)
+        workers = [{'url': url, 'capacity': 1, 'active': 0}]
+        results = []
+        errors = []
+        def compile_one(i):
+            with tempfile.TemporaryDirectory() as tmpdirpath:
+                input_dir = make_input(tmpdirpath)
+                try:
+                    results.append(dispatcher.run_latex(workers, 'latexmk', input_dir,
+                                                        Path(tmpdirpath) / Path('output')))
+                except remote.RemoteError as e:
+                    errors.append(str(e))
+        threads = [threading.Thread(target=compile_one, args=(i,)) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # The worker runs one at a time, so the second gets a 503.
+        assert len(results) == 1
+        assert len(errors) == 1 and 'busy' in errors[0]
+    finally:
+        service.shutdown()
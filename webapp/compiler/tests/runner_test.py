@@ -11,6 +11,7 @@ import tempfile
 
 sys.path.insert(0, '../')
 
+import runner
 from runner import run_latex
 
 cmd = 'latexmk -g -recorder -pdf -pdflatex="pdflatex -interaction=nonstopmode -disable-write18 -no-shell-escape" main'
@@ -1899,3 +1900,97 @@ def test_packages():
     diffs = packages.difference(lines)
     print(diffs)
     assert len(diffs) == 0
+
+def test_staging():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        input_dir = Path(tmpdirpath) / Path('input')
+        Path(input_dir, 'figs').mkdir(parents=True)
+        Path(input_dir, 'main.tex').write_text('hello')
+        Path(input_dir, 'main.aux').write_text('stale')
+        Path(input_dir, 'iacrcc.cls').write_text('mine')
+        Path(input_dir, '.latexmkrc').write_text('bad')
+        Path(input_dir, 'figs', 'fig.pdf').write_bytes(b'abc')
+        Path(input_dir, 'figs', 'chap.aux').write_text('aux')
+        Path(input_dir, 'figs', 'writable.tex').write_text('w')
+        os.symlink('/etc/passwd', Path(input_dir, 'passwd'))
+        for name in ['main.tex', 'figs/fig.pdf']:
+            os.chmod(Path(input_dir, name), 0o644)
+        os.chmod(Path(input_dir, 'figs', 'writable.tex'), 0o664)
+        staging_dir = Path(tmpdirpath) / Path('staging')
+        warnings, stats = runner._stage_inputs(input_dir, staging_dir)
+        assert len(warnings) == 2
+        assert sorted([str(p.relative_to(staging_dir)) for p in staging_dir.rglob('*')]) == ['figs', 'figs/chap.aux', 'figs/fig.pdf', 'figs/writable.tex', 'main.tex']
+        assert stats['files'] == 4
+        # aux files are never linked, because latex may rewrite them, and
+        # neither are files that the texlive group could write to.
+        assert stats['linked'] == 2
+        assert Path(input_dir, 'figs', 'fig.pdf').stat().st_ino == Path(staging_dir, 'figs', 'fig.pdf').stat().st_ino
+        # The mode of an input file is never changed.
+        assert Path(input_dir, 'figs', 'writable.tex').stat().st_mode & 0o777 == 0o664
+        assert Path(staging_dir, 'figs', 'writable.tex').stat().st_mode & 0o777 == 0o644
+        output_dir = Path(tmpdirpath) / Path('output')
+        runner._move_outputs(staging_dir, output_dir)
+        assert not list(staging_dir.iterdir())
+        assert Path(output_dir, 'figs', 'fig.pdf').read_bytes() == b'abc'
+
+def test_staging_owned_by_container(monkeypatch):
+    """Files owned by the uid of the texlive user are never linked, since
+    it could write them."""
+    monkeypatch.setattr(runner, 'CONTAINER_UID', os.getuid())
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        input_dir = Path(tmpdirpath) / Path('input')
+        input_dir.mkdir()
+        Path(input_dir, 'main.tex').write_text('hello')
+        os.chmod(Path(input_dir, 'main.tex'), 0o644)
+        staging_dir = Path(tmpdirpath) / Path('staging')
+        warnings, stats = runner._stage_inputs(input_dir, staging_dir)
+        assert stats['linked'] == 0
+        assert Path(input_dir, 'main.tex').stat().st_ino != Path(staging_dir, 'main.tex').stat().st_ino
+
+def test_count_latex_passes():
+    log = """Latexmk: applying rule 'pdflatex'...
+Run number 1 of rule 'pdflatex'
+Run number 1 of rule 'bibtex main'
+Run number 2 of rule 'pdflatex'
+Run number 1 of rule 'lualatex'"""
+    assert runner.count_latex_passes(log) == 3
+
+def test_warm_start():
+    """The second compilation should need fewer passes."""
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        first = run_latex(cmd, '../../metadata/latex/iacrcc/tests/test1', tmpdirpath + '/first')
+        assert first.get('exit_code') == 0
+        assert not first.get('warm_start')
+        second = run_latex(cmd, '../../metadata/latex/iacrcc/tests/test1', tmpdirpath + '/second',
+                           seed_dir=tmpdirpath + '/first')
+        assert second.get('exit_code') == 0
+        assert second.get('warm_start')
+        assert second.get('latex_passes') < first.get('latex_passes')
+
+def test_phase_timer():
+    timer = runner._PhaseTimer()
+    timer.feed(b"Latexmk: applying rule 'pdflatex'...\nRun number 1 of rule 'pdf")
+    timer.feed(b"latex'\nThis is pdfTeX\nRun number 1 of rule 'bibtex main'\n")
+    timer.feed(b"Run number 2 of rule 'pdflatex'\nOutput written")
+    phases = timer.finish()
+    assert set(phases.keys()) == {'other', 'latex', 'bibtex'}
+    assert all(seconds >= 0 for seconds in phases.values())
+    assert timer.latex_passes == 2
+
+def test_output_tail():
+    tail = runner._OutputTail(10)
+    tail.feed(b'abc')
+    assert tail.value() == b'abc'
+    for chunk in [b'defg', b'hijklmn', b'op']:
+        tail.feed(chunk)
+    assert tail.value() == b'[earlier output was omitted]\nghijklmnop'
+
+def test_wall_budget():
+    """A compilation that never ends should be killed."""
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        input_dir = Path(tmpdirpath) / Path('input')
+        input_dir.mkdir()
+        Path(input_dir, 'main.tex').write_text('\\documentclass{article}\\begin{document}\\loop\\iftrue\\repeat\\end{document}\n')
+        output = run_latex(cmd, input_dir, Path(tmpdirpath) / Path('output'), wall_limit=5)
+        assert output['budget_exceeded']['budget'] == 'wall'
+        assert output['exit_code'] != 0
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from pathlib import Path
+import sys
+import tempfile
+
+sys.path.insert(0, '../')
+
+import tracing
+
+def test_no_trace():
+    with tracing.span('step', a=1):
+        tracing.annotate(b=2)
+
+def test_nesting():
+    with tracing.trace('compile', task_key='p1/candidate') as t:
+        with tracing.span('latex', engine='pdflatex'):
+            tracing.annotate(exit_code=0)
+            with tracing.span('inner'):
+                pass
+        try:
+            with tracing.span('broken'):
+                raise ValueError('bad')
+        except ValueError:
+            pass
+    d = t.to_dict()
+    spans = {s['name']: s for s in d['spans']}
+    assert spans['compile']['parent'] is None
+    assert spans['compile']['attrs'] == {'task_key': 'p1/candidate'}
+    assert spans['latex']['parent'] == 0
+    assert spans['latex']['attrs'] == {'engine': 'pdflatex', 'exit_code': 0}
+    assert spans['inner']['parent'] == spans['latex']['id']
+    assert spans['broken']['error'] == 'ValueError: bad'
+    assert all([s['duration'] is not None for s in d['spans']])
+    assert spans['compile']['duration'] >= spans['latex']['duration']
+    # The trace has ended.
+    with tracing.span('after'):
+        pass
+    assert 'after' not in [s['name'] for s in t.to_dict()['spans']]
+
+def test_threads():
+    with tracing.trace('compile') as t:
+        with tracing.span('postprocess'):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = []
+                for i in range(8):
+                    def stage(i=i):
+                        with tracing.span('stage{}'.format(i)):
+                            tracing.annotate(i=i)
+                    futures.append(executor.submit(contextvars.copy_context().run, stage))
+                for f in futures:
+                    f.result()
+    spans = t.to_dict()['spans']
+    parent = [s for s in spans if s['name'] == 'postprocess'][0]['id']
+    stages = [s for s in spans if s['name'].startswith('stage')]
+    assert len(stages) == 8
+    assert all([s['parent'] == parent for s in stages])
+    assert all([s['attrs'] == {'i': int(s['name'][5:])} for s in stages])
+    assert [s['id'] for s in spans] == list(range(len(spans)))
+
+def test_exporter():
+    with tempfile.TemporaryDirectory() as tmpdirpath:
+        path = Path(tmpdirpath) / Path('trace.jsonl')
+        assert tracing.read_traces(path) == []
+        exporter = tracing.JsonlExporter(path)
+        ids = []
+        for i in range(3):
+            with tracing.trace('compile', n=i) as t:
+                with tracing.span('a'):
+                    with tracing.span('b'):
+                        pass
+                with tracing.span('c'):
+                    pass
+            exporter.export(t)
+            ids.append(t.trace_id)
+        with path.open('a') as f:
+            f.write('not json\n')
+        traces = tracing.read_traces(path, limit=2)
+        assert [t['trace_id'] for t in traces] == [ids[2], ids[1]]
+        tree = tracing.span_tree(traces[0])
+        assert [(s['name'], s['depth']) for s in tree] == [('compile', 0), ('a', 1), ('b', 2), ('c', 1)]
+        # The file is cut in half when it is too large.
+        small = tracing.JsonlExporter(path, max_bytes=1)
+        small.export(t)
+        assert len(path.read_text().splitlines()) == 3
@@ -0,0 +1,157 @@
+"""
+Lightweight tracing of the steps of a compilation. A trace is started
+with trace(), and code that runs inside it marks its steps with span():
+
+   with tracing.trace('compile', task_key=task_key) as t:
+       with tracing.span('latex', engine='pdflatex'):
+           ...
+   tracing.JsonlExporter(path).export(t)
+
+Spans nest, and record their start relative to the trace, their
+duration, their attributes, and the exception if one was raised. The
+current span is kept in a contextvar, so a span outside of a trace is
+nearly free, and code in this directory can use spans without knowing
+whether the web server is tracing. Threads do not inherit the current
+span, so work submitted to a thread pool should be run with
+contextvars.copy_context().run.
+
+There is no external service. Traces are appended as lines of JSON to a
+file, and read back with read_traces.
+"""
+
+from contextlib import contextmanager
+import contextvars
+import itertools
+import json
+import os
+from pathlib import Path
+import threading
+import time
+import uuid
+
+# (Trace, id of the current span) or None if there is no trace.
+_current = contextvars.ContextVar('tracing_current', default=None)
+
+class Trace:
+    """The spans of one trace. The root span has id 0."""
+    def __init__(self, name, attrs):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.spans = [{'id': 0, 'parent': None, 'name': name, 'start': 0.0,
+                       'duration': None, 'attrs': dict(attrs)}]
+
+    def _start_span(self, name, parent, attrs):
+        span = {'parent': parent, 'name': name,
+                'start': round(time.perf_counter() - self._origin, 4),
+                'duration': None, 'attrs': dict(attrs)}
+        with self._lock:
+            # The id of a span is its index in spans.
+            span['id'] = next(self._ids)
+            self.spans.append(span)
+        return span
+
+    def _end_span(self, span):
+        # start was rounded, so a very short span could be negative.
+        span['duration'] = max(0.0, round(time.perf_counter() - self._origin - span['start'], 4))
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [dict(s) for s in self.spans]
+        return {'trace_id': self.trace_id,
+                'name': self.name,
+                'started': self.started,
+                'spans': spans}
+
+@contextmanager
+def trace(name, **attrs):
+    """Start a trace, with a root span called name. yields the Trace."""
+    t = Trace(name, attrs)
+    token = _current.set((t, 0))
+    try:
+        yield t
+    except BaseException as e:
+        t.spans[0]['error'] = '{}: {}'.format(type(e).__name__, str(e))
+        raise
+    finally:
+        _current.reset(token)
+        t._end_span(t.spans[0])
+
+@contextmanager
+def span(name, **attrs):
+    """Record a step in the current trace. Does nothing if there is no
+    trace."""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    t, parent = current
+    s = t._start_span(name, parent, attrs)
+    token = _current.set((t, s['id']))
+    try:
+        yield
+    except BaseException as e:
+        s['error'] = '{}: {}'.format(type(e).__name__, str(e))
+        raise
+    finally:
+        _current.reset(token)
+        t._end_span(s)
+
+def annotate(**attrs):
+    """Add attributes to the current span, if there is one."""
+    current = _current.get()
+    if current is not None:
+        t, span_id = current
+        with t._lock:
+            t.spans[span_id]['attrs'].update(attrs)
+
+class JsonlExporter:
+    """Appends each trace as one line of JSON to path. When the file is
+    larger than max_bytes, the oldest half of the traces is dropped."""
+    def __init__(self, path, max_bytes=1024*1024):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+
+    def export(self, t: Trace):
+        line = json.dumps(t.to_dict(), default=str) + '\n'
+        with self.path.open('a', encoding='UTF-8') as f:
+            f.write(line)
+        if self.path.stat().st_size > self.max_bytes:
+            lines = self.path.read_text(encoding='UTF-8').splitlines(keepends=True)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            tmp.write_text(''.join(lines[len(lines) // 2:]), encoding='UTF-8')
+            os.replace(tmp, self.path)
+
+def read_traces(path, limit=None) -> list:
+    """returns the traces in a file from JsonlExporter, newest first. Lines
+    that cannot be parsed are skipped."""
+    path = Path(path)
+    if not path.is_file():
+        return []
+    traces = []
+    for line in reversed(path.read_text(encoding='UTF-8', errors='replace').splitlines()):
+        try:
+            traces.append(json.loads(line))
+        except ValueError:
+            continue
+        if limit and len(traces) >= limit:
+            break
+    return traces
+
+def span_tree(t: dict) -> list:
+    """returns the spans of a trace dict in depth first order, each with a
+    depth. Children are in order of their start."""
+    children = {}
+    for s in t['spans']:
+        children.setdefault(s['parent'], []).append(s)
+    ordered = []
+    stack = [(s, 0) for s in reversed(sorted(children.get(None, []), key=lambda s: s['start']))]
+    while stack:
+        s, depth = stack.pop()
+        ordered.append(dict(s, depth=depth))
+        for child in reversed(sorted(children.get(s['id'], []), key=lambda s: s['start'])):
+            stack.append((child, depth + 1))
+    return ordered
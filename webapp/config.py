@@ -6,7 +6,7 @@ from os import path
 
 from enum import Enum
 from pydantic import BaseModel, Field, AnyUrl, ConfigDict, EmailStr, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 basedir = path.abspath(path.dirname(__file__))
 
@@ -127,6 +127,91 @@ class Config(BaseModel):
     MAIL_BACKEND: str = Field(default='console',
                               title='Which backend to use for flask_mailman.',
                               description='In production this should be smtp, but in debug it should be console.')
+    ############################## options related to the LaTeX compiler ######################################
+    COMPILER_WORKERS: int = Field(default=1,
+                                  title='Number of compilations that may run at the same time in each process.',
+                                  description='Each one runs in its own docker container, so see the resource limits below. Jobs are shared by all processes through the compile_job table.')
+    COMPILER_IN_PROCESS: bool = Field(default=True,
+                                      title='Whether the web server runs compile workers in its own processes.',
+                                      description='If false, then compilations are run by separate worker processes started with python3 -m webapp.worker.')
+    COMPILER_LEASE_SECONDS: int = Field(default=120,
+                                        title='Seconds that a worker holds a compile job without a heartbeat.',
+                                        description='If a process dies, then its jobs are picked up by another worker after this.')
+    COMPILER_POLL_INTERVAL: float = Field(default=2,
+                                          title='Seconds between checks of the compile_job table by idle workers.')
+    COMPILER_AGING_SECONDS: int = Field(default=300,
+                                        title='Seconds of waiting that raise a compile job by one priority class.',
+                                        description='Final versions and admin recompiles run before copy edit versions, which run before candidate versions. Aging prevents starvation.')
+    COMPILER_FAIR_SHARE_WEIGHT: float = Field(default=0.5,
+                                              title='Priority classes that a job loses for each running job of the same journal.',
+                                              description='This shares the compile workers between journals.')
+    COMPILER_SNAPSHOT_SECONDS: float = Field(default=5,
+                                             title='Seconds that a snapshot of the compile schedule is reused.',
+                                             description='Queue positions and time estimates shown to authors are computed from the snapshot.')
+    COMPILER_MAX_QUEUED: Optional[int] = Field(default=None,
+                                               title='Maximum number of queued or running compile jobs before uploads are refused.',
+                                               description='Authors are asked to try again when the queue is expected to have room. If None then there is no limit. Admin recompiles are not limited.')
+    COMPILER_MAX_QUEUED_PER_JOURNAL: Optional[int] = Field(default=None,
+                                                           title='Maximum number of queued or running compile jobs for one journal before its uploads are refused.',
+                                                           description='If None then there is no limit.')
+    COMPILER_MAX_PENDING_BYTES: Optional[int] = Field(default=None,
+                                                      title='Maximum bytes of inputs of queued or running compile jobs before uploads are refused.',
+                                                      description='This protects the disk of DATA_DIR. A new upload counts with the size of its request. If None then there is no limit.')
+    COMPILER_MAX_ATTEMPTS: int = Field(default=3,
+                                       title='Number of times a compile job may be abandoned before it is marked as failed.')
+    COMPILER_CPU_SHARES: Optional[int] = Field(default=None,
+                                               title='Relative CPU weight of a compile container (docker --cpu-shares).',
+                                               description='If None then docker uses its default of 1024.')
+    COMPILER_CPUSETS: List[str] = Field(default=[],
+                                        title='CPU sets for compile containers, e.g., ["0-1", "2-3"].',
+                                        description='Containers are assigned these in rotation. If empty then containers may use any CPU.')
+    COMPILER_MEM_LIMIT: Optional[str] = Field(default='4g',
+                                              title='Memory limit for a compile container (docker --memory).',
+                                              description='Swap is not allowed beyond this. If None then there is no limit.')
+    COMPILER_PIDS_LIMIT: Optional[int] = Field(default=256,
+                                               title='Maximum number of processes in a compile container (docker --pids-limit).')
+    COMPILER_POOL_SIZE: int = Field(default=0,
+                                    title='Number of warm docker containers to keep for compiling LaTeX.',
+                                    description='If 0, then a container is started and removed for every compilation.')
+    COMPILER_POOL_MAX_USES: int = Field(default=50,
+                                        title='Number of compilations before a pooled container is replaced.')
+    COMPILER_POOL_IDLE_TIMEOUT: int = Field(default=600,
+                                            title='Seconds that a pooled container may be idle before it is removed.')
+    COMPILER_WARM_START: bool = Field(default=False,
+                                      title='Whether to seed a compilation with aux files from the previous compilation of the paper.',
+                                      description='Only files produced by the server are used, and this saves latexmk passes.')
+    COMPILER_FONT_CACHE: bool = Field(default=False,
+                                      title='Whether to mount a shared volume of font and format caches in compile containers.',
+                                      description='This saves lualatex from rebuilding its font database in every container. The volume is built once per docker image.')
+    COMPILER_WALL_BUDGETS: Dict[str, int] = Field(default={'pdflatex': 300, 'xelatex': 400, 'lualatex': 450},
+                                                  title='Seconds of wall clock time allowed for a compilation, by engine.',
+                                                  description='The container is killed when this is exceeded. Pooled containers also have a hard limit of 500 seconds.')
+    COMPILER_CPU_BUDGETS: Dict[str, int] = Field(default={'pdflatex': 240, 'xelatex': 320, 'lualatex': 360},
+                                                 title='Seconds of CPU time allowed for a compilation, by engine.',
+                                                 description='The container is killed when this is exceeded. Engines that are missing have no CPU budget.')
+    COMPILER_REMOTE_TOKEN: Optional[str] = Field(default=None,
+                                                 title='Shared secret of remote compile workers.',
+                                                 description='If set, then workers started with python3 webapp/compiler/remote.py register at /compiler/register, and compilations are sent to them. If no worker is available then latex runs locally.')
+    COMPILER_REMOTE_ATTEMPTS: int = Field(default=3,
+                                          title='Number of remote workers that a compilation is tried on before it runs locally.')
+    COMPILER_TRACING: bool = Field(default=True,
+                                   title='Whether to record the time of each step of a compilation.',
+                                   description='The traces are kept in trace.jsonl in the version directory, and are shown on the admin page of the paper.')
+    BIBTEX_INDEX: bool = Field(default=True,
+                               title='Whether to index the bibtex files in BIBINPUTS, such as cryptobib.',
+                               description='The indexes are kept in bibindex in DATA_DIR and are rebuilt when a bibtex file changes. Only the cited entries are read from them.')
+    COMPILE_CACHE_DIR: Optional[str] = Field(default=None,
+                                             title='Directory for caching compilation results of identical inputs.',
+                                             description='If None, then every upload is compiled. It should be on the same filesystem as DATA_DIR.')
+    COMPILE_CACHE_MAX_BYTES: int = Field(default=10*1024*1024*1024,
+                                         title='Approximate bound on the size of the compile cache.',
+                                         description='Least recently used entries are removed to stay below this.')
+    METRICS_DB: Optional[str] = Field(default=None,
+                                      title='sqlite file for the counters and histograms at /metrics.',
+                                      description='It must be on local disk, and it is shared by all processes on the host. If None, then it is metrics.sqlite in DATA_DIR.')
+    METRICS_TOKEN: Optional[str] = Field(default=None,
+                                         title='Bearer token that a Prometheus scraper uses for /metrics.',
+                                         description='If None, then only logged in admins can see /metrics.')
     model_config = ConfigDict(extra='forbid')
 
 # class ProdConfig(Config):
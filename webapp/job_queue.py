@@ -0,0 +1,686 @@
+"""A compile queue that is stored in the compile_job table, so that queued
+compilations survive a restart of the web server and are shared by all
+processes that serve the app. Each process runs COMPILER_WORKERS threads
+that claim jobs from the table. A claim is a conditional UPDATE, so two
+workers can never claim the same job, and the worker holds a lease that
+it extends with a heartbeat while the compilation runs. If a process
+dies, then its leases expire and the jobs are claimed by another worker.
+
+Jobs are not claimed in FIFO order. Each job has a priority class, and
+the journals of the papers share the workers fairly, so that a rush of
+candidate uploads for one journal does not hold up the final version
+of a paper that blocks the export of an issue. The order is decided by
+score() below, which ages waiting jobs so that none of them starve.
+"""
+
+from datetime import datetime, timedelta
+import heapq
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import shutil
+import socket
+import threading
+import time
+from sqlalchemy import select, update, and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .metadata.db_models import CompileJob, CompileRecord, CompilationParts, JobStatus, PaperStatus, TaskStatus, Version
+from .metadata.compilation import Compilation
+from .metrics import metrics
+from .status_events import status_broker
+from .tasks import run_latex_task, engine_from_cmd, input_size
+
+# Priority classes. Lower numbers run first.
+PRIORITY_ADMIN = 0      # recompiles requested by admins and copy editors
+PRIORITY_FINAL = 0
+PRIORITY_COPYEDIT = 1
+PRIORITY_CANDIDATE = 2
+
+def priority_for_version(version: str) -> int:
+    if version == Version.FINAL.value:
+        return PRIORITY_FINAL
+    if version == Version.COPYEDIT.value:
+        return PRIORITY_COPYEDIT
+    return PRIORITY_CANDIDATE
+
+def score(priority, journal_key, enqueued_at, running, now, aging_seconds, share_weight):
+    """The score of a waiting job. The job with the lowest score is claimed
+    first. Waiting aging_seconds is worth one priority class, and every job
+    of the same journal that is already running costs share_weight classes."""
+    wait = (now - enqueued_at).total_seconds()
+    return (priority if priority is not None else PRIORITY_CANDIDATE) - wait / aging_seconds + share_weight * running.get(journal_key, 0)
+
+def schedule(jobs, running, now, aging_seconds, share_weight, limit=None):
+    """Return jobs in the order they would be claimed if no more jobs
+    arrive, or only the first limit of them. jobs is a list of objects
+    with id, priority, journal_key, and enqueued_at, and running has the
+    number of running jobs for each journal_key. Each job that is
+    scheduled counts as running for the jobs after it, so journals take
+    turns.
+    The running jobs add the same amount to the score of every job of a
+    journal, so the jobs of each journal are sorted once, and only the
+    first job of each journal competes in a heap."""
+    running = dict(running)
+    def key(j):
+        return (score(j.priority, j.journal_key, j.enqueued_at, running, now, aging_seconds, share_weight),
+                j.enqueued_at, j.id)
+    journals = {}
+    for job in jobs:
+        journals.setdefault(job.journal_key, []).append(job)
+    heap = []
+    for journal_key, journal_jobs in journals.items():
+        journal_jobs.sort(key=key, reverse=True)
+        job = journal_jobs.pop()
+        heap.append((key(job), id(journal_jobs), job, journal_jobs))
+    heapq.heapify(heap)
+    order = []
+    while heap and (limit is None or len(order) < limit):
+        _, _, best, journal_jobs = heapq.heappop(heap)
+        order.append(best)
+        running[best.journal_key] = running.get(best.journal_key, 0) + 1
+        if journal_jobs:
+            job = journal_jobs.pop()
+            heapq.heappush(heap, (key(job), id(journal_jobs), job, journal_jobs))
+    return order
+
+# Upper bounds in bytes of the input sizes that are estimated separately.
+SIZE_BUCKETS = [256 * 1024, 2 * 1024 * 1024, 16 * 1024 * 1024]
+DEFAULT_COMPILE_SECONDS = 60
+
+def size_bucket(size) -> int:
+    if size is None:
+        return None
+    for i, bound in enumerate(SIZE_BUCKETS):
+        if size < bound:
+            return i
+    return len(SIZE_BUCKETS)
+
+def percentile(values, q):
+    """The q-th percentile of a non-empty sorted list, by nearest rank."""
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values) / 100) - 1))]
+
+class CompileTimeEstimator:
+    """Percentiles of recent compile times for each engine and size bucket.
+    Groups with fewer than min_samples compilations fall back to the engine,
+    and then to all compilations."""
+    def __init__(self, records, min_samples=5):
+        """records is a list of (engine, input_size, compile_time)."""
+        groups = {}
+        for engine, size, seconds in records:
+            for key in [(engine, size_bucket(size)), (engine, None), (None, None)]:
+                groups.setdefault(key, []).append(seconds)
+        self.percentiles = {}
+        for key, values in groups.items():
+            if len(values) >= min_samples or key == (None, None):
+                values.sort()
+                self.percentiles[key] = (percentile(values, 50), percentile(values, 90))
+
+    def estimate(self, engine, size) -> tuple[float, float]:
+        """returns the (p50, p90) seconds of a compilation."""
+        for key in [(engine, size_bucket(size)), (engine, None), (None, None)]:
+            if key in self.percentiles:
+                return self.percentiles[key]
+        return DEFAULT_COMPILE_SECONDS, DEFAULT_COMPILE_SECONDS
+
+def _remaining_times(running_jobs, estimator, now, index):
+    """returns the seconds until each running job finishes."""
+    return [max(0, estimator.estimate(j.engine, j.input_size)[index] - (now - j.started_at).total_seconds())
+            for j in running_jobs]
+
+def _finish_times(order, running_jobs, estimator, workers, now, index):
+    """Simulate the workers on the schedule. running_jobs and order are as
+    returned by JobQueue._schedule, and there must be at least as many
+    workers as running jobs. index 0 is the p50 and 1 is the p90 estimate.
+    returns the seconds until each job in order finishes."""
+    # Each worker is free after the remaining time of its running job.
+    free = _remaining_times(running_jobs, estimator, now, index)
+    free += [0] * (workers - len(free))
+    heapq.heapify(free)
+    finish = []
+    for job in order:
+        start = heapq.heappop(free)
+        end = start + estimator.estimate(job.engine, job.input_size)[index]
+        heapq.heappush(free, end)
+        finish.append(end)
+    return finish
+
+class QueueSnapshot:
+    """The schedule at one point in time, with the position and estimated
+    time to finish of each queued job."""
+    def __init__(self, order, running_jobs, estimator, recent_waits, workers, now):
+        # Other processes may run workers too, and all of them are busy.
+        workers = max(workers, len(running_jobs), 1)
+        self.created = now
+        self.queued = len(order)
+        self.running = len(running_jobs)
+        self.depth = self.queued + self.running
+        self.workers = workers
+        self.positions = {job.id: i + 1 for i, job in enumerate(order)}
+        finish_p50 = _finish_times(order, running_jobs, estimator, workers, now, 0)
+        self.etas = dict(zip([job.id for job in order],
+                             zip(finish_p50,
+                                 _finish_times(order, running_jobs, estimator, workers, now, 1))))
+        # (seconds until it finishes, journal_key, input_size) of every
+        # queued or running job, for admission_wait.
+        self.pending = list(zip(_remaining_times(running_jobs, estimator, now, 0) + finish_p50,
+                                [job.journal_key for job in running_jobs + order],
+                                [job.input_size or 0 for job in running_jobs + order]))
+        waits = sorted([(now - job.enqueued_at).total_seconds() for job in order])
+        self.oldest_wait = waits[-1] if waits else 0
+        self.median_wait = percentile(waits, 50) if waits else 0
+        recent_waits = sorted(recent_waits)
+        self.recent_wait_p50 = percentile(recent_waits, 50) if recent_waits else None
+        self.recent_wait_p90 = percentile(recent_waits, 90) if recent_waits else None
+        self.recent_started = len(recent_waits)
+
+    def position(self, jobid) -> int:
+        """The 1-based position of a job, or the end of the queue if it was
+        enqueued after the snapshot was taken."""
+        return self.positions.get(jobid, self.queued + 1)
+
+    def eta(self, jobid) -> tuple[float, float]:
+        """returns the (p50, p90) seconds from the snapshot until the job
+        finishes, or None if the job is not in the snapshot."""
+        return self.etas.get(jobid)
+
+class QueueFull(Exception):
+    """Raised by JobQueue.enqueue when a limit on the queue is reached."""
+    pass
+
+def admission_wait(snapshot, journal_key, upload_bytes, max_queued=None, max_per_journal=None,
+                   max_bytes=None, superseding=False):
+    """Decide whether a new upload may be queued. Each limit is skipped if
+    it is None. An upload that supersedes a queued or running job does not
+    add a job, so only the limit on bytes applies to it.
+    returns None if the upload is admitted, or else the estimated seconds
+    until enough of the pending jobs finish for it to be admitted."""
+    waits = []
+    finish = sorted([f for f, _, _ in snapshot.pending])
+    if max_queued is not None and not superseding and len(finish) >= max_queued:
+        waits.append(finish[len(finish) - max_queued] if max_queued > 0 else math.inf)
+    if max_per_journal is not None and not superseding:
+        journal = sorted([f for f, key, _ in snapshot.pending if key == journal_key])
+        if len(journal) >= max_per_journal:
+            waits.append(journal[len(journal) - max_per_journal] if max_per_journal > 0 else math.inf)
+    if max_bytes is not None:
+        excess = sum([size for _, _, size in snapshot.pending]) + upload_bytes - max_bytes
+        if excess > 0:
+            wait = math.inf
+            for f, _, size in sorted(snapshot.pending):
+                excess -= size
+                if excess <= 0:
+                    wait = f
+                    break
+            waits.append(wait)
+    return max(waits) if waits else None
+
+def new_staging_dir(version_dir) -> Path:
+    """returns a path next to version_dir to stage an upload in for
+    enqueue or supersede. It is not created."""
+    version_dir = Path(version_dir)
+    return version_dir.with_name('{}.next-{}'.format(version_dir.name, datetime.now().strftime('%Y%m%d%H%M%S%f')))
+
+def promote_upload(staging_dir, version_dir, paperid: str, version: str):
+    """Move an upload from staging_dir to version_dir, replacing the
+    previous upload, and reset the CompileRecord from its compilation.json.
+    This must only be called by the holder of the job for the version, or
+    when there is no job."""
+    staging_dir = Path(staging_dir)
+    version_dir = Path(version_dir)
+    old_dir = version_dir.with_name(staging_dir.name + '.old')
+    if version_dir.is_dir():
+        version_dir.rename(old_dir)
+    staging_dir.rename(version_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    compilation = Compilation.model_validate_json(Path(version_dir, 'compilation.json').read_text(encoding='UTF-8'))
+    comprec = db.session.execute(select(CompileRecord).where(and_(CompileRecord.paperid == paperid,
+                                                                  CompileRecord.version == version))).scalar_one_or_none()
+    if not comprec:
+        comprec = CompileRecord(paperid=paperid, version=version)
+    comprec.task_status = TaskStatus.PENDING
+    comprec.started = datetime.now()
+    comprec.set_result(db.session, CompilationParts(compilation))
+    db.session.add(comprec)
+    db.session.commit()
+
+class JobQueue:
+    def __init__(self):
+        self.app = None
+        self.lease_seconds = 120
+        self.poll_interval = 2
+        self.max_attempts = 3
+        self.aging_seconds = 300
+        self.share_weight = 0.5
+        self.workers = 1
+        self.snapshot_seconds = 5
+        self.history = 500
+        self.max_queued = None
+        self.max_per_journal = None
+        self.max_pending_bytes = None
+        self._snapshot = None
+        self._snapshot_time = 0
+        self._snapshot_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def init_app(self, app):
+        self.app = app
+        self.lease_seconds = app.config['COMPILER_LEASE_SECONDS']
+        self.poll_interval = app.config['COMPILER_POLL_INTERVAL']
+        self.max_attempts = app.config['COMPILER_MAX_ATTEMPTS']
+        self.aging_seconds = app.config['COMPILER_AGING_SECONDS']
+        self.share_weight = app.config['COMPILER_FAIR_SHARE_WEIGHT']
+        self.workers = app.config['COMPILER_WORKERS']
+        self.snapshot_seconds = app.config['COMPILER_SNAPSHOT_SECONDS']
+        self.max_queued = app.config.get('COMPILER_MAX_QUEUED')
+        self.max_per_journal = app.config.get('COMPILER_MAX_QUEUED_PER_JOURNAL')
+        self.max_pending_bytes = app.config.get('COMPILER_MAX_PENDING_BYTES')
+        # Tests use an in-memory database that worker threads cannot see.
+        if app.config['COMPILER_IN_PROCESS'] and not app.testing:
+            self.start(app.config['COMPILER_WORKERS'])
+
+    def start(self, workers):
+        """Start worker threads in this process."""
+        for i in range(workers):
+            worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), len(self._threads))
+            thread = threading.Thread(target=self._work, args=(worker_id,),
+                                      name='compiler-{}'.format(len(self._threads)),
+                                      daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self, timeout=None) -> bool:
+        """Stop claiming jobs, and wait for running jobs to finish.
+        returns False if some were still running after timeout seconds."""
+        self._stopping.set()
+        self._wakeup.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not [t for t in self._threads if t.is_alive()]
+
+    def running(self) -> int:
+        """The number of worker threads in this process that are alive."""
+        return len([t for t in self._threads if t.is_alive()])
+
+    def enqueue(self, task_key: str, paperid: str, version: str, cmd: str, paper_path: str, doi: str,
+                priority: int = None, staging: str = None, limited: bool = False) -> bool:
+        """Add a compilation to the queue. The priority class defaults to
+        priority_for_version(version). If staging is given, it is an upload
+        that the worker moves into paper_path when it claims the job, as
+        for supersede. If limited, the limits on the queue are checked
+        against the current jobs rather than the snapshot that admit uses,
+        and QueueFull is raised if one is reached. Uploads that are enqueued
+        at the same moment may still each see room, so the limits are soft.
+        returns False if there is already a queued or running job for
+        task_key, and then paper_path and staging are left alone."""
+        now = datetime.now()
+        args = json.dumps({'cmd': cmd, 'paper_path': paper_path, 'doi': doi})
+        next_args = None
+        if staging:
+            next_args = json.dumps({'cmd': cmd, 'paper_path': paper_path, 'doi': doi, 'staging': staging})
+        if priority is None:
+            priority = priority_for_version(version)
+        journal_key = db.session.execute(select(PaperStatus.journal_key).where(PaperStatus.paperid == paperid)).scalar_one_or_none()
+        engine = engine_from_cmd(cmd)
+        size = input_size(Path(staging or paper_path) / Path('input'))
+        if limited:
+            # Only a new job counts against the limits, so a duplicate is
+            # refused as such first.
+            if self.is_active(task_key):
+                db.session.commit()
+                return False
+            if self._is_full(journal_key, size):
+                db.session.commit()
+                self._invalidate_snapshot()
+                raise QueueFull()
+        # Reuse the row from a previous compilation of this version.
+        sql = update(CompileJob).where(and_(CompileJob.task_key == task_key,
+                                            CompileJob.status.in_([JobStatus.DONE, JobStatus.FAILED])))
+        sql = sql.values(status=JobStatus.QUEUED,
+                         args=args,
+                         next_args=next_args,
+                         priority=priority,
+                         journal_key=journal_key,
+                         engine=engine,
+                         input_size=size,
+                         enqueued_at=now,
+                         started_at=None,
+                         finished_at=None,
+                         worker_id=None,
+                         lease_expires=None,
+                         attempts=0,
+                         error=None).execution_options(synchronize_session=False)
+        if db.session.execute(sql).rowcount == 0:
+            # Either there is no row, or the job is still active. The unique
+            # index on task_key decides which.
+            try:
+                db.session.add(CompileJob(task_key=task_key,
+                                          paperid=paperid,
+                                          version=version,
+                                          args=args,
+                                          next_args=next_args,
+                                          status=JobStatus.QUEUED,
+                                          priority=priority,
+                                          journal_key=journal_key,
+                                          engine=engine,
+                                          input_size=size,
+                                          enqueued_at=now,
+                                          attempts=0))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return False
+        else:
+            db.session.commit()
+        self._invalidate_snapshot()
+        status_broker.publish(task_key, TaskStatus.PENDING.value, 'queued', 'Queued')
+        self._wakeup.set()
+        return True
+
+    def _is_full(self, journal_key: str, size: int) -> bool:
+        """Whether one more job with size bytes of inputs would exceed a
+        limit on the queued and running jobs."""
+        active = CompileJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING])
+        full = False
+        if self.max_queued is not None:
+            count = db.session.execute(select(func.count(CompileJob.id)).where(active)).scalar_one()
+            full = full or count >= self.max_queued
+        if self.max_per_journal is not None:
+            count = db.session.execute(select(func.count(CompileJob.id)).where(and_(active,
+                                                                                   CompileJob.journal_key == journal_key))).scalar_one()
+            full = full or count >= self.max_per_journal
+        if self.max_pending_bytes is not None:
+            pending = db.session.execute(select(func.sum(CompileJob.input_size)).where(active)).scalar_one() or 0
+            full = full or pending + size > self.max_pending_bytes
+        return full
+
+    def get_job(self, task_key: str):
+        return db.session.execute(select(CompileJob).where(CompileJob.task_key == task_key)).scalar_one_or_none()
+
+    def is_active(self, task_key: str) -> bool:
+        """Whether a job for task_key is queued or running."""
+        job = self.get_job(task_key)
+        return job is not None and job.status in (JobStatus.QUEUED, JobStatus.RUNNING)
+
+    def _schedule(self, now, limit=None):
+        """The claimable jobs in the order that workers will claim them,
+        or the first limit of them, and the running jobs."""
+        sql = select(CompileJob.id,
+                     CompileJob.priority,
+                     CompileJob.journal_key,
+                     CompileJob.enqueued_at,
+                     CompileJob.engine,
+                     CompileJob.input_size).where(self._claimable(now))
+        jobs = db.session.execute(sql).all()
+        sql = select(CompileJob.journal_key,
+                     CompileJob.started_at,
+                     CompileJob.engine,
+                     CompileJob.input_size).where(and_(CompileJob.status == JobStatus.RUNNING,
+                                                       CompileJob.lease_expires >= now))
+        running_jobs = db.session.execute(sql).all()
+        running = {}
+        for job in running_jobs:
+            running[job.journal_key] = running.get(job.journal_key, 0) + 1
+        return schedule(jobs, running, now, self.aging_seconds, self.share_weight, limit), running_jobs
+
+    def snapshot(self) -> QueueSnapshot:
+        """returns a QueueSnapshot that is at most COMPILER_SNAPSHOT_SECONDS
+        old, so that status polls from many browsers share one computation
+        of the schedule."""
+        with self._snapshot_lock:
+            if self._snapshot and time.monotonic() - self._snapshot_time < self.snapshot_seconds:
+                return self._snapshot
+        now = datetime.now()
+        order, running_jobs = self._schedule(now)
+        sql = select(CompileRecord.engine,
+                     CompileRecord.input_size,
+                     CompileRecord.compile_time).where(CompileRecord.compile_time != None).order_by(CompileRecord.started.desc()).limit(self.history)
+        estimator = CompileTimeEstimator(db.session.execute(sql).all())
+        sql = select(CompileJob.enqueued_at,
+                     CompileJob.started_at).where(and_(CompileJob.started_at != None,
+                                                       CompileJob.started_at >= now - timedelta(hours=1)))
+        recent_waits = [(started - enqueued).total_seconds() for enqueued, started in db.session.execute(sql).all()]
+        snap = QueueSnapshot(order, running_jobs, estimator, recent_waits, self.workers, now)
+        with self._snapshot_lock:
+            self._snapshot = snap
+            self._snapshot_time = time.monotonic()
+        return snap
+
+    def _invalidate_snapshot(self):
+        with self._snapshot_lock:
+            self._snapshot = None
+
+    def position(self, job: CompileJob) -> tuple[int, int]:
+        """returns the 1-based position of a queued job in the schedule,
+        and the number of queued or running jobs."""
+        snap = self.snapshot()
+        return snap.position(job.id), snap.depth
+
+    def admit(self, journal_key: str, upload_bytes: int, superseding: bool = False):
+        """returns None if an upload may be queued, or the estimated seconds
+        until it may be. See admission_wait."""
+        if self.max_queued is None and self.max_per_journal is None and self.max_pending_bytes is None:
+            return None
+        return admission_wait(self.snapshot(), journal_key, upload_bytes,
+                              max_queued=self.max_queued,
+                              max_per_journal=self.max_per_journal,
+                              max_bytes=self.max_pending_bytes,
+                              superseding=superseding)
+
+    def stats(self) -> dict:
+        """returns the number of jobs with each status."""
+        sql = select(CompileJob.status, func.count(CompileJob.id)).group_by(CompileJob.status)
+        counts = {status.value: 0 for status in JobStatus}
+        for status, count in db.session.execute(sql).all():
+            counts[status.value] = count
+        return counts
+
+    def _claimable(self, now):
+        return or_(CompileJob.status == JobStatus.QUEUED,
+                   and_(CompileJob.status == JobStatus.RUNNING,
+                        CompileJob.lease_expires < now))
+
+    def claim(self, worker_id: str):
+        """Claim the first claimable job in the schedule for worker_id. A job is claimable if
+        it is queued, or if the lease of the worker that claimed it expired.
+        returns the CompileJob or None."""
+        now = datetime.now()
+        # Jobs whose workers keep dying are given up on.
+        sql = update(CompileJob).where(and_(CompileJob.status == JobStatus.RUNNING,
+                                            CompileJob.lease_expires < now,
+                                            CompileJob.attempts >= self.max_attempts))
+        sql = sql.values(status=JobStatus.FAILED,
+                         finished_at=now,
+                         error='The compilation was abandoned {} times'.format(self.max_attempts))
+        db.session.execute(sql.execution_options(synchronize_session=False))
+        db.session.commit()
+        order, running_jobs = self._schedule(now, limit=10)
+        for jobid in [j.id for j in order]:
+            sql = update(CompileJob).where(and_(CompileJob.id == jobid, self._claimable(now)))
+            sql = sql.values(status=JobStatus.RUNNING,
+                             worker_id=worker_id,
+                             started_at=now,
+                             lease_expires=now + timedelta(seconds=self.lease_seconds),
+                             attempts=CompileJob.attempts + 1)
+            result = db.session.execute(sql.execution_options(synchronize_session=False))
+            db.session.commit()
+            if result.rowcount == 1:
+                self._invalidate_snapshot()
+                job = db.session.get(CompileJob, jobid, populate_existing=True)
+                metrics.observe('latex_submit_queue_wait_seconds', (now - job.enqueued_at).total_seconds())
+                status_broker.publish(job.task_key, TaskStatus.RUNNING.value, 'running', 'Compilation is running')
+                return job
+            # Another worker claimed it first.
+        return None
+
+    def heartbeat(self, jobid: int, worker_id: str) -> bool:
+        """Extend the lease of a running job. returns False if the lease was lost."""
+        sql = update(CompileJob).where(and_(CompileJob.id == jobid,
+                                            CompileJob.worker_id == worker_id,
+                                            CompileJob.status == JobStatus.RUNNING))
+        sql = sql.values(lease_expires=datetime.now() + timedelta(seconds=self.lease_seconds))
+        result = db.session.execute(sql.execution_options(synchronize_session=False))
+        db.session.commit()
+        return result.rowcount == 1
+
+    def finish(self, jobid: int, worker_id: str, error: str = None) -> bool:
+        """Mark a job as DONE, or FAILED if error is given. If a newer
+        upload superseded the job while it ran, then the job stays with
+        this worker instead, and this returns True to run it again."""
+        for _ in range(3):
+            now = datetime.now()
+            sql = update(CompileJob).where(and_(CompileJob.id == jobid,
+                                                CompileJob.worker_id == worker_id,
+                                                CompileJob.next_args != None))
+            sql = sql.values(started_at=now,
+                             lease_expires=now + timedelta(seconds=self.lease_seconds),
+                             attempts=1,
+                             error=None)
+            result = db.session.execute(sql.execution_options(synchronize_session=False))
+            db.session.commit()
+            if result.rowcount == 1:
+                return True
+            # This is conditional on next_args so that an upload cannot
+            # supersede the job between the two updates.
+            sql = update(CompileJob).where(and_(CompileJob.id == jobid,
+                                                CompileJob.worker_id == worker_id,
+                                                CompileJob.next_args == None))
+            sql = sql.values(status=JobStatus.FAILED if error else JobStatus.DONE,
+                             finished_at=now,
+                             lease_expires=None,
+                             error=error)
+            result = db.session.execute(sql.execution_options(synchronize_session=False))
+            db.session.commit()
+            if result.rowcount == 1:
+                return False
+            if not self._holds_lease(jobid, worker_id):
+                return False
+        return False
+
+    def _holds_lease(self, jobid: int, worker_id: str) -> bool:
+        sql = select(CompileJob.id).where(and_(CompileJob.id == jobid,
+                                               CompileJob.worker_id == worker_id,
+                                               CompileJob.status == JobStatus.RUNNING))
+        return db.session.execute(sql).scalar_one_or_none() is not None
+
+    def supersede(self, task_key: str, cmd: str, paper_path: str, doi: str, staging: str) -> bool:
+        """Replace the inputs of the queued or running job for task_key with
+        an upload in the staging directory. If the job has not started, then
+        it compiles the new upload instead. If it is running, the new upload
+        is compiled by the same worker right after it finishes. Only the
+        newest upload is kept. returns False if there is no queued or
+        running job, and then the caller should enqueue instead."""
+        next_args = json.dumps({'cmd': cmd, 'paper_path': paper_path, 'doi': doi, 'staging': staging})
+        for _ in range(3):
+            sql = select(CompileJob.id, CompileJob.next_args).where(and_(CompileJob.task_key == task_key,
+                                                                         CompileJob.status.in_([JobStatus.QUEUED,
+                                                                                                JobStatus.RUNNING])))
+            job = db.session.execute(sql).one_or_none()
+            db.session.commit()
+            if job is None:
+                return False
+            # Conditional on the upload we replace, so that it is not also
+            # taken by a worker.
+            sql = update(CompileJob).where(and_(CompileJob.id == job.id,
+                                                CompileJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING]),
+                                                CompileJob.next_args == job.next_args if job.next_args else CompileJob.next_args == None))
+            sql = sql.values(next_args=next_args)
+            result = db.session.execute(sql.execution_options(synchronize_session=False))
+            db.session.commit()
+            if result.rowcount == 1:
+                if job.next_args:
+                    shutil.rmtree(json.loads(job.next_args)['staging'], ignore_errors=True)
+                self._invalidate_snapshot()
+                status_broker.publish(task_key, TaskStatus.PENDING.value, 'queued',
+                                      'Queued after the previous upload')
+                return True
+        return False
+
+    def _take_next(self, jobid: int, worker_id: str, paperid: str, version: str):
+        """If an upload superseded the job, then move it into place for
+        this worker to compile. returns its args, or None."""
+        for _ in range(3):
+            next_args = db.session.execute(select(CompileJob.next_args).where(CompileJob.id == jobid)).scalar_one_or_none()
+            if next_args is None:
+                db.session.commit()
+                return None
+            sql = update(CompileJob).where(and_(CompileJob.id == jobid,
+                                                CompileJob.worker_id == worker_id,
+                                                CompileJob.next_args == next_args))
+            sql = sql.values(args=next_args, next_args=None)
+            result = db.session.execute(sql.execution_options(synchronize_session=False))
+            db.session.commit()
+            if result.rowcount == 1:
+                args = json.loads(next_args)
+                promote_upload(args.pop('staging'), args['paper_path'], paperid, version)
+                return args
+        return None
+
+    def _heartbeat_loop(self, jobid, worker_id, done):
+        with self.app.app_context():
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    if not self.heartbeat(jobid, worker_id):
+                        logging.warning('lost the lease on compile job {}'.format(jobid))
+                        return
+                except Exception as e:
+                    logging.error('heartbeat failed: ' + str(e))
+
+    def run_job(self, job: CompileJob, worker_id: str):
+        """Run a claimed job with a heartbeat to keep the lease."""
+        args = json.loads(job.args)
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, args=(job.id, worker_id, done),
+                                     name='heartbeat-{}'.format(job.id), daemon=True)
+        heartbeat.start()
+        try:
+            again = True
+            while again:
+                error = None
+                try:
+                    args = self._take_next(job.id, worker_id, job.paperid, job.version.value) or args
+                    run_latex_task(self.app.root_path,
+                                   args['cmd'],
+                                   args['paper_path'],
+                                   job.paperid,
+                                   args['doi'],
+                                   job.version.value,
+                                   job.task_key,
+                                   lambda: self._holds_lease(job.id, worker_id))
+                except Exception as e:
+                    logging.error('compile job {} failed: {}'.format(job.task_key, str(e)))
+                    error = str(e) or 'Exception in compilation'
+                # A newer upload arrived while this one was running.
+                again = self.finish(job.id, worker_id, error)
+        finally:
+            done.set()
+            heartbeat.join()
+        if error:
+            status_broker.publish(job.task_key, TaskStatus.FAILED_EXCEPTION.value, 'failed',
+                                  'An exception occurred: {}'.format(error))
+        else:
+            status_broker.publish(job.task_key, TaskStatus.FINISHED.value, 'finished',
+                                  'Compilation {}'.format(TaskStatus.FINISHED.value))
+
+    def _work(self, worker_id):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    job = self.claim(worker_id)
+                    if job is not None:
+                        self.run_job(job, worker_id)
+                        continue
+            except Exception as e:
+                logging.error('compile worker {}: {}'.format(worker_id, str(e)))
+            # Jobs enqueued by this process wake us up immediately, and jobs
+            # from other processes are found when polling.
+            self._wakeup.wait(self.poll_interval)
+            if not self._stopping.is_set():
+                self._wakeup.clear()
+
+compile_queue = JobQueue()
@@ -0,0 +1,125 @@
+"""A list of the files in the input and output directories of a version,
+with their size, mtime, sha256, and mime type. It is written to
+manifest.json in the version directory at the end of each compilation,
+and the pages that list or serve the files read it instead of walking
+the directories. The directories do not change between compilations.
+
+manifest.json looks like
+   {"input": [{"path": "main.tex", "size": 1234, "mtime": 1700000000.5,
+               "sha256": "...", "mime": "text/x-tex"}, ...],
+    "output": [...]}
+where paths are relative to the directory, and sorted.
+"""
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+from pathlib import Path
+
+MANIFEST_FILE = 'manifest.json'
+TREES = ('input', 'output')
+
+def _sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _walk(top, prefix=''):
+    """yields (relative path, os.stat_result) for the regular files under
+    top. Symlinks are skipped."""
+    with os.scandir(top) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path, prefix + entry.name + '/')
+            elif entry.is_file(follow_symlinks=False):
+                yield prefix + entry.name, entry.stat(follow_symlinks=False)
+
+def scan_tree(top, previous=None, hashes=True) -> list:
+    """returns the manifest entries for the files under top. The sha256
+    is copied from an entry in previous that has the same path, size, and
+    mtime, so unchanged input files are not read again."""
+    top = Path(top)
+    if not top.is_dir():
+        return []
+    known = {e['path']: e for e in previous or []}
+    entries = []
+    for relpath, st in _walk(top):
+        entry = {'path': relpath,
+                 'size': st.st_size,
+                 'mtime': st.st_mtime,
+                 'sha256': None,
+                 'mime': mimetypes.guess_type(relpath)[0] or 'application/octet-stream'}
+        if hashes:
+            old = known.get(relpath)
+            if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime and old.get('sha256'):
+                entry['sha256'] = old['sha256']
+            else:
+                entry['sha256'] = _sha256(top / Path(relpath))
+        entries.append(entry)
+    entries.sort(key=lambda e: e['path'])
+    return entries
+
+def read_manifest(version_dir):
+    """returns the manifest of version_dir, or None if there is none."""
+    manifest_file = Path(version_dir) / Path(MANIFEST_FILE)
+    try:
+        return json.loads(manifest_file.read_text(encoding='UTF-8'))
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logging.warning('Unreadable {}: {}'.format(str(manifest_file), str(e)))
+        return None
+
+def build_manifest(version_dir, previous=None, output_dir=None) -> dict:
+    """returns the manifest of the input and output directories of
+    version_dir without writing it. previous is an older manifest whose
+    hashes may be reused. If output_dir is given, then it is scanned
+    instead of version_dir/output, e.g. before it is moved there."""
+    version_dir = Path(version_dir)
+    previous = previous or {}
+    dirs = {'input': version_dir / Path('input'),
+            'output': Path(output_dir) if output_dir else version_dir / Path('output')}
+    return {tree: scan_tree(dirs[tree], previous.get(tree)) for tree in TREES}
+
+def write_manifest(version_dir, previous=None, manifest=None) -> dict:
+    """Scan the input and output directories of version_dir and write its
+    manifest. previous is an older manifest whose hashes may be reused.
+    If manifest is given, then it is written without scanning.
+    returns the manifest."""
+    version_dir = Path(version_dir)
+    if manifest is None:
+        manifest = build_manifest(version_dir, previous)
+    manifest_file = version_dir / Path(MANIFEST_FILE)
+    tmp = manifest_file.with_name(MANIFEST_FILE + '.tmp')
+    tmp.write_text(json.dumps(manifest), encoding='UTF-8')
+    os.replace(tmp, manifest_file)
+    return manifest
+
+def remove_manifest(version_dir):
+    """Remove the manifest of version_dir, e.g. before its output is
+    replaced. returns the manifest that was removed, or None."""
+    manifest = read_manifest(version_dir)
+    Path(version_dir, MANIFEST_FILE).unlink(missing_ok=True)
+    return manifest
+
+def get_files(version_dir, tree) -> list:
+    """returns the manifest entries of tree ('input' or 'output') in
+    version_dir. If there is no manifest, as for versions compiled before
+    manifests existed or that are compiling now, then the directory is
+    scanned without hashes."""
+    manifest = read_manifest(version_dir)
+    if manifest is not None:
+        return manifest.get(tree, [])
+    return scan_tree(Path(version_dir) / Path(tree), hashes=False)
+
+def get_file(version_dir, tree, path):
+    """returns the manifest entry for path in tree, or None if there is
+    no such file."""
+    for entry in get_files(version_dir, tree):
+        if entry['path'] == path:
+            return entry
+    return None
@@ -0,0 +1,691 @@
+"""
+Extract the cited entries of a compiled paper from its bibtex files,
+without running bibtex. This replaces running bibexport with
+wideexport.bst, and produces the same output, namely the cited entries
+in the order of citation with a fixed set of fields, followed by
+entries that are cross-referenced by them.
+
+The citations and the names of the bibtex files are read from main.aux
+(for bibtex) or main.bcf (for biblatex). Each bibtex file is scanned
+once, and only @string definitions and the entries that are needed are
+parsed. Since bibtex requires an entry to appear after the entries that
+cross-reference it, the keys from crossref fields are added to the
+needed keys as the file is scanned. As in bibtex:
+1. keys and macro names are case-insensitive.
+2. whitespace in field values is compressed to single spaces.
+3. the first of repeated entries or fields is used.
+4. fields that are missing from an entry are inherited from the entry
+   in its crossref field.
+5. months and the journals abbreviations of wideexport.bst are exported
+   as macros, and other macros are expanded.
+6. entry types that wideexport.bst does not know are dropped.
+
+Bibtex files that are shared by many papers, such as cryptobib, are
+found through BIBINPUTS. If configure_index is called, then each of
+them is indexed once into a file that maps keys to entries and has the
+@string definitions already resolved, and only the cited entries are
+read from it. An index is rebuilt when the size or modification time of
+its bibtex file changes, for example after cryptobib is updated.
+
+This module has no dependencies outside the standard library, and may
+be run from the command line on a directory with main.aux:
+  python3 bibextract.py path/to/output
+or to build the indexes for the files in BIBINPUTS:
+  python3 bibextract.py --index_dir /path/to/index --build
+"""
+
+import argparse
+from collections import ChainMap
+from collections.abc import Mapping
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+import re
+import struct
+import sys
+import threading
+import xml.etree.ElementTree as ET
+
+# The fields that are exported, in the order of wideexport.bst.
+EXPORT_FIELDS = ['address', 'author', 'booktitle', 'chapter', 'crossref', 'edition',
+                 'editor', 'howpublished', 'institution', 'journal', 'key', 'month',
+                 'note', 'number', 'organization', 'pages', 'publisher', 'school',
+                 'series', 'type', 'title', 'volume', 'year',
+                 'abstract', 'acronym', 'annote', 'biburl', 'bibsource', 'doi', 'eid',
+                 'isbn', 'issn', 'language', 'timestamp', 'url', 'urn']
+
+# The entry types that have an export function in wideexport.bst.
+EXPORT_TYPES = {'article', 'book', 'booklet', 'conference', 'habthesis', 'inbook',
+                'incollection', 'inproceedings', 'journals', 'manual', 'mastersthesis',
+                'misc', 'phdthesis', 'proceedings', 'techreport', 'unpublished'}
+
+# The macros defined in wideexport.bst. Their values are recognized
+# when the month and journal fields are written.
+STYLE_MACROS = {name: 'export-' + name for name in
+                ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct',
+                 'nov', 'dec', 'acmcs', 'acta', 'cacm', 'ibmjrd', 'ibmsj', 'ieeese',
+                 'ieeetc', 'ieeetcad', 'ipl', 'jacm', 'jcss', 'scp', 'sicomp', 'tocs',
+                 'tods', 'tog', 'toms', 'toois', 'toplas', 'tcs']}
+
+# bibtex defaults to 2, but bibexport keeps every cross-referenced entry.
+MIN_CROSSREFS = 1
+
+BCF_NS = '{https://sourceforge.net/projects/biblatex}'
+
+_AT = re.compile(r'@\s*([A-Za-z][^\s"#%\'(),={}]*)\s*([{(])')
+_KEY = re.compile(r'\s*([^\s,{}()"#%\'=]*)\s*([,})])')
+_FIELD_NAME = re.compile(r'\s*([^\s"#%\'(),={}]+)\s*=\s*')
+_MACRO_NAME = re.compile(r'[^\s"#%\'(),={}0-9][^\s"#%\'(),={}]*')
+_NUMBER = re.compile(r'[0-9]+')
+_CONCAT = re.compile(r'\s*#\s*')
+_SEPARATOR = re.compile(r'\s*(,?)\s*')
+_SPACES = re.compile(r'\s*')
+_BRACES = re.compile(r'[{}]')
+_QUOTED = re.compile(r'[{}"]')
+_WHITESPACE = re.compile(r'\s+')
+_AUX_COMMAND = re.compile(r'\\(citation|bibdata|@input)\{([^}]*)\}')
+_EXPORT_MACRO = re.compile(r'export-(.{0,3})', re.DOTALL)
+
+class BibSyntaxError(Exception):
+    pass
+
+def read_aux(aux_file: Path, citations=None, bibdata=None):
+    r"""Read \citation and \bibdata from an aux file, and from the aux
+    files that it includes with \@input. returns (citations, bibdata)
+    as lists in the order they appear."""
+    if citations is None:
+        citations = []
+        bibdata = []
+    text = aux_file.read_text(encoding='UTF-8', errors='replace')
+    for m in _AUX_COMMAND.finditer(text):
+        if m.group(1) == '@input':
+            child = aux_file.parent / Path(m.group(2))
+            if child.is_file() and child.resolve() != aux_file.resolve():
+                read_aux(child, citations, bibdata)
+        else:
+            items = [item.strip() for item in m.group(2).split(',') if item.strip()]
+            if m.group(1) == 'citation':
+                citations.extend(items)
+            else:
+                bibdata.extend(items)
+    return citations, bibdata
+
+def read_bcf(bcf_file: Path):
+    """Read the citekeys and datasources from a biblatex control
+    file. returns (citations, bibdata) like read_aux."""
+    root = ET.parse(str(bcf_file)).getroot()
+    citations = [child.text.strip() for child in root.iter(BCF_NS + 'citekey') if child.text]
+    bibdata = [child.text.strip() for child in root.iter(BCF_NS + 'datasource') if child.text]
+    return citations, bibdata
+
+def search_path_from_env():
+    """returns the directories in BIBINPUTS. Empty entries, which tell
+    kpathsea to search the texmf tree, are skipped."""
+    dirs = []
+    for d in os.environ.get('BIBINPUTS', '').split(os.pathsep):
+        d = d.rstrip('/')
+        if d and d != '.':
+            dirs.append(Path(d))
+    return dirs
+
+def find_bibfile(name: str, output_path: Path, search_path):
+    r"""Find a bibtex file named in \bibdata or a datasource. It is
+    looked up in output_path and then in search_path. returns None if it
+    is not found, or if the name is absolute or contains '..'."""
+    if not name.endswith('.bib'):
+        name = name + '.bib'
+    relpath = Path(name)
+    if relpath.is_absolute() or '..' in relpath.parts:
+        return None
+    for d in [output_path] + list(search_path):
+        candidate = Path(d) / relpath
+        if candidate.is_file():
+            return candidate
+    return None
+
+class BibReader:
+    """Scans bibtex files for the entries in wanted. Entries and
+    @string definitions accumulate over the files passed to read().
+    If parse_fields is False, then entries are only matched for braces
+    and their fields are empty, which is enough for BibIndex.build."""
+    def __init__(self, wanted, all_entries=False, parse_fields=True):
+        # lower case key -> key as cited.
+        self.wanted = {key.lower(): key for key in wanted}
+        self.all_entries = all_entries
+        self.parse_fields = parse_fields
+        # Definitions from later files come first.
+        self.macros = ChainMap({}, STYLE_MACROS)
+        self.undefined = set() # macros that were used but not defined.
+        self.preamble = []
+        self.entries = {} # lower case key -> (entry_type, key, fields)
+        self.order = [] # lower case keys in the order they were read.
+        self.crossref_counts = {} # lower case key -> number of times it is cross-referenced.
+        # The source of what was read, for BibIndex.build.
+        self.spans = {} # lower case key -> (start, end) of the entry.
+        self.raw_strings = [] # (name, text of the @string after the delimiter)
+        self.raw_preambles = [] # text of each @preamble after the delimiter.
+
+    def read(self, text: str):
+        pos = 0
+        while True:
+            m = _AT.search(text, pos)
+            if not m:
+                return
+            pos = m.end()
+            command = m.group(1).lower()
+            close = '}' if m.group(2) == '{' else ')'
+            try:
+                if command == 'comment':
+                    continue
+                if command == 'string':
+                    name, value, pos = self._parse_field(text, pos)
+                    self.macros[name] = value
+                    self.raw_strings.append((name, text[m.end():pos]))
+                    pos = self._parse_close(text, pos, close)
+                elif command == 'preamble':
+                    value, pos = self._parse_value(text, pos)
+                    self.preamble.append(value)
+                    self.raw_preambles.append(text[m.end():pos])
+                    pos = self._parse_close(text, pos, close)
+                else:
+                    km = _KEY.match(text, pos)
+                    if not km:
+                        continue
+                    lowkey = km.group(1).lower()
+                    if lowkey in self.entries or not (self.all_entries or lowkey in self.wanted):
+                        # Skip to the next @ without parsing the fields.
+                        continue
+                    pos = km.end()
+                    fields = {}
+                    if km.group(2) == ',' and not self.parse_fields and close == '}':
+                        pos = _balanced(text, m.end(), _BRACES) + 1
+                    elif km.group(2) == ',':
+                        fields, pos = self._parse_fields(text, pos, close)
+                    elif km.group(2) != close:
+                        raise BibSyntaxError('bad delimiter after key')
+                    self._add_entry(command, km.group(1), fields)
+                    self.spans[lowkey] = (m.start(), pos)
+            except BibSyntaxError:
+                # bibtex skips to the next @ after an error.
+                pos = m.end()
+
+    def _add_entry(self, entry_type, key, fields):
+        lowkey = key.lower()
+        self.entries[lowkey] = (entry_type, key, fields)
+        self.order.append(lowkey)
+        crossref = fields.get('crossref')
+        if crossref:
+            parent = crossref.lower()
+            self.crossref_counts[parent] = self.crossref_counts.get(parent, 0) + 1
+            if parent not in self.wanted:
+                self.wanted[parent] = crossref
+
+    def _parse_fields(self, text, pos, close):
+        fields = {}
+        while True:
+            if text.startswith(close, pos):
+                return fields, pos + 1
+            name, value, pos = self._parse_field(text, pos)
+            if name not in fields:
+                fields[name] = value
+            sep = _SEPARATOR.match(text, pos)
+            pos = sep.end()
+            if text.startswith(close, pos):
+                return fields, pos + 1
+            if not sep.group(1):
+                raise BibSyntaxError('expected a comma')
+
+    def _parse_close(self, text, pos, close):
+        sep = _SEPARATOR.match(text, pos)
+        if not text.startswith(close, sep.end()):
+            raise BibSyntaxError('expected ' + close)
+        return sep.end() + 1
+
+    def _parse_field(self, text, pos):
+        m = _FIELD_NAME.match(text, pos)
+        if not m:
+            raise BibSyntaxError('expected a field name')
+        value, pos = self._parse_value(text, m.end())
+        return m.group(1).lower(), value, pos
+
+    def _parse_value(self, text, pos):
+        """returns the value starting at pos after expanding macros and
+        compressing whitespace."""
+        parts = []
+        while True:
+            pos = _SPACES.match(text, pos).end()
+            c = text[pos:pos+1]
+            if c == '{':
+                end = _balanced(text, pos + 1, _BRACES)
+                parts.append(text[pos+1:end])
+                pos = end + 1
+            elif c == '"':
+                end = _balanced(text, pos + 1, _QUOTED)
+                parts.append(text[pos+1:end])
+                pos = end + 1
+            elif _NUMBER.match(text, pos):
+                m = _NUMBER.match(text, pos)
+                parts.append(m.group(0))
+                pos = m.end()
+            else:
+                m = _MACRO_NAME.match(text, pos)
+                if not m:
+                    raise BibSyntaxError('expected a value')
+                # bibtex warns about undefined macros and uses an empty string.
+                name = m.group(0).lower()
+                value = self.macros.get(name)
+                if value is None:
+                    self.undefined.add(name)
+                    value = ''
+                parts.append(value)
+                pos = m.end()
+            m = _CONCAT.match(text, pos)
+            if not m:
+                break
+            pos = m.end()
+        return _WHITESPACE.sub(' ', ''.join(parts)).strip(), pos
+
+    def read_index(self, index):
+        """Read the entries in wanted from a BibIndex. This only looks at
+        the cited entries and the macros that they use. As with read()
+        and bibtex, an entry that is only wanted because of a crossref
+        is found in this file only after the first entry that refers to
+        it."""
+        below = self.macros
+        self.macros = below.new_child(IndexMacros(index, below)).new_child()
+        for raw in index.preambles():
+            value, _ = self._parse_value(raw, 0)
+            self.preamble.append(value)
+        keys = list(self.wanted)
+        wanted = set(keys) # wanted before this file was read.
+        first = len(self.order)
+        positions = {}
+        after = {} # lower case key -> position of the first entry that cross-references it.
+        i = 0
+        while i < len(keys):
+            lowkey = keys[i]
+            i += 1
+            if lowkey in self.entries:
+                continue
+            found = index.entry(lowkey)
+            if found is None or found[0] < after.get(lowkey, found[0]):
+                continue
+            position, text = found
+            self.read(text)
+            if lowkey not in self.entries:
+                continue
+            positions[lowkey] = position
+            crossref = self.entries[lowkey][2].get('crossref')
+            if crossref and crossref.lower() not in wanted:
+                parent = crossref.lower()
+                if position < after.get(parent, position + 1):
+                    after[parent] = position
+                    keys.append(parent)
+        # Keep the entries in the order of the file, as read() would.
+        self.order[first:] = sorted(self.order[first:], key=lambda k: positions[k])
+
+    def cited_entries(self, citations, min_crossrefs=MIN_CROSSREFS):
+        """returns a list of (entry_type, key, fields) in the order that
+        bibtex would write them: the citations, then the entries that are
+        cross-referenced at least min_crossrefs times."""
+        keys = [] # (lower case key, key to write)
+        seen = set()
+        def add(lowkey, key):
+            if lowkey not in seen and lowkey in self.entries:
+                seen.add(lowkey)
+                keys.append((lowkey, key))
+        for key in citations:
+            if key == '*':
+                for lowkey in self.order:
+                    add(lowkey, self.entries[lowkey][1])
+            else:
+                add(key.lower(), key)
+        cited = set(seen)
+        for lowkey in self.order:
+            if lowkey not in cited and self.crossref_counts.get(lowkey, 0) >= min_crossrefs:
+                add(lowkey, self.entries[lowkey][1])
+        result = []
+        for lowkey, key in keys:
+            entry_type, _, fields = self.entries[lowkey]
+            crossref = fields.get('crossref')
+            if crossref:
+                fields = dict(fields)
+                parent = self.entries.get(crossref.lower())
+                if parent:
+                    for name, value in parent[2].items():
+                        if name not in fields:
+                            fields[name] = value
+                if crossref.lower() not in seen:
+                    del fields['crossref']
+            result.append((entry_type, key, fields))
+        return result
+
+def _balanced(text, pos, delimiters):
+    """returns the index of the } or " that ends a value starting at pos."""
+    depth = 0
+    for m in delimiters.finditer(text, pos):
+        c = m.group(0)
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            if depth == 0:
+                if delimiters is _BRACES:
+                    return m.start()
+                raise BibSyntaxError('unbalanced braces')
+            depth -= 1
+        elif depth == 0:
+            return m.start()
+    raise BibSyntaxError('unterminated value')
+
+class IndexMacros(Mapping):
+    """The @string definitions of a BibIndex as a mapping. Definitions
+    that use macros from other files are resolved on first use, with
+    the macros that were defined before the index was read."""
+    def __init__(self, index, below):
+        self.index = index
+        self.below = below
+        self._resolved = {}
+        self._resolving = set()
+
+    def __getitem__(self, name):
+        if name in self._resolved:
+            return self._resolved[name]
+        if name in self._resolving:
+            # A definition that uses its own name refers to the one before it.
+            raise KeyError(name)
+        resolved, text = self.index.macro(name)
+        if not resolved:
+            reader = BibReader([])
+            reader.macros = ChainMap(self, self.below)
+            self._resolving.add(name)
+            try:
+                _, text, _ = reader._parse_field(text, 0)
+            finally:
+                self._resolving.discard(name)
+        self._resolved[name] = text
+        return text
+
+    def __iter__(self):
+        return iter(self.index.macro_names())
+
+    def __len__(self):
+        return self.index.num_macros
+
+def _hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode('UTF-8'), digest_size=8).digest(), 'little')
+
+class BibIndex:
+    """A bibtex file indexed for lookup by key. The index file has a
+    header, two tables of (hash, offset, length) sorted by hash for the
+    entries and the @string definitions, the records that they point to,
+    and a list of the @preamble texts in JSON. Each entry record is the
+    lower case key, a zero byte, and the source of the entry. Each
+    @string record is the lower case name, a zero byte, and either 'v'
+    and the value, or 'r' and the source of a definition that uses
+    macros from other files. The file is memory-mapped, so a lookup only
+    reads the pages that it needs."""
+    MAGIC = b'BIBIDX01'
+    HEADER = struct.Struct('<8sQqIIQQQ')
+    RECORD = struct.Struct('<QQI')
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with self.path.open('rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.source_size, self.source_mtime_ns, self.num_entries, self.num_macros,
+         self._entries_offset, self._macros_offset, self._preamble_offset) = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError('Not a bibtex index: {}'.format(path))
+
+    def is_current(self, bibfile):
+        """returns True if bibfile has not changed since it was indexed."""
+        st = Path(bibfile).stat()
+        return st.st_size == self.source_size and st.st_mtime_ns == self.source_mtime_ns
+
+    def _lookup(self, table_offset, count, name):
+        h = _hash(name)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.RECORD.unpack_from(self._mm, table_offset + mid * self.RECORD.size)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        prefix = name.encode('UTF-8') + b'\0'
+        while lo < count:
+            rh, offset, length = self.RECORD.unpack_from(self._mm, table_offset + lo * self.RECORD.size)
+            if rh != h:
+                break
+            if self._mm[offset:offset + len(prefix)] == prefix:
+                return offset, self._mm[offset + len(prefix):offset + length].decode('UTF-8')
+            lo += 1
+        return None
+
+    def entry(self, lowkey):
+        """returns (position, source) of the entry, or None if there is
+        none. Entries are stored in the order of the file, so the
+        positions have the same order."""
+        return self._lookup(self._entries_offset, self.num_entries, lowkey)
+
+    def macro(self, name):
+        """returns (True, value) for a resolved @string definition, or
+        (False, source). Raises KeyError if name is not defined."""
+        record = self._lookup(self._macros_offset, self.num_macros, name)
+        if record is None:
+            raise KeyError(name)
+        return record[1][0] == 'v', record[1][1:]
+
+    def macro_names(self):
+        names = []
+        for i in range(self.num_macros):
+            _, offset, length = self.RECORD.unpack_from(self._mm, self._macros_offset + i * self.RECORD.size)
+            record = self._mm[offset:offset + length]
+            names.append(record[:record.index(b'\0')].decode('UTF-8'))
+        return names
+
+    def preambles(self):
+        return json.loads(self._mm[self._preamble_offset:].decode('UTF-8'))
+
+    @classmethod
+    def build(cls, bibfile, path):
+        """Index bibfile into path, and return the BibIndex."""
+        bibfile = Path(bibfile)
+        st = bibfile.stat()
+        text = bibfile.read_text(encoding='UTF-8', errors='replace')
+        reader = BibReader([], all_entries=True, parse_fields=False)
+        reader.read(text)
+        entries = [(lowkey, text[start:end]) for lowkey, (start, end) in reader.spans.items()]
+        # Resolve the @string definitions that only use macros from this
+        # file or the style. The others are kept as source.
+        resolver = BibReader([])
+        macros = {}
+        for name, raw in reader.raw_strings:
+            resolver.undefined = set()
+            _, value, _ = resolver._parse_field(raw, 0)
+            if resolver.undefined:
+                resolver.macros.pop(name, None)
+                macros[name] = 'r' + raw
+            else:
+                resolver.macros[name] = value
+                macros[name] = 'v' + value
+        tables = []
+        blob = bytearray()
+        offset = cls.HEADER.size + cls.RECORD.size * (len(entries) + len(macros))
+        for records in [entries, macros.items()]:
+            table = []
+            for name, value in records:
+                data = name.encode('UTF-8') + b'\0' + value.encode('UTF-8')
+                table.append((_hash(name), offset + len(blob), len(data)))
+                blob += data
+            table.sort()
+            tables.append(table)
+        entries_offset = cls.HEADER.size
+        macros_offset = entries_offset + cls.RECORD.size * len(entries)
+        header = cls.HEADER.pack(cls.MAGIC, st.st_size, st.st_mtime_ns, len(entries), len(macros),
+                                 entries_offset, macros_offset, offset + len(blob))
+        path = Path(path)
+        tmp = path.with_name('{}.{}.{}.tmp'.format(path.name, os.getpid(), threading.get_ident()))
+        with tmp.open('wb') as f:
+            f.write(header)
+            for table in tables:
+                for record in table:
+                    f.write(cls.RECORD.pack(*record))
+            f.write(blob)
+            f.write(json.dumps(reader.raw_preambles).encode('UTF-8'))
+        os.replace(tmp, path)
+        return cls(path)
+
+# If not None, the bibtex files in the search path are indexed in this
+# directory. See configure_index.
+_index_dir = None
+_indexes = {} # path of index -> BibIndex
+_index_lock = threading.Lock()
+
+def configure_index(index_dir):
+    """Use indexes in index_dir for the bibtex files that are found in
+    the search path, such as cryptobib. If index_dir is None then they
+    are scanned like the bibtex files of the paper."""
+    global _index_dir
+    with _index_lock:
+        _index_dir = Path(index_dir) if index_dir else None
+        _indexes.clear()
+    if _index_dir:
+        _index_dir.mkdir(parents=True, exist_ok=True)
+
+def get_index(bibfile):
+    """returns the BibIndex for bibfile, building it if it is missing or
+    bibfile has changed since it was built. returns None if indexes are
+    not configured or the index cannot be written."""
+    if _index_dir is None:
+        return None
+    bibfile = Path(bibfile).resolve()
+    digest = hashlib.sha1(str(bibfile).encode('UTF-8')).hexdigest()[:16]
+    path = _index_dir / Path('{}-{}.idx'.format(bibfile.stem, digest))
+    with _index_lock:
+        try:
+            index = _indexes.get(path)
+            if index is None and path.is_file():
+                try:
+                    index = BibIndex(path)
+                except ValueError:
+                    index = None
+            if index is None or not index.is_current(bibfile):
+                index = BibIndex.build(bibfile, path)
+            _indexes[path] = index
+            return index
+        except OSError:
+            return None
+
+def build_indexes(search_path=None):
+    """Build the indexes for all bibtex files in search_path, which
+    defaults to BIBINPUTS. returns the number of files indexed."""
+    if search_path is None:
+        search_path = search_path_from_env()
+    count = 0
+    for d in search_path:
+        for bibfile in sorted(Path(d).rglob('*.bib')):
+            if get_index(bibfile) is not None:
+                count += 1
+    return count
+
+def _export_month(value):
+    """remove.exports.from.months in wideexport.bst."""
+    parts = _EXPORT_MACRO.split(value)
+    tokens = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            tokens.append(part)
+        elif part:
+            tokens.append('{' + part + '}')
+    return ' # '.join(tokens)
+
+def _export_journal(value):
+    """remove.export.from.journals in wideexport.bst."""
+    if value.startswith('export-'):
+        return value[7:]
+    return '{' + value + '}'
+
+def format_entries(entries, preamble=None):
+    """returns the text that bibexport writes with wideexport.bst."""
+    lines = ['']
+    if preamble:
+        lines.extend([',-------------------.',
+                      '|     PREAMBLE      |',
+                      "`-------------------'",
+                      '',
+                      '@preamble{ "' + ''.join(preamble) + '"',
+                      '}',
+                      '',
+                      ',-------------------.',
+                      '|  BIBTEX ENTRIES   |',
+                      "`-------------------'",
+                      ''])
+    for entry_type, key, fields in entries:
+        if entry_type not in EXPORT_TYPES:
+            continue
+        lines.append('@{}{{{},'.format(entry_type, key))
+        for name in EXPORT_FIELDS:
+            if name not in fields:
+                continue
+            if name == 'month':
+                value = _export_month(fields[name])
+            elif name == 'journal':
+                value = _export_journal(fields[name])
+            else:
+                value = '{' + fields[name] + '}'
+            lines.append('{:<18}{},'.format('  {} = '.format(name), value))
+        lines.append('}')
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+def extract(output_path: Path, search_path=None, min_crossrefs=MIN_CROSSREFS):
+    """Extract the cited entries for the paper compiled in output_path.
+    search_path is a list of directories to look for bibtex files that
+    are not in output_path, and defaults to BIBINPUTS.
+    returns (bibtex, missing) where missing is a list of bibtex files
+    that were not found. Raises FileNotFoundError if there is no main.aux.
+    """
+    output_path = Path(output_path)
+    if search_path is None:
+        search_path = search_path_from_env()
+    bcf_file = output_path / Path('main.bcf')
+    if bcf_file.is_file():
+        citations, bibdata = read_bcf(bcf_file)
+    else:
+        citations, bibdata = read_aux(output_path / Path('main.aux'))
+    reader = BibReader([key for key in citations if key != '*'], all_entries='*' in citations)
+    missing = []
+    for name in bibdata:
+        bibfile = find_bibfile(name, output_path, search_path)
+        if bibfile is None:
+            missing.append(name)
+            continue
+        index = None
+        if not reader.all_entries and output_path not in bibfile.parents:
+            index = get_index(bibfile)
+        if index is not None:
+            reader.read_index(index)
+        else:
+            reader.read(bibfile.read_text(encoding='UTF-8', errors='replace'))
+    entries = reader.cited_entries(citations, min_crossrefs)
+    return format_entries(entries, reader.preamble), missing
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Extract the cited bibtex entries of a compiled paper')
+    argparser.add_argument('--index_dir', default=None,
+                           help='directory for the indexes of bibtex files in BIBINPUTS')
+    argparser.add_argument('--build', action='store_true',
+                           help='build the indexes for all bibtex files in BIBINPUTS')
+    argparser.add_argument('output', nargs='?',
+                           help='directory with main.aux or main.bcf')
+    args = argparser.parse_args()
+    configure_index(args.index_dir)
+    if args.build:
+        print('Indexed {} bibtex files'.format(build_indexes()), file=sys.stderr)
+    if args.output:
+        bibtex, missing = extract(Path(args.output))
+        for name in missing:
+            print('Missing bibtex file:', name, file=sys.stderr)
+        print(bibtex, end='')
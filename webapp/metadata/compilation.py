@@ -5,7 +5,7 @@ used properly.
 import json
 from pydantic import model_validator, StringConstraints, ConfigDict, BaseModel, Field, EmailStr, AnyUrl, PositiveInt
 from pydantic_extra_types.country import CountryAlpha2
-from typing import List, Optional
+from typing import Dict, List, Optional
 from typing_extensions import Annotated
 
 from datetime import datetime, timezone
@@ -275,6 +275,7 @@ class ErrorType(StrEnum):
     UNDERFULL_VBOX = 'underfull vbox'
     SERVER_WARNING = 'server warning' # produced by the server and not LaTeX itself.
     SERVER_ERROR = 'server error' # produced by the server and not LaTeX itself.
+    BUDGET_EXCEEDED = 'budget exceeded' # the compilation was killed for using too much time.
     BIBTEX_ERROR = 'bibtex_error' # produced by running bibtex or biber.
     BIBTEX_WARNING = 'bibtex_warning' # produced by running bibtex or biber.
 
@@ -330,6 +331,17 @@ class BibItem(BaseModel):
     links: List[BibLink] = Field([],
                                 title='links to biliographic services like eprint, google scholar, arxiv, mathscinet, etc')
 
+class ResourceUsage(BaseModel):
+    cpu_seconds: float = Field(...,
+                               title='CPU time used by the container during compilation')
+    peak_memory: int = Field(...,
+                             title='Peak memory use of the container in bytes',
+                             description='This is sampled, so short peaks may be missed.')
+    io_read_bytes: int = Field(0,
+                               title='Bytes read from block devices')
+    io_write_bytes: int = Field(0,
+                                title='Bytes written to block devices')
+
 class Compilation(BaseModel):
     paperid: Annotated[str, StringConstraints(min_length=3)] = Field(...,
                                           title='Globally unique paper ID constructed in review system',
@@ -364,6 +376,18 @@ class Compilation(BaseModel):
     compile_time: Optional[float] = Field(default=None,
                                           title='Number of seconds for compilation',
                                           description='May be none before it is compiled')
+    latex_passes: Optional[int] = Field(default=None,
+                                        title='Number of times latexmk ran the latex engine',
+                                        description='May be none before it is compiled')
+    resources: Optional[ResourceUsage] = Field(default=None,
+                                               title='Resources used by the compilation container',
+                                               description='From the docker stats API. May be none if stats were unavailable.')
+    timings: Dict[str, float] = Field(default={},
+                                      title='Seconds spent in each phase',
+                                      description='Phases include staging, latex, bibtex or biber, the stages in postprocess.py, and postprocess for all of them.')
+    passes_saved: Optional[int] = Field(default=None,
+                                        title='Number of latex passes saved by starting from the previous compilation',
+                                        description='Only present if COMPILER_WARM_START is enabled and there was a previous compilation.')
     engine: str = Field(default='pdflatex',
                         title='latex engine used',
                         description='Choices are currently pdflatex, lualatex, xelatex')
@@ -3,17 +3,23 @@ This defines the database models for SQLAlchemy in 2.0 style.
 """
 from datetime import datetime
 from enum import Enum
+import hashlib
+import json
+import logging
+import zlib
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import Boolean, Integer, String, Text, DateTime, UniqueConstraint, ForeignKey, Table, Column, select
+from sqlalchemy import Boolean, Integer, BigInteger, Float, String, Text, LargeBinary, DateTime, UniqueConstraint, ForeignKey, Table, Column, select, insert, delete, exists, inspect, text, and_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.sql import func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from flask_security.models import sqla as sqla
 from typing import List, Optional
 try:
-    from .compilation import PubType
+    from .compilation import PubType, Compilation
 except:
-    from compilation import PubType
+    from compilation import PubType, Compilation
 
 # This is used for testing for papers that are submitted without hotcrp.
 NO_HOTCRP = 'none'
@@ -148,6 +154,220 @@ class CompileRecord(Base):
     task_status: Mapped[TaskStatus] = mapped_column(server_default = TaskStatus.PENDING.value)
     started: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
     result: Mapped[str] = mapped_column(Text(16700000), nullable=True) # trigger longtext in mysql.
+    # These duplicate values in result so that admins can find expensive
+    # compilations without parsing the JSON of every record.
+    compile_time: Mapped[Optional[float]] = mapped_column(Float, nullable=True,
+                                                          comment='Wall clock seconds for the compilation')
+    cpu_time: Mapped[Optional[float]] = mapped_column(Float, nullable=True,
+                                                      comment='CPU seconds used by the container')
+    peak_memory: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True,
+                                                       comment='Peak memory of the container in bytes')
+    io_bytes: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True,
+                                                    comment='Bytes read and written by the container')
+    latex_passes: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    engine: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
+    input_size: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True,
+                                                      comment='Bytes in the input directory')
+    # The large fields of the compilation are kept in compile_blob, and
+    # result has the rest. error_count is NULL for records written before
+    # that, whose result has everything until migrate_compile_records runs.
+    error_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    warning_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    blob_links: Mapped[List['CompileRecordBlob']] = relationship(cascade='all, delete-orphan',
+                                                                 passive_deletes=True)
+
+    def _link_blobs(self, session, digests: dict):
+        """Point the large fields of the record at digests, a map from
+        field to digest, and delete the blobs that are no longer used."""
+        links = {link.field: link for link in self.blob_links}
+        old_digests = {link.digest for link in links.values()}
+        for field, link in links.items():
+            if field not in digests:
+                self.blob_links.remove(link)
+        for field, digest in digests.items():
+            if field in links:
+                links[field].digest = digest
+            else:
+                self.blob_links.append(CompileRecordBlob(field=field, digest=digest))
+        unused = old_digests - set(digests.values())
+        if unused:
+            session.flush()
+            for digest in unused:
+                _delete_blob_if_unused(session, digest)
+
+    def set_result(self, session, parts):
+        """Store the CompilationParts of a compilation in result and
+        compile_blob. Blobs that are no longer used by any record are
+        deleted. The caller commits the session."""
+        old_digests = {link.digest for link in self.blob_links}
+        digests = {}
+        for field, part in parts.large.items():
+            data = part.encode('UTF-8')
+            digest = hashlib.sha256(data).hexdigest()
+            if digest not in old_digests:
+                _insert_blob(session, digest, data)
+            digests[field] = digest
+        self.result = parts.compact
+        self.error_count = parts.error_count
+        self.warning_count = parts.warning_count
+        self._link_blobs(session, digests)
+
+    def copy_result(self, session, other):
+        """Share the result of another record. Blobs are not copied."""
+        self.result = other.result
+        self.error_count = other.error_count
+        self.warning_count = other.warning_count
+        self._link_blobs(session, {link.field: link.digest for link in other.blob_links})
+
+    def get_result(self, session, fields=None) -> Compilation:
+        """returns the Compilation in result. Only the large fields in
+        fields are loaded from compile_blob, and the others are left as
+        their defaults. By default all are loaded."""
+        data = json.loads(self.result)
+        if self.error_count is not None:
+            if fields is None:
+                wanted = self.blob_links
+            else: # this avoids loading the links for fields=[].
+                wanted = [link for link in self.blob_links if link.field in fields] if fields else []
+            if wanted:
+                sql = select(CompileBlob).where(CompileBlob.digest.in_([link.digest for link in wanted]))
+                blobs = {blob.digest: blob for blob in session.execute(sql).scalars()}
+                for link in wanted:
+                    blob = blobs.get(link.digest)
+                    if blob is None:
+                        logging.error('compile_record {} is missing the blob {} for {}'.format(self.id, link.digest, link.field))
+                    else:
+                        data.update(json.loads(zlib.decompress(blob.data)))
+            data.setdefault('warning_log', [])
+        return Compilation.model_validate(data)
+
+# Fields of Compilation that can be large. These are stored in
+# compile_blob unless their JSON is shorter than BLOB_MIN_BYTES.
+BLOB_FIELDS = ('log', 'bibtex', 'bibhtml', 'warning_log')
+BLOB_MIN_BYTES = 1024
+
+class CompilationParts:
+    """A Compilation serialized once, as the JSON of the fields that are
+    kept in compile_record.result and the JSON of each large field."""
+    def __init__(self, compilation: Compilation):
+        small = [compilation.model_dump_json(exclude=set(BLOB_FIELDS), exclude_none=True)]
+        self.large = {}
+        for field in BLOB_FIELDS:
+            part = compilation.model_dump_json(include={field}, exclude_none=True)
+            if part == '{}':
+                continue
+            if len(part) < BLOB_MIN_BYTES:
+                small.append(part)
+            else:
+                self.large[field] = part
+        self.compact = _join_json(small)
+        self.error_count = len(compilation.error_log)
+        self.warning_count = len(compilation.warning_log)
+
+    def json(self) -> str:
+        """returns the JSON of the whole compilation, as in compilation.json."""
+        return _join_json([self.compact] + list(self.large.values()))
+
+def _join_json(parts) -> str:
+    """Join JSON objects that have no keys in common."""
+    return '{' + ','.join([p[1:-1] for p in parts if p != '{}']) + '}'
+
+class CompileBlob(Base):
+    """The JSON of a large field of a compilation, e.g. {"log": "..."}.
+    Rows are named by the sha256 of the JSON, so identical values are
+    stored once, e.g. when the final version is copied from the candidate."""
+    __tablename__ = 'compile_blob'
+    digest: Mapped[str] = mapped_column(String(64), primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary(16700000), nullable=False,
+                                        comment='zlib compressed JSON')
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False,
+                                      comment='Bytes of JSON before compression')
+
+class CompileRecordBlob(Base):
+    """Links a CompileRecord to the CompileBlob of one of its large fields.
+    The foreign key on digest keeps a blob from being deleted while a
+    record uses it."""
+    __tablename__ = 'compile_record_blob'
+    record_id: Mapped[int] = mapped_column(ForeignKey('compile_record.id', ondelete='CASCADE'), primary_key=True)
+    field: Mapped[str] = mapped_column(String(32), primary_key=True)
+    digest: Mapped[str] = mapped_column(ForeignKey('compile_blob.digest'), nullable=False, index=True)
+
+def _insert_blob(session, digest, data):
+    """Insert a blob unless it exists. Another process may store the same
+    blob at the same time, e.g. for two versions with the same log, so
+    this is a single statement that ignores a duplicate digest rather than
+    a check followed by an insert."""
+    values = {'digest': digest, 'data': zlib.compress(data), 'size': len(data)}
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        sql = sqlite.insert(CompileBlob).values(values).on_conflict_do_nothing()
+    elif dialect == 'postgresql':
+        sql = postgresql.insert(CompileBlob).values(values).on_conflict_do_nothing()
+    else: # mysql
+        sql = insert(CompileBlob).values(values).prefix_with('IGNORE')
+    session.execute(sql)
+
+def _delete_blob_if_unused(session, digest):
+    """Delete a blob unless a record links to it. This is a single
+    statement, so a record that links to the blob at the same time either
+    keeps it or fails on the foreign key."""
+    sql = delete(CompileBlob).where(and_(CompileBlob.digest == digest,
+                                         ~exists().where(CompileRecordBlob.digest == digest)))
+    session.execute(sql.execution_options(synchronize_session=False))
+
+class JobStatus(str, Enum):
+    """Status of a job in the compile queue."""
+    QUEUED = 'QUEUED'       # waiting for a worker
+    RUNNING = 'RUNNING'     # claimed by a worker that holds a lease
+    DONE = 'DONE'           # run_latex_task returned
+    FAILED = 'FAILED'       # an exception, or the lease expired too many times
+
+class CompileJob(Base):
+    """A compilation waiting for or claimed by a worker. There is at most
+    one row for each paper version, and it is reused when the paper is
+    compiled again. Workers in any process claim jobs with a conditional
+    update, and hold a lease that they extend while the job runs. If the
+    worker dies then the lease expires and another worker claims it."""
+    __tablename__ = 'compile_job'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    task_key: Mapped[str] = mapped_column(String(64), unique=True, nullable=False,
+                                          comment='paperid/version from paper_key')
+    paperid: Mapped[str] = mapped_column(ForeignKey('paper_status.paperid', ondelete='CASCADE'), nullable=False)
+    version: Mapped[Version] = mapped_column(nullable=False)
+    args: Mapped[str] = mapped_column(Text, nullable=False,
+                                      comment='JSON with cmd, paper_path, and doi for run_latex_task')
+    status: Mapped[JobStatus] = mapped_column(nullable=False, index=True)
+    priority: Mapped[Optional[int]] = mapped_column(Integer, nullable=True,
+                                                    comment='Priority class from job_queue. Lower runs first.')
+    journal_key: Mapped[Optional[str]] = mapped_column(String(32), nullable=True,
+                                                       comment='PaperStatus.journal_key, used for fair sharing between journals.')
+    # A newer upload that supersedes this one. It has the same keys as
+    # args, plus the directory that the upload is staged in.
+    next_args: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # These are used to estimate how long the job will take.
+    engine: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
+    input_size: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    enqueued_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    started_at: Mapped[Optional[datetime]] = mapped_column(DateTime(), nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime(), nullable=True)
+    worker_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True,
+                                                     comment='host:pid:thread of the worker holding the lease')
+    lease_expires: Mapped[Optional[datetime]] = mapped_column(DateTime(), nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+class RemoteWorker(Base):
+    """A compile worker service on another host (see compiler/remote.py).
+    The service updates its row every few seconds, and compilations are
+    sent to the workers that were seen recently."""
+    __tablename__ = 'remote_worker'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    url: Mapped[str] = mapped_column(String(255), unique=True, nullable=False)
+    capacity: Mapped[int] = mapped_column(Integer, nullable=False,
+                                          comment='Compilations the worker runs at the same time')
+    active: Mapped[int] = mapped_column(Integer, default=0,
+                                        comment='Compilations running when it last registered')
+    last_seen: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
 
 class DiscussionStatus(str, Enum):
     """Status of a copyedit discussion item."""
@@ -309,3 +529,75 @@ class Issue(Base):
     papers: Mapped[List['PaperStatus']] = relationship(back_populates='issue')
     description: Mapped[Optional[str]] = mapped_column(Text, nullable=True,
                                                        comment='For example, "Special issue on secure messaging"')
+
+def upgrade_schema(engine):
+    """create_all does not add columns to existing tables, so add any
+    nullable columns that are missing. This covers the columns added to
+    existing tables since the schema was first deployed."""
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                coltype = column.type.compile(dialect=engine.dialect)
+                conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, column.name, coltype)))
+
+def _count_log(result, field) -> int:
+    """The length of a list in the JSON of a record that is not a valid
+    Compilation, or 0."""
+    try:
+        return len(json.loads(result).get(field) or [])
+    except (TypeError, ValueError, AttributeError):
+        return 0
+
+def migrate_compile_records(session, batch_size=50) -> int:
+    """Move the large fields of records written before compile_blob
+    existed into it. This is safe to run from several processes at once.
+    returns the number of records that were converted."""
+    converted = 0
+    try:
+        while True:
+            comprecs = session.execute(select(CompileRecord).where(CompileRecord.error_count == None).limit(batch_size)).scalars().all()
+            if not comprecs:
+                break
+            for comprec in comprecs:
+                try:
+                    compilation = Compilation.model_validate_json(comprec.result) if comprec.result else None
+                except ValueError as e:
+                    logging.warning('unable to migrate compile_record {}: {}'.format(comprec.id, str(e)))
+                    compilation = None
+                if compilation:
+                    comprec.set_result(session, CompilationParts(compilation))
+                    converted += 1
+                else: # leave result as it is.
+                    comprec.error_count = _count_log(comprec.result, 'error_log')
+                    comprec.warning_count = _count_log(comprec.result, 'warning_log')
+            session.commit()
+    except SQLAlchemyError as e:
+        # Most likely another process is migrating the same records.
+        session.rollback()
+        logging.warning('migration of compile_record stopped: {}'.format(str(e)))
+    return converted
+
+def delete_unused_blobs(session) -> int:
+    """Delete the blobs that no record links to, e.g. after papers were
+    deleted. Blobs are otherwise deleted when a record stops using them.
+    returns the number of blobs that were deleted."""
+    try:
+        # Links of deleted records, if the database did not cascade.
+        sql = delete(CompileRecordBlob).where(~exists().where(CompileRecord.id == CompileRecordBlob.record_id))
+        session.execute(sql.execution_options(synchronize_session=False))
+        sql = delete(CompileBlob).where(~exists().where(CompileRecordBlob.digest == CompileBlob.digest))
+        deleted = session.execute(sql.execution_options(synchronize_session=False)).rowcount
+        session.commit()
+        return deleted
+    except SQLAlchemyError as e:
+        # A blob was linked by another process while it was deleted.
+        session.rollback()
+        logging.warning('deleting unused compile_blob stopped: {}'.format(str(e)))
+        return 0
@@ -4,13 +4,8 @@ Library for handling output meta file from compiling latex.
 
 from nameparser import HumanName
 from arxiv_latex_cleaner import arxiv_latex_cleaner
-import random
 import re
-import shutil
-import string
 import sys
-import tempfile
-import xml.etree.ElementTree as ET
 from pylatexenc import latexwalker
 from pylatexenc.latex2text import LatexNodes2Text, get_default_latex_context_db, MacroTextSpec, EnvironmentTextSpec, SpecialsTextSpec
 
@@ -19,13 +14,14 @@ assert sys.version_info >= (3,9)
 
 try:
     from .compilation import CompileError, ErrorType, Compilation
+    from . import bibextract
 except Exception as e:
     from compilation import CompileError, ErrorType, Compilation
+    import bibextract
 
 from pathlib import Path
 import os
 import re
-import subprocess
 
 def get_key_val(line):
     """If line has form key: value, then return key, value."""
@@ -38,80 +34,28 @@ def get_key_val(line):
 
 def extract_bibtex(root_path: str, output_path: Path, compilation: Compilation):
     """This is used to populate the bibtex field of compilation.
-     This implementation uses bibexport, which is only supported
-     under bibtex (not biber). In order to overcome this, we create a
-     temporary aux file that can be processed by bibexport. An
-     alternative implementation could be built by parsing the aux
-     file to extract the \bibcite entries, and then use pybtex or
-     another parser to parse the bibtex files and extract the
-     entries. We chose to use bibexport because it is the fastest and
-     most reliable parser of bibtex.
+     The citations are read from main.aux (bibtex) or main.bcf
+     (biblatex), and the cited entries are extracted from the bibtex
+     files in output_path or BIBINPUTS by bibextract. This produces
+     the same output as bibexport with wideexport.bst, but without
+     running bibtex in a subprocess. root_path is not used.
     """
     try:
-        auxfilename = 'main.aux'
-        aux_file = output_path / Path('main.aux')
-        if not aux_file.is_file():
+        if not (output_path / Path('main.aux')).is_file():
             compilation.error_log.append(CompileError(error_type=ErrorType.LATEX_ERROR,
                                                       logline=0,
                                                       text='Missing aux file'))
             return
-        # We use a custom "wideexport" for bibexport. It needs to be in the path for
-        # bibexport to find it, so we copy it to the current output_path with a random filename
-        # and remove it when we are done.
-        bibtex_style_file = Path(root_path) / Path('metadata/wideexport.bst')
-        bst_filename = 'bst_' + ''.join(random.choices(string.ascii_uppercase, k=10)) + '.bst'
-        bst_file = output_path / Path(bst_filename)
-        shutil.copy(bibtex_style_file, bst_file)
-        bcf_file = output_path / Path('main.bcf')
-        if bcf_file.is_file():
-            # In this case the author used biblatex/biber, so we
-            # create a temporary auxfile to use for bibexport.
-            cite_keys = set()
-            bibsources = []
-            tree = ET.parse(str(bcf_file))
-            root = tree.getroot()
-            for child in root.iter('{https://sourceforge.net/projects/biblatex}citekey'):
-                cite_keys.add(child.text)
-            for child in root.iter('{https://sourceforge.net/projects/biblatex}datasource'):
-                bibsources.append(child.text)
-            bibsources = ','.join([a[:-4] for a in bibsources])
-            auxfilename = 'tmp_' + ''.join(random.choices(string.ascii_uppercase, k=10)) + '.aux'
-            aux_file = output_path / Path(auxfilename)
-            cite_keys = list(cite_keys)
-            tmpauxlines = ['\\citation{' + key + '}' for key in cite_keys]
-            tmpauxlines.append('\\bibstyle{plain}')
-            tmpauxlines.append('\\bibdata{' + bibsources + '}')
-            tmpauxlines.extend(['\\bibcite{' + cite_keys[i] + '}{' + str(i) + '}' for i in range(len(cite_keys))])
-            tmpauxcontents = '\n'.join(tmpauxlines) + '\n'
-            aux_file.write_text(tmpauxcontents, encoding='UTF-8', errors='replace')
-        with tempfile.TemporaryDirectory() as tmpdir:
-            bibfile = tmpdir / Path('main.bib')
-            args = ['bibexport', '-b', bst_filename, '-o', str(bibfile.resolve()), auxfilename]
-            process = subprocess.run(args,
-                                     cwd=output_path.resolve(),
-                                     encoding='UTF-8',
-                                     errors='replace',
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT)
-            if auxfilename != 'main.aux':
-                aux_file.unlink()
-            if process.returncode:
-                compilation.error_log.append(CompileError(error_type=ErrorType.SERVER_ERROR,
-                                                          logline=0,
-                                                          text='Error in bibexport {}:{}'.format(process.returncode,
-                                                                                                 process.stdout)))
-            if bibfile.is_file():
-                compilation.bibtex = bibfile.read_text(encoding='UTF-8', errors='replace')
-            else:
-                compilation.error_log.append(CompileError(error_type=ErrorType.SERVER_ERROR,
-                                                          logline=0,
-                                                          text='No output from bibexport: {}'.format(process.stdout)))
+        bibtex, missing = bibextract.extract(output_path)
+        for name in missing:
+            compilation.error_log.append(CompileError(error_type=ErrorType.BIBTEX_ERROR,
+                                                      logline=0,
+                                                      text='Unable to find bibtex file {}'.format(name)))
+        compilation.bibtex = bibtex
     except Exception as e:
         compilation.error_log.append(CompileError(error_type=ErrorType.BIBTEX_ERROR,
                                                   logline=0,
                                                   text='Error checking in extract_bibtex: {}. This may be a bug'.format(str(e))))
-    finally:
-        bst_file.unlink()
 
 
 
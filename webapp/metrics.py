@@ -0,0 +1,190 @@
+"""Counters and histograms for the compile pipeline, exposed in the
+Prometheus text format at /metrics. The values are kept in a small
+sqlite database on local disk, so that all WSGI and worker processes
+on a host add to the same values. Gauges like the depth of the queue
+are read from the database when /metrics is scraped.
+
+Recording a value never raises, because metrics must not break a
+request or a compilation.
+"""
+
+import hmac
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+from flask import Blueprint, Response, request, abort
+from flask import current_app as app
+from flask_security import current_user
+from .metadata.db_models import Role
+
+metrics_bp = Blueprint('metrics_bp', __name__)
+
+SECONDS_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+SHORT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+# name => (type, help, histogram buckets)
+METRICS = {
+    'latex_submit_uploads_total': ('counter', 'Uploads by version and outcome.', None),
+    'latex_submit_compilations_total': ('counter', 'Finished compilations by CompileStatus and engine.', None),
+    'latex_submit_compile_errors_total': ('counter', 'Errors in finished compilations by ErrorType.', None),
+    'latex_submit_compile_seconds': ('histogram', 'Seconds that latexmk ran.', SECONDS_BUCKETS),
+    'latex_submit_phase_seconds': ('histogram', 'Seconds in each phase of a compilation.', SECONDS_BUCKETS),
+    'latex_submit_postprocess_seconds': ('histogram', 'Seconds of post-processing after latexmk.', SHORT_BUCKETS),
+    'latex_submit_queue_wait_seconds': ('histogram', 'Seconds from enqueue to claim by a worker.', SECONDS_BUCKETS),
+    'latex_submit_exports_total': ('counter', 'Issue exports by outcome.', None),
+    'latex_submit_export_seconds': ('histogram', 'Seconds to export an issue.', SECONDS_BUCKETS),
+}
+
+def _label_key(labels):
+    return json.dumps(labels or {}, sort_keys=True)
+
+def _format_labels(labels, extra=None):
+    items = sorted((labels or {}).items()) + (extra or [])
+    if not items:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                           for k, v in items]) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class MetricsStore:
+    """The values of all metrics in a sqlite database at path. Each row is
+    one counter, or one bucket, the sum, or the count of a histogram."""
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS sample (name TEXT, labels TEXT, bucket TEXT, value REAL, '
+                     'PRIMARY KEY (name, labels, bucket))')
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            # WAL lets readers work while another process writes.
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def add(self, rows):
+        """Add value to each (name, labels, bucket, value) in rows."""
+        conn = self._conn()
+        with conn:
+            conn.executemany('INSERT INTO sample (name, labels, bucket, value) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (name, labels, bucket) DO UPDATE SET value = value + excluded.value',
+                             rows)
+
+    def samples(self):
+        """returns a list of (name, labels, bucket, value)."""
+        return self._conn().execute('SELECT name, labels, bucket, value FROM sample ORDER BY name, labels').fetchall()
+
+class Metrics:
+    def __init__(self):
+        self.store = None
+
+    def init_app(self, app):
+        path = app.config.get('METRICS_DB') or Path(app.config['DATA_DIR']) / Path('metrics.sqlite')
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.store = MetricsStore(path)
+        except Exception as e:
+            logging.error('metrics are disabled: ' + str(e))
+            self.store = None
+
+    def inc(self, name, labels=None, value=1):
+        if self.store is None:
+            return
+        try:
+            self.store.add([(name, _label_key(labels), '', value)])
+        except Exception as e:
+            logging.warning('unable to record {}: {}'.format(name, str(e)))
+
+    def observe(self, name, value, labels=None):
+        """Add value to a histogram."""
+        if self.store is None or value is None:
+            return
+        key = _label_key(labels)
+        rows = [(name, key, str(le), 1) for le in METRICS[name][2] if value <= le]
+        rows += [(name, key, '+Inf', 1), (name, key, 'sum', value), (name, key, 'count', 1)]
+        try:
+            self.store.add(rows)
+        except Exception as e:
+            logging.warning('unable to record {}: {}'.format(name, str(e)))
+
+    def record_compilation(self, compilation, cached=False):
+        """Update the metrics from a finished Compilation."""
+        labels = {'status': compilation.status, 'engine': compilation.engine, 'cached': str(cached).lower()}
+        self.inc('latex_submit_compilations_total', labels)
+        for error in compilation.error_log:
+            self.inc('latex_submit_compile_errors_total', {'error_type': error.error_type})
+        if cached:
+            return
+        if compilation.compile_time is not None and compilation.compile_time >= 0:
+            self.observe('latex_submit_compile_seconds', compilation.compile_time, {'engine': compilation.engine})
+        for phase, seconds in compilation.timings.items():
+            if phase == 'postprocess':
+                self.observe('latex_submit_postprocess_seconds', seconds)
+            else:
+                self.observe('latex_submit_phase_seconds', seconds, {'phase': phase})
+
+    def render(self, gauges=None):
+        """returns the metrics in the Prometheus text format. gauges is a
+        list of (name, help, labels, value) to add."""
+        samples = {}
+        if self.store is not None:
+            for name, labels, bucket, value in self.store.samples():
+                samples.setdefault(name, []).append((json.loads(labels), bucket, value))
+        lines = []
+        for name, (kind, help, buckets) in METRICS.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, bucket, value in samples.get(name, []):
+                if kind == 'counter':
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+                elif bucket in ('sum', 'count'):
+                    lines.append('{}_{}{} {}'.format(name, bucket, _format_labels(labels), _format_value(value)))
+            if kind == 'histogram':
+                # Buckets are stored only when they are incremented, so
+                # fill in the cumulative values for the others.
+                by_labels = {}
+                for labels, bucket, value in samples.get(name, []):
+                    if bucket not in ('sum', 'count'):
+                        by_labels.setdefault(_label_key(labels), {})[bucket] = value
+                for key, values in by_labels.items():
+                    labels = json.loads(key)
+                    for le in [str(b) for b in buckets] + ['+Inf']:
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', le)]),
+                                                             _format_value(values.get(le, 0))))
+        for name, help, gauge_values in gauges or []:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in gauge_values:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def show_metrics():
+    """For a Prometheus scraper with METRICS_TOKEN as a bearer token, or for
+    a logged in admin."""
+    token = app.config.get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    if not ((token and hmac.compare_digest(authorization, 'Bearer ' + token)) or
+            (current_user.is_authenticated and current_user.has_role(Role.ADMIN))):
+        abort(403)
+    from .job_queue import compile_queue
+    gauges = []
+    try:
+        snapshot = compile_queue.snapshot()
+        gauges.append(('latex_submit_queue_jobs', 'Compile jobs by status.',
+                       [({'status': status}, count) for status, count in compile_queue.stats().items()]))
+        gauges.append(('latex_submit_queue_oldest_wait_seconds', 'Seconds that the oldest queued job has waited.',
+                       [({}, snapshot.oldest_wait)]))
+    except Exception as e:
+        logging.warning('unable to read the compile queue: ' + str(e))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,344 @@
+"""Post-processing of the output of latexmk. The steps are stages in a
+small dependency graph, and stages whose dependencies are finished run
+concurrently in a thread pool. The stages are short and mostly read
+files, so threads are enough. The bibexport stage extracts the cited
+entries with metadata/bibextract.py rather than running bibexport.
+Each stage works on its own data, and the results are merged into the
+Compilation in a fixed order at the end, so the order
+of errors does not depend on which stage finished first.
+
+    latex_log ──┐
+    bibtex_log ─┤
+    bibexport ──┼── bibhtml ──┬── merge
+    citation_map┘             │
+    metadata ─────────────────┘
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import contextvars
+import logging
+from pathlib import Path
+import time
+from urllib.parse import urlencode
+from .metadata.latex.iacrcc.parser import meta_parse
+from .metadata.meta_parse import clean_abstract, extract_bibtex
+from .bibmarkup import bibtex_to_html, get_citation_map
+from .metadata.xml_meta import validate_abstract
+from .metadata.compilation import Meta, CompileStatus, VersionEnum, CompileError, ErrorType, LicenseEnum, ResourceUsage
+from .log_parser import LatexLogParser, BibTexLogParser
+from .compiler.tracing import span
+
+def is_fatal(err):
+    """This is used to classify log messages as "fatal" meaning they need to
+       be corrected by the author. Some are indications that the compilation
+       failed, but others like missing references are deemed fatal by this
+       implementation. This is a policy decision."""
+    if err.error_type in (ErrorType.METADATA_ERROR,
+                          ErrorType.LATEX_ERROR,
+                          ErrorType.REFERENCE_ERROR,
+                          ErrorType.SERVER_ERROR,
+                          ErrorType.BIBTEX_ERROR):
+        return True
+    # if err.error_type == ErrorType.OVERFULL_HBOX and err.severity > 40:
+    #     return True
+    # if err.error_type == ErrorType.OVERFULL_VBOX and err.severity > 100:
+    #     return True
+    if err.text == 'LaTeX Warning: There were undefined references.':
+        return True
+    return False
+
+class Stage:
+    """A step of post-processing. func is called with the results of the
+    stages named in deps as keyword arguments."""
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+class StageFailed:
+    """The result of a stage that raised an exception, or whose
+    dependency failed."""
+    def __init__(self, error):
+        self.error = error
+
+def _timed(stage, kwargs):
+    start = time.time()
+    try:
+        with span(stage.name):
+            result = stage.func(**kwargs)
+    except Exception as e:
+        logging.error('post-processing stage {} failed: {}'.format(stage.name, str(e)))
+        result = StageFailed(e)
+    return result, round(time.time() - start, 2)
+
+def run_stages(stages, max_workers=4):
+    """Run the stages in a thread pool, each one as soon as its
+    dependencies are finished. A stage is skipped if a dependency failed.
+    returns: a dict from stage name to result, and a dict from stage name
+    to seconds."""
+    results = {}
+    timings = {}
+    pending = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in pending:
+                raise ValueError('stage {} depends on unknown stage {}'.format(stage.name, dep))
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='postprocess') as executor:
+        while pending or futures:
+            for name, stage in list(pending.items()):
+                if all([dep in results for dep in stage.deps]):
+                    del pending[name]
+                    failed = [results[dep] for dep in stage.deps if isinstance(results[dep], StageFailed)]
+                    if failed:
+                        results[name] = StageFailed(failed[0].error)
+                        continue
+                    kwargs = {dep: results[dep] for dep in stage.deps}
+                    # The stage runs in the context of the caller, so that
+                    # its spans are in the caller's trace.
+                    futures[executor.submit(contextvars.copy_context().run, _timed, stage, kwargs)] = name
+            if not futures:
+                if pending:
+                    raise ValueError('cycle in stages: {}'.format(', '.join(pending.keys())))
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                results[name], timings[name] = future.result()
+    return results, timings
+
+def _parse_latex_log(output_path):
+    """returns the errors from main.log, or None if there is no log."""
+    logfile = output_path / 'main.log'
+    if not logfile.is_file():
+        return None
+    # Note: the class_file will be updated when it runs.
+    logparser = LatexLogParser(main_file='main.tex', class_file='iacrcc.cls')
+    logparser.parse_file(logfile)
+    return logparser.errors
+
+def _parse_bibtex_log(output_path):
+    """returns the errors from main.blg, or None if there is no log."""
+    biblogfile = output_path / Path('main.blg')
+    if not biblogfile.is_file():
+        return None
+    biblog_parser = BibTexLogParser()
+    biblog_parser.parse_file(biblogfile)
+    return biblog_parser.errors
+
+def _scratch(compilation):
+    """A copy of compilation with empty logs, for a stage to update."""
+    return compilation.model_copy(update={'error_log': [],
+                                          'warning_log': [],
+                                          'bibtex': None,
+                                          'bibhtml': [],
+                                          'meta': None})
+
+def _bibexport(root_path, output_path, compilation):
+    scratch = _scratch(compilation)
+    extract_bibtex(root_path, output_path, scratch)
+    return scratch
+
+def _bibhtml(bibexport, citation_map):
+    # bibexport is not used by any other stage, so it is safe to update.
+    bibtex_to_html(bibexport, citation_map)
+    return bibexport
+
+def _metadata(output_path, compilation, doi):
+    """Parse main.meta and main.abstract. returns a scratch Compilation with
+    meta, the errors to append, and the warnings to put first, and a status
+    that is METADATA_FAIL or METADATA_PARSE_FAIL if those happened. Otherwise
+    the status is None, and it is decided when merging."""
+    scratch = _scratch(compilation)
+    metafile = output_path / Path('main.meta')
+    if not metafile.is_file():
+        scratch.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
+                                              logline=0,
+                                              text='No metadata file. Are you sure you used the correct document class?'))
+        return scratch, CompileStatus.METADATA_FAIL
+    try:
+        metastr = metafile.read_text(encoding='UTF-8', errors='replace')
+        with span('parse_meta'):
+            data = meta_parse.parse_meta(metastr)
+        abstract_file = Path(output_path) / Path('main.abstract')
+        if not abstract_file.is_file():
+            scratch.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
+                                                  logline=0,
+                                                  text='The textabstract environment is required.'))
+        else:
+            with span('clean_abstract'):
+                data['abstract'] = clean_abstract(abstract_file.read_text(encoding='UTF-8', errors='replace'))
+            with span('validate_abstract'):
+                valid = validate_abstract(data['abstract'])
+            if not valid:
+                scratch.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
+                                                      logline=0,
+                                                      text='The textabstract environment contains illegal macros or environments. See the HTML tab.'))
+        if 'license' not in data:
+            scratch.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
+                                                  logline=0,
+                                                  text='A license is required.'))
+        else:
+            try:
+                # Translate license keys from iacrcc.cls to keys in LicenseEnum.
+                data['license'] = LicenseEnum.license_from_iacrcc(data['license'])
+            except ValueError:
+                try:
+                    data['license'] = LicenseEnum.license_from_spdx(data['license'])
+                except ValueError:
+                    scratch.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
+                                                          logline=0,
+                                                          text='Unrecognized SPDX license identifier'))
+        scratch.meta = Meta(**data)
+        scratch.meta.DOI = doi
+        # Check authors to see if they have ORCID and affiliations.
+        for author in scratch.meta.authors:
+            if not author.orcid:
+                scratch.warning_log.insert(0, CompileError(error_type=ErrorType.METADATA_WARNING,
+                                                           logline=0,
+                                                           help='See <a target="_blank" href="https://orcid.org/orcid-search/search?{}">ORCID search</a> and <a target="_blank" href="https://publish.iacr.org/iacrcc">iacrcc latex documentation</a>.'.format(urlencode({'searchQuery': author.name})),
+                                                           text='author {} is lacking an ORCID. They are strongly recommended for all authors.'.format(author.name)))
+            if not author.affiliations:
+                scratch.warning_log.insert(0, CompileError(error_type=ErrorType.METADATA_WARNING,
+                                                           logline=0,
+                                                           text='author {} is lacking an affiliation'.format(author.name)))
+            else:
+                for affindex in author.affiliations:
+                    aff = scratch.meta.affiliations[affindex-1]
+                    if not aff.ror:
+                        scratch.warning_log.insert(0, CompileError(error_type=ErrorType.METADATA_WARNING,
+                                                                   logline=0,
+                                                                   text='affiliation {} may have a ROR ID'.format(aff.name),
+                                                                   help='See <a href="https://ror.org/search?{}" target="_blank">ROR search</a> and <a target="_blank" href="https://publish.iacr.org/iacrcc">iacrcc latex documentation</a>.'.format(urlencode({'query': aff.name}))))
+        if scratch.meta.version != VersionEnum.FINAL:
+            scratch.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
+                                                  logline=0,
+                                                  text='Paper should use documentclass[version=final]',
+                                                  help='See <a href="/iacrcc">the documentation for iacrcc.cls</a>'))
+    except Exception as me:
+        scratch.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
+                                              logline=0,
+                                              text='Failure to extract metadata: ' + str(me)))
+        return scratch, CompileStatus.METADATA_PARSE_FAIL
+    return scratch, None
+
+def process_output(root_path, compilation, output, output_path, execution_time, doi, output_files=None):
+    """Update compilation from the output of runner.run_latex. This parses
+    the latex and bibtex logs, extracts the bibliography, and parses the
+    metadata. The seconds for each stage are added to compilation.timings,
+    and 'postprocess' is the total. output_files are the paths from the
+    manifest, and output_path is scanned if they are not given."""
+    start_time = time.time()
+    compilation.compile_time = execution_time
+    compilation.timings = dict(output.get('phases') or {})
+    compilation.latex_passes = output.get('latex_passes')
+    if output.get('resources'):
+        compilation.resources = ResourceUsage.model_validate(output['resources'])
+    compilation.log = output.get('log', 'no log')
+    if output_files is None:
+        output_files = sorted([str(p.relative_to(str(output_path))) for p in output_path.rglob('*') if p.is_file()])
+    compilation.output_files = output_files
+    compilation.exit_code = output.get('exit_code', -1)
+    exceeded = output.get('budget_exceeded')
+    # The bibliography and metadata are only extracted from a compilation
+    # that did not fail, and that is known before any stage runs.
+    failed = bool(output.get('errors', []) or exceeded or compilation.exit_code != 0)
+    stages = [Stage('latex_log', lambda: _parse_latex_log(output_path)),
+              Stage('bibtex_log', lambda: _parse_bibtex_log(output_path))]
+    if not failed:
+        stages += [Stage('bibexport', lambda: _bibexport(root_path, output_path, compilation)),
+                   Stage('citation_map', lambda: get_citation_map(output_path)),
+                   Stage('bibhtml', _bibhtml, deps=['bibexport', 'citation_map']),
+                   Stage('metadata', lambda: _metadata(output_path, compilation, doi))]
+    results, timings = run_stages(stages)
+    # Merge the results in the order that the steps used to run in.
+    for warning in output.get('warnings', []):
+        compilation.warning_log.append(CompileError(error_type=ErrorType.SERVER_WARNING,
+                                                    logline=0,
+                                                    text=warning))
+    for error in output.get('errors', []):
+        compilation.error_log.append(CompileError(error_type=ErrorType.SERVER_ERROR,
+                                                  logline=0,
+                                                  text=error))
+    latex_errors = results['latex_log']
+    if isinstance(latex_errors, StageFailed):
+        raise latex_errors.error
+    if latex_errors is not None:
+        for error in latex_errors:
+            if is_fatal(error):
+                compilation.error_log.append(error)
+                compilation.status = CompileStatus.COMPILATION_ERRORS
+            else:
+                compilation.warning_log.append(error)
+        # Put reference errors at the end because they are
+        # usually caused by something else.
+        compilation.error_log.sort(key=lambda err: 1 if err.error_type == ErrorType.REFERENCE_ERROR else 0)
+        bibtex_errors = results['bibtex_log']
+        if isinstance(bibtex_errors, StageFailed):
+            raise bibtex_errors.error
+        if bibtex_errors is not None:
+            for error in bibtex_errors:
+                if is_fatal(error):
+                    compilation.error_log.append(error)
+                    compilation.status = CompileStatus.COMPILATION_ERRORS
+                else:
+                    compilation.warning_log.append(error)
+        else:
+            compilation.warning_log.append(CompileError(error_type=ErrorType.BIBTEX_ERROR,
+                                                        logline=0,
+                                                        text='Unable to parse bibtex/biber log'))
+    if output.get('errors', []):
+        compilation.status = CompileStatus.COMPILATION_FAILED
+    if exceeded:
+        compilation.status = CompileStatus.COMPILATION_FAILED
+        budget = 'wall clock' if exceeded['budget'] == 'wall' else 'CPU time'
+        compilation.error_log.insert(0, CompileError(error_type=ErrorType.BUDGET_EXCEEDED,
+                                                     logline=0,
+                                                     text=('The compilation was stopped after {} seconds because it exceeded '
+                                                           'the {} limit of {} seconds.').format(exceeded['used'],
+                                                                                                 budget,
+                                                                                                 exceeded['limit']),
+                                                     help='This is usually caused by an infinite loop or a very expensive figure.'))
+    elif compilation.exit_code != 0:
+        compilation.status = CompileStatus.COMPILATION_FAILED
+        compilation.error_log.insert(0, CompileError(error_type=ErrorType.LATEX_ERROR,
+                                                     logline=0,
+                                                     text='Exit code of {} because the compilation failed'.format(compilation.exit_code)))
+    if not failed:
+        bib = results['bibexport']
+        if isinstance(bib, StageFailed):
+            compilation.error_log.insert(0,
+                                         CompileError(error_type=ErrorType.SERVER_ERROR,
+                                                      logline=0,
+                                                      text='Error extracting bibtex: {} This is a bug'.format(str(bib.error))))
+        else:
+            html = results['bibhtml']
+            if isinstance(html, StageFailed):
+                # The errors from bibexport are kept.
+                compilation.error_log.insert(0,
+                                             CompileError(error_type=ErrorType.SERVER_ERROR,
+                                                          logline=0,
+                                                          text='Error producing html: {} This is a bug'.format(str(html.error))))
+            else:
+                bib = html
+            compilation.bibtex = bib.bibtex
+            compilation.bibhtml = bib.bibhtml
+            compilation.error_log.extend(bib.error_log)
+            compilation.warning_log.extend(bib.warning_log)
+        if isinstance(results['metadata'], StageFailed):
+            raise results['metadata'].error
+        meta, meta_status = results['metadata']
+        compilation.meta = meta.meta
+        compilation.error_log.extend(meta.error_log)
+        compilation.warning_log[0:0] = meta.warning_log
+        if meta_status:
+            compilation.status = meta_status
+        elif compilation.meta.version != VersionEnum.FINAL:
+            compilation.status = CompileStatus.WRONG_VERSION
+        elif compilation.error_log:
+            compilation.status = CompileStatus.COMPILATION_ERRORS
+        else:
+            compilation.status = CompileStatus.COMPILATION_SUCCESS
+    for name, seconds in timings.items():
+        compilation.timings[name] = seconds
+    compilation.timings['postprocess'] = round(time.time() - start_time, 2)
@@ -0,0 +1,82 @@
+"""Registration of remote compile workers, and dispatch of compilations
+to them. The worker service is in compiler/remote.py. Workers register
+at /compiler/register with COMPILER_REMOTE_TOKEN, and run_latex_task
+sends a compilation to the least loaded worker that registered recently.
+If none can run it, then latex runs locally.
+"""
+
+from datetime import datetime, timedelta
+import hmac
+import logging
+import threading
+from flask import Blueprint, request, jsonify, abort
+from flask import current_app as app
+from sqlalchemy import select
+from . import db
+from .compiler.remote import Dispatcher, RemoteError, WORKER_TIMEOUT
+from .compiler.tracing import span
+from .metadata.db_models import RemoteWorker
+
+remote_bp = Blueprint('remote_bp', __name__)
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def _get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(app.config['COMPILER_REMOTE_TOKEN'],
+                                     attempts=app.config.get('COMPILER_REMOTE_ATTEMPTS', 3))
+        return _dispatcher
+
+def live_workers():
+    """returns a list of dicts with url, capacity, and active for the
+    workers that registered in the last WORKER_TIMEOUT seconds."""
+    cutoff = datetime.now() - timedelta(seconds=WORKER_TIMEOUT)
+    rows = db.session.execute(select(RemoteWorker).where(RemoteWorker.last_seen >= cutoff)).scalars().all()
+    return [{'url': w.url, 'capacity': w.capacity, 'active': w.active} for w in rows]
+
+def run_remote(cmd, input_path, output_path, wall_limit=None, cpu_limit=None):
+    """Compile on a remote worker if remote workers are configured.
+    returns the dict from runner.run_latex, or None if the caller
+    should run latex locally."""
+    if not app.config.get('COMPILER_REMOTE_TOKEN'):
+        return None
+    try:
+        workers = live_workers()
+    except Exception as e:
+        logging.warning('unable to read remote workers: ' + str(e))
+        return None
+    if not workers:
+        return None
+    try:
+        with span('remote', workers=len(workers)):
+            return _get_dispatcher().run_latex(workers, cmd, input_path, output_path,
+                                               wall_limit=wall_limit, cpu_limit=cpu_limit)
+    except RemoteError as e:
+        logging.warning(str(e) + '. Compiling locally.')
+        return None
+
+@remote_bp.route('/compiler/register', methods=['POST'])
+def register_worker():
+    token = app.config.get('COMPILER_REMOTE_TOKEN')
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        abort(403)
+    data = request.get_json(silent=True) or {}
+    url = data.get('url')
+    capacity = data.get('capacity')
+    active = data.get('active', 0)
+    if (not isinstance(url, str) or not url.startswith(('http://', 'https://')) or len(url) > 255 or
+        not isinstance(capacity, int) or not isinstance(active, int)):
+        return jsonify({'error': 'url, capacity, and active are required'}), 400
+    worker = db.session.execute(select(RemoteWorker).where(RemoteWorker.url == url)).scalar_one_or_none()
+    if worker is None:
+        worker = RemoteWorker(url=url)
+        db.session.add(worker)
+        logging.info('remote worker {} registered'.format(url))
+    worker.capacity = capacity
+    worker.active = active
+    worker.last_seen = datetime.now()
+    db.session.commit()
+    return jsonify({'status': 'ok'})
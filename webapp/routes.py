@@ -1,12 +1,14 @@
 import datetime
 import time
 from io import BytesIO
-from flask import json, Blueprint, render_template, request, jsonify, send_file, redirect, url_for, flash
+from flask import json, Blueprint, render_template, request, jsonify, send_file, redirect, url_for, flash, Response, stream_with_context
 from flask import current_app as app
 from flask_mail import Message
 import hmac
 import markdown
+import math
 import os
+import queue
 import re
 from pathlib import Path
 import random
@@ -15,22 +17,23 @@ import shutil
 from sqlalchemy import select, and_
 from sqlalchemy.sql import func
 import string
-from . import executor, mail, task_queue, get_json_path, get_pdf_url, validate_hmac, create_hmac, paper_key, db, _get_journals
-from .metadata.db_models import CompileRecord, validate_version, TaskStatus, PaperStatus, PaperStatusEnum, Version, log_event, Discussion, DiscussionStatus, Journal, Volume, Issue, NO_HOTCRP
+from . import mail, get_json_path, get_pdf_url, validate_hmac, create_hmac, paper_key, db, _get_journals
+from .metadata.db_models import CompileRecord, validate_version, TaskStatus, PaperStatus, PaperStatusEnum, Version, log_event, Discussion, DiscussionStatus, Journal, Volume, Issue, NO_HOTCRP, JobStatus, CompilationParts
 import zipfile
 from .metadata.compilation import Compilation, CompileStatus, CompileError, ErrorType, PubType
 from .metadata import validate_paperid, get_doi
-from .tasks import run_latex_task
+from .tasks import LIVE_LOG
+from .manifest import get_files, get_file
+from .job_queue import compile_queue, new_staging_dir, QueueFull
+from .metrics import metrics
+from .status_events import status_broker
 from .forms import SubmitForm, CompileForCopyEditForm, NotifyFinalForm
 from .bibmarkup import mark_bibtex
 from werkzeug.datastructures import MultiDict
 import hashlib
 import logging
 from .country_list import countries
-
-ENGINES = {'lualatex': 'latexmk -g -recorder -pdflua -lualatex="lualatex --disable-write18 --nosocket --no-shell-escape" main',
-           'pdflatex': 'latexmk -g -recorder -pdf -pdflatex="pdflatex -interaction=nonstopmode -disable-write18 -no-shell-escape" main',
-           'xelatex': 'latexmk -g -recorder -pdfxe -xelatex="xelatex -interaction=nonstopmode -file-line-error -no-shell-escape" main'}
+from .compiler.engines import ENGINES
 
 home_bp = Blueprint('home_bp',
                     __name__,
@@ -127,13 +130,23 @@ def show_submit_version():
                                    error='Your paper has already been published.')
     return render_template('submit.html', form=form, title='Upload your paper', journal=journal)
 
-def context_wrap(fn):
-    """Wrapper to pass context to function in thread."""
-    app_context = app.app_context()
-    def wrapper(*args, **kwargs):
-        with app_context:
-            return fn(*args, **kwargs)
-    return wrapper
+# Retry-After when the wait for the compile queue cannot be estimated.
+DEFAULT_RETRY_SECONDS = 900
+
+def _busy_response(version, wait):
+    """The 503 response to an upload that is refused because the compile
+    queue is full. wait is the estimated seconds until there is room."""
+    metrics.inc('latex_submit_uploads_total', {'version': version, 'outcome': 'throttled'})
+    if math.isinf(wait):
+        wait = DEFAULT_RETRY_SECONDS
+    retry_after = max(60, math.ceil(wait))
+    minutes = math.ceil(retry_after / 60)
+    html = render_template('message.html',
+                           title='The server is busy',
+                           error=('Many papers are waiting to be compiled, so your upload was not accepted. '
+                                  'Please go back and upload it again in about {} minute{}.').format(minutes,
+                                                                                                's' if minutes > 1 else ''))
+    return html, 503, {'Retry-After': str(retry_after)}
 
 # NOTE: there are constraints on what can be submitted based on
 # the current status for the paperid.
@@ -158,16 +171,7 @@ def submit_version():
     revised = args.get('revised', '')
     hotcrp = args.get('hotcrp', '')
     hotcrp_id = args.get('hotcrp_id', '')
-    task_key = paper_key(paperid, version)
     now = datetime.datetime.now()
-    if task_queue.get(task_key):
-        log_event(db, paperid, 'Attempt to resubmit while compiling')
-        msg = 'Already running {}:{}'.format(form.paperid.data,
-                                             form.version.data)
-        logging.warning(msg)
-        return render_template('message.html',
-                               title='Another one is running',
-                               error='At most one compilation may be queued on each paper.')
     # Ensure that the journal, volume, and issue exist.
     journal_id = args.get('journal')
     journal = db.session.execute(select(Journal).filter_by(hotcrp_key=journal_id)).scalar_one_or_none()
@@ -175,6 +179,39 @@ def submit_version():
         return render_template('message.html',
                                title='Unknown journal {}'.format(journal_id),
                                error='Unknown journal {}'.format(journal_id))
+    sql = select(PaperStatus).filter_by(paperid=paperid)
+    paper_status = db.session.execute(sql).scalar_one_or_none()
+    # send_mail keeps track of whether we should send an email to the author. This only
+    # happens on the first upload of each version.
+    send_mail = False
+    # check that submission is allowed.
+    if paper_status:
+        if paper_status.status == PaperStatusEnum.EDIT_PENDING:
+            return render_template('message.html',
+                                   title='Paper was sent to copy editor',
+                                   error='Paper may not be updated while it is in the hands of the copy editor')
+        if paper_status.status == PaperStatusEnum.COPY_EDIT_ACCEPT:
+            return render_template('message.html',
+                                   title='Paper is in final production steps',
+                                   error='Paper may not be updated after copy edit acceptance')
+        if paper_status.status == PaperStatusEnum.PUBLISHED:
+            return render_template('message.html',
+                                   title='Paper is already published',
+                                   error='Paper may not be updated after it is published')
+        if (paper_status.status == PaperStatusEnum.EDIT_FINISHED or
+            paper_status.status == PaperStatusEnum.FINAL_SUBMITTED):
+            # TODO: check that discussion items are finished
+            send_mail = True
+            version = Version.FINAL.value
+    task_key = paper_key(paperid, version)
+    superseding = compile_queue.is_active(task_key)
+    # Refuse the upload before anything is written if the compile queue is full.
+    journal_key = paper_status.journal_key if paper_status else args.get('journal')
+    wait = compile_queue.admit(journal_key, request.content_length or 0, superseding)
+    if wait is not None:
+        if paper_status:
+            log_event(db, paperid, 'Upload refused because the compile queue is full')
+        return _busy_response(version, wait)
     volume = db.session.execute(select(Volume).filter_by(name=args.get('volume'),
                                                          journal_id=journal.id)).scalar_one_or_none()
     if not volume:
@@ -193,11 +230,6 @@ def submit_version():
         db.session.commit()
     paper_dir = Path(app.config['DATA_DIR']) / Path(paperid)
     paper_dir.mkdir(parents=True, exist_ok=True)
-    sql = select(PaperStatus).filter_by(paperid=paperid)
-    paper_status = db.session.execute(sql).scalar_one_or_none()
-    # send_mail keeps track of whether we should send an email to the author. This only
-    # happens on the first upload of each version.
-    send_mail = False
     pubtype = PubType.from_str(form.pubtype.data)
     if not paper_status:
         papernum = db.session.execute(select(func.max(PaperStatus.paperno)).where(PaperStatus.issue_id==issue.id)).scalar_one_or_none()
@@ -222,44 +254,31 @@ def submit_version():
         db.session.add(paper_status)
         db.session.commit()
         send_mail = True
-    # check that submission is allowed.
-    if paper_status.status == PaperStatusEnum.EDIT_PENDING:
-        return render_template('message.html',
-                               title='Paper was sent to copy editor',
-                               error='Paper may not be updated while it is in the hands of the copy editor')
-    if paper_status.status == PaperStatusEnum.COPY_EDIT_ACCEPT:
-        return render_template('message.html',
-                               title='Paper is in final production steps',
-                               error='Paper may not be updated after copy edit acceptance')
-    if paper_status.status == PaperStatusEnum.PUBLISHED:
-        return render_template('message.html',
-                               title='Paper is already published',
-                               error='Paper may not be updated after it is published')
     if paper_status.status == PaperStatusEnum.SUBMITTED:
         paper_status.status = PaperStatusEnum.PENDING
         paper_status.lastmodified = datetime.datetime.now()
         db.session.add(paper_status)
         db.session.commit()
-    if (paper_status.status == PaperStatusEnum.EDIT_FINISHED or
-        paper_status.status == PaperStatusEnum.FINAL_SUBMITTED):
-        # TODO: check that discussion items are finished
-        send_mail = True
-        version = Version.FINAL.value
     log_event(db, paperid, 'Upload of zip file for {}'.format(version))
     version_dir = paper_dir / Path(version)
-    # This blows everything away for the version.
-    if version_dir.is_dir():
-        shutil.rmtree(version_dir)
-    version_dir.mkdir(parents=True)
+    # The upload is staged next to version_dir, and the worker moves it
+    # into place when it is ready to compile it, so version_dir is never
+    # changed by a request.
+    upload_dir = new_staging_dir(version_dir)
+    upload_dir.mkdir(parents=True)
+    def reject_upload():
+        metrics.inc('latex_submit_uploads_total', {'version': version, 'outcome': 'invalid'})
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return render_template('submit.html', form=form, journal=journal)
     # Unzip the zip file into submitted_dir
-    zip_path = version_dir / Path('all.zip')
-    tmpzip_path = version_dir / Path('tmp.zip')
+    zip_path = upload_dir / Path('all.zip')
+    tmpzip_path = upload_dir / Path('tmp.zip')
     try:
         request.files['zipfile'].save(tmpzip_path)
     except Exception as e:
         logging.critical('Unable to save zip file: {}'.format(str(e)))
         form.zipfile.errors.append('unable to save zip file')
-        return render_template('submit.html', form=form, journal=journal)
+        return reject_upload()
     try:
         allzip= zipfile.ZipFile(zip_path, 'w')
         with zipfile.ZipFile(tmpzip_path, 'r') as tmpzip:
@@ -274,8 +293,8 @@ def submit_version():
     except Exception as e:
         logging.error('Unable to remove __MACOSX from zip file')
         form.zipfile.errors.append('Unable to remove __MACOSX from zip file. Please rezip without this')
-        return render_template('submit.html', form=form, journal=journal)
-    input_dir = version_dir / Path('input')
+        return reject_upload()
+    input_dir = upload_dir / Path('input')
     try:
         zip_file = zipfile.ZipFile(zip_path)
         zip_file.extractall(input_dir)
@@ -283,13 +302,13 @@ def submit_version():
         logging.error('Unable to extract from zip file: {}'.format(str(e)))
         log_event(db, paperid, 'Zip file could not be unzipped')
         form.zipfile.errors.append('Unable to extract from zip file: {}'.format(str(e)))
-        return render_template('submit.html', form=form, journal=journal)
+        return reject_upload()
     tex_file = input_dir / Path('main.tex')
     if not tex_file.is_file():
         log_event(db, paperid, 'Zip file did not have main.tex at top level')
         form.zipfile.errors.append('Your zip file should contain main.tex at the top level')
         # then no sense trying to compile
-        return render_template('submit.html', form=form, journal=journal)
+        return reject_upload()
     # Check that none of the latex files use \begin{thebibliography}, because that would
     # bypass our bibliography style. The LaTeX runner will automatically remove main.bbl
     # later on.
@@ -299,7 +318,7 @@ def submit_version():
             if '\\begin{thebibliography}' in txt:
                 log_event(db, paperid, 'LaTeX file with thebibligraphy in it')
                 form.zipfile.errors.append('Your Latex files may not contain \\begin{thebibliography} in them. Please use bibtex or biblatex and upload your bibtex files.')
-                return render_template('submit.html', form=form, journal=journal)
+                return reject_upload()
     command = ENGINES.get(args.get('engine'))
     compilation_data = {'paperid': paperid,
                         'status': CompileStatus.COMPILING,
@@ -317,18 +336,10 @@ def submit_version():
                         'warning_log': [],
                         'zipfilename': request.files['zipfile'].filename}
     compilation = Compilation(**compilation_data)
-    sql = select(CompileRecord).filter_by(paperid=paperid).filter_by(version=version)
-    comprec = db.session.execute(sql).scalar_one_or_none()
-    if not comprec:
-        comprec = CompileRecord(paperid=paperid,version=version)
-    comprec.task_status = TaskStatus.PENDING
-    comprec.started = now
-    compstr = compilation.model_dump_json(indent=2, exclude_none=True)
-    comprec.result = compstr
-    db.session.add(comprec)
-    db.session.commit()
-    compilation_file = version_dir / Path('compilation.json')
-    compilation_file.write_text(compstr, encoding='UTF-8')
+    parts = CompilationParts(compilation)
+    # The CompileRecord is updated from this file when the upload is moved into place.
+    compilation_file = upload_dir / Path('compilation.json')
+    compilation_file.write_text(parts.json(), encoding='UTF-8')
     receivedDate = datetime.datetime.strptime(submitted[:10],'%Y-%m-%d')
     acceptedDate = datetime.datetime.strptime(accepted[:10],'%Y-%m-%d')
     publishedDate = datetime.date.today().strftime('%Y-%m-%d')
@@ -350,20 +361,34 @@ def submit_version():
     metadata += '\\IfClassLoadedTF{iacrj}{\\ifcsstring{@IACRversion}{final}{}{\\ClassError{iacrj}{This production system requires using version=final in \\string\\documentclass}{}}}{}'
     metadata_file = input_dir / Path('main.iacrmetadata')
     metadata_file.write_text(metadata)
-    output_dir = version_dir / Path('output')
-    # Remove output from any previous run.
-    if output_dir.is_dir():
-        shutil.rmtree(output_dir)
-    # fire off a separate task to compile. We wrap run_latex_task so it
-    # can have the flask context to use sqlalchemy on the database.
-    task_queue[task_key] = executor.submit(context_wrap(run_latex_task),
-                                           app.root_path,
-                                           command,
-                                           str(version_dir.absolute()),
-                                           paperid,
-                                           doi,
-                                           version,
-                                           task_key)
+    # Queue the compilation for a worker. A job for the version may start
+    # or finish while we were unpacking, so this goes back and forth
+    # between supersede and enqueue until one of them takes the upload.
+    outcome = 'rejected'
+    for _ in range(3):
+        if superseding and compile_queue.supersede(task_key, command, str(version_dir.absolute()), doi,
+                                                   str(upload_dir.absolute())):
+            log_event(db, paperid, 'Upload supersedes the queued or running compilation')
+            outcome = 'superseded'
+            break
+        try:
+            if compile_queue.enqueue(task_key, paperid, version, command, str(version_dir.absolute()), doi,
+                                     staging=str(upload_dir.absolute()), limited=True):
+                outcome = 'queued'
+                break
+        except QueueFull:
+            # Other uploads took the room while this one was unpacked.
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            log_event(db, paperid, 'Upload refused because the compile queue is full')
+            wait = compile_queue.admit(paper_status.journal_key, request.content_length or 0, superseding)
+            return _busy_response(version, math.inf if wait is None else wait)
+        superseding = True
+    metrics.inc('latex_submit_uploads_total', {'version': version, 'outcome': outcome})
+    if outcome == 'rejected':
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return render_template('message.html',
+                               title='Another one is running',
+                               error='At most one compilation may be queued on each paper.')
     paper_url = url_for('home_bp.view_results',
                         paperid=paperid,
                         version=version,
@@ -384,6 +409,10 @@ def submit_version():
     status_url = paper_url.replace('/view/', '/tasks/')
     data = {'title': 'Compiling your LaTeX',
             'status_url': status_url,
+            'progress_url': url_for('home_bp.get_progress',
+                                    paperid=paperid,
+                                    version=version,
+                                    auth=create_hmac([paperid, version])),
             'headline': 'Compiling your paper'}
     return render_template('running.html', **data)
 
@@ -446,7 +475,7 @@ def compile_for_copyedit():
                                title='Paper was already sent to copy editor',
                                error = 'Paper was already sent for copy editing.')
     task_key = paper_key(paperid, Version.COPYEDIT.value)
-    if task_queue.get(task_key):
+    if compile_queue.is_active(task_key):
         log_event(db, paperid, 'Attempt to resubmit while compiling')
         msg = 'Already running {}:{}'.format(form.paperid.data,
                                              Version.COPYEDIT.value)
@@ -461,12 +490,12 @@ def compile_for_copyedit():
                                title='Compilation not found',
                                error='Compilation record was not found for {}. This is a bug'.format(form.version.data))
     # Change the status to submitted, so that it cannot be updated by the author.
-    version_compilation = version_comprec.result
-    if not version_compilation:
+    if not version_comprec.result:
         return render_template('message.html',
                                title='version_compilation not found',
                                error='version_compilation was not found. This is a bug')
-    version_compilation = Compilation.model_validate_json(version_compilation)
+    # Only the small fields are needed.
+    version_compilation = version_comprec.get_result(db.session, fields=[])
     # TODO: if we switch to having the editor assign a copy editor, then
     # the status will be set to PaperStatusEnum.SUBMITTED. For now we set it
     # to EDIT_PENDING, assuming that the assignment of copy editor is automatic.
@@ -476,24 +505,18 @@ def compile_for_copyedit():
     db.session.commit()
     log_event(db, paperid, 'Submitted for copy edit'.format(paperid))
     copyedit_dir = paper_dir / Path(Version.COPYEDIT.value)
-    if copyedit_dir.is_dir():
-        shutil.rmtree(copyedit_dir)
-    copyedit_dir.mkdir(parents=True)
+    # As for an upload, this is staged next to copyedit_dir and the worker
+    # moves it into place, so copyedit_dir is left alone if it is not queued.
+    staging_dir = new_staging_dir(copyedit_dir)
+    staging_dir.mkdir(parents=True)
     version_dir = paper_dir / Path(form.version.data)
     version_input_dir = version_dir / Path('input')
-    copyedit_input_dir = copyedit_dir / Path('input')
+    copyedit_input_dir = staging_dir / Path('input')
     shutil.copytree(version_input_dir,
                     copyedit_input_dir)
     copyedit_file = copyedit_input_dir / Path('main.copyedit')
     copyedit_file.touch() # this iacrcc.cls to add line numbers.
-    sql = select(CompileRecord).filter_by(paperid=paperid, version=Version.COPYEDIT.value)
-    copyedit_comprec = db.session.execute(sql).scalar_one_or_none()
-    if not copyedit_comprec:
-        copyedit_comprec = CompileRecord(paperid=paperid,version=Version.COPYEDIT.value)
-    copyedit_comprec.task_status = TaskStatus.PENDING
     now = datetime.datetime.now()
-    copyedit_comprec.started = now
-    copyedit_comprec.task_status = TaskStatus.PENDING
     compilation = Compilation(**{'paperid': paperid,
                                  'venue': paper_status.journal_key,
                                  'status': CompileStatus.COMPILING,
@@ -511,26 +534,18 @@ def compile_for_copyedit():
                                  'warning_log': [],
                                  'zipfilename': version_compilation.zipfilename})
     command = version_compilation.command
-    compstr = compilation.model_dump_json(indent=2, exclude_none=True)
-    copyedit_comprec.result = compstr
-    db.session.add(copyedit_comprec)
-    db.session.commit()
-    compilation_file = copyedit_dir / Path('compilation.json')
-    compilation_file.write_text(compstr, encoding='UTF-8')
-    output_dir = copyedit_dir / Path('output')
-    # Remove output from any previous run.
-    if output_dir.is_dir():
-        shutil.rmtree(output_dir)
-    # fire off a separate task to compile. We wrap run_latex_task so it
-    # can have the flask context to use sqlalchemy on the database.
-    task_queue[task_key] = executor.submit(context_wrap(run_latex_task),
-                                           app.root_path,
-                                           command,
-                                           str(copyedit_dir.absolute()),
-                                           paperid,
-                                           version_compilation.meta.DOI,
-                                           Version.COPYEDIT.value,
-                                           task_key)
+    parts = CompilationParts(compilation)
+    # The CompileRecord is updated from this file when it is moved into place.
+    compilation_file = staging_dir / Path('compilation.json')
+    compilation_file.write_text(parts.json(), encoding='UTF-8')
+    # Queue the compilation for a worker.
+    if not compile_queue.enqueue(task_key, paperid, Version.COPYEDIT.value, command,
+                                 str(copyedit_dir.absolute()), version_compilation.meta.DOI,
+                                 staging=str(staging_dir.absolute())):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return render_template('message.html',
+                               title='Another one is running',
+                               error='At most one compilation may be queued on each paper.')
     status_url = url_for('home_bp.get_status',
                          paperid=paperid,
                          version=Version.COPYEDIT.value,
@@ -551,6 +566,10 @@ def compile_for_copyedit():
         print(msg.body)
     data = {'title': 'Compiling your LaTeX for copy editor',
             'status_url': status_url,
+            'progress_url': url_for('home_bp.get_progress',
+                                    paperid=paperid,
+                                    version=Version.COPYEDIT.value,
+                                    auth=create_hmac([paperid, Version.COPYEDIT.value])),
             'headline': 'Recompiling your paper with line numbers for the copy editor'}
     return render_template('running.html', **data)
 
@@ -742,6 +761,49 @@ def respond_to_comment(paperid, itemid, auth):
     except Exception as e:
         return jsonify({'error': str(e)})
 
+def _status_redirect(paperid, version, args):
+    """The url that the user is sent to when the compilation is complete."""
+    if 'request_more' in args: # This means that it's an admin recompile for EDIT_REVISED.
+        return url_for('admin_file.copyedit', paperid=paperid)
+    elif version == Version.COPYEDIT.value:
+        return url_for('home_bp.view_copyedit',
+                       paperid=paperid,
+                       auth=create_hmac([paperid, version]))
+    else:
+        return url_for('home_bp.view_results',
+                       paperid=paperid,
+                       version=version,
+                       auth=create_hmac([paperid, version]))
+
+def _task_status(paperid, version):
+    """returns the TaskStatus and a message for the compilation of a
+    valid paperid and version."""
+    # is the task in the queue or running?
+    task_key = paper_key(paperid, version)
+    job = compile_queue.get_job(task_key)
+    if job and job.status == JobStatus.RUNNING:
+        return TaskStatus.RUNNING, 'Compilation is running'
+    elif job and job.status == JobStatus.QUEUED:
+        snapshot = compile_queue.snapshot()
+        msg = 'Pending (position {} out of {})'.format(snapshot.position(job.id), snapshot.depth)
+        eta = snapshot.eta(job.id)
+        if eta:
+            low = max(1, round(eta[0] / 60))
+            high = max(low, round(eta[1] / 60))
+            if high > low:
+                msg += ', done in about {} to {} minutes'.format(low, high)
+            else:
+                msg += ', done in about {} minute{}'.format(low, '' if low == 1 else 's')
+        return TaskStatus.RUNNING, msg
+    elif job and job.status == JobStatus.FAILED:
+        return TaskStatus.FAILED_EXCEPTION, 'An exception occurred: {}'.format(job.error)
+    # The job is done, so the result is in the CompileRecord.
+    sql = select(CompileRecord).filter_by(paperid=paperid, version=version)
+    record = db.session.execute(sql).scalar_one_or_none()
+    if not record:
+        return TaskStatus.ERROR, 'No record of compilation'
+    return record.task_status, 'Compilation {}'.format(record.task_status.value)
+
 @home_bp.route('/tasks/<paperid>/<version>/<auth>', methods=['GET'])
 def get_status(paperid, version, auth):
     """Check on the current status of a compilation via ajax.
@@ -752,17 +814,7 @@ def get_status(paperid, version, auth):
     if not validate_hmac([paperid, version], auth):
         return jsonify({'status': TaskStatus.ERROR,
                         'msg': 'hmac is invalid'})
-    if 'request_more' in args: # This means that it's an admin recompile for EDIT_REVISED.
-        paper_url = url_for('admin_file.copyedit', paperid=paperid)
-    elif version == Version.COPYEDIT.value:
-        paper_url = url_for('home_bp.view_copyedit',
-                            paperid=paperid,
-                            auth=create_hmac([paperid, version]))
-    else:
-        paper_url = url_for('home_bp.view_results',
-                            paperid=paperid,
-                            version=version,
-                            auth=create_hmac([paperid, version]))
+    paper_url = _status_redirect(paperid, version, args)
     if not validate_paperid(paperid):
         return jsonify({'url': paper_url,
                         'status': TaskStatus.ERROR,
@@ -771,56 +823,119 @@ def get_status(paperid, version, auth):
         return jsonify({'url': paper_url,
                         'status': TaskStatus.ERROR,
                         'msg': 'Unknown version'}), 200
-    status = TaskStatus.PENDING
-    msg = 'Unknown status'
-    # is the task in the queue or running?
-    task_key = paper_key(paperid, version)
-    future = task_queue.get(task_key, None)
-    if future:
-        if future.cancelled():
-            status = TaskStatus.CANCELLED
-            msg = 'Compilation was cancelled'
-        elif future.running():
-            status = TaskStatus.RUNNING
-            msg = 'Compilation is running'
-        elif future._exception:
-            status = TaskStatus.FAILED_EXCEPTION
-            msg = 'An exception occurred: {}'.format(str(future._exception))
-        elif future.done(): # must have returned a result
-            # Tasks that are done should remove themselves from task_queue, so this
-            # shouldn't happen
-            logging.error('Task was done {}'.format(paperid))
-            status = TaskStatus.FINISHED
-            result = future.result()
-            logging.critical('result was {}'.format(str(result)))
-            msg = 'Finished with errors. This may be a bug.'
-        else: # it's enqueued
-            status = TaskStatus.RUNNING
-            try:
-                position = tuple(task_queue.keys()).index(paperid)
-                size = len(task_queue)
-                msg = 'Pending (position {} out of {})'.format(position, size)
-            except Exception:
-                msg = 'Unknown position'
-    else: # The task would normally remove itself from the task_queue.
-        sql = select(CompileRecord).filter_by(paperid=paperid, version=version)
-        record = db.session.execute(sql).scalar_one_or_none()
-        if not record:
-            status = TaskStatus.ERROR
-            msg = 'No record of compilation'
-        else:
-            status = record.task_status
-            msg = 'Compilation {}'.format(status.value)
-    if (status == TaskStatus.FINISHED or
-        status == TaskStatus.CANCELLED or
-        status == TaskStatus.FAILED_EXCEPTION):
-        task_queue.pop(task_key, None)
+    status, msg = _task_status(paperid, version)
     if 'next' in args: # this allows us to override the redirect target.
         paper_url = args.get('next')
     return jsonify({'url': paper_url,
                     'status': status.value,
                     'msg': msg}), 200
 
+# If no event arrives in this many seconds, the events stream checks the
+# database, since the worker may run in another process.
+EVENTS_CHECK_SECONDS = 10
+# The stream is closed after this many seconds so that it does not hold
+# a server thread for the whole compilation, and the browser reconnects
+# after EVENTS_RETRY_MS.
+EVENTS_MAX_SECONDS = 60
+EVENTS_RETRY_MS = 1000
+
+@home_bp.route('/tasks/<paperid>/<version>/<auth>/events', methods=['GET'])
+def get_status_events(paperid, version, auth):
+    """A server-sent events stream of status changes for a compilation.
+    Each event has the same json as get_status, plus 'stage' which is
+    one of queued, running, postprocessing, finished, or failed when it is
+    known. The stream ends after the status is no longer PENDING or
+    RUNNING, or after EVENTS_MAX_SECONDS when EventSource reconnects.
+    """
+    args = request.args.to_dict()
+    if not validate_hmac([paperid, version], auth):
+        return jsonify({'error': 'hmac is invalid'}), 403
+    if not validate_paperid(paperid) or not validate_version(version):
+        return jsonify({'error': 'invalid paperid or version'}), 400
+    paper_url = args.get('next') or _status_redirect(paperid, version, args)
+    task_key = paper_key(paperid, version)
+
+    def stream():
+        events = status_broker.subscribe(task_key)
+        try:
+            deadline = time.monotonic() + EVENTS_MAX_SECONDS
+            yield 'retry: {}\n\n'.format(EVENTS_RETRY_MS)
+            last = None
+            # The first check is against the database, in case the
+            # compilation finished before we subscribed.
+            event = None
+            while time.monotonic() < deadline:
+                if event:
+                    status, stage, msg = TaskStatus(event.status), event.stage, event.msg
+                else:
+                    # End the read transaction so that we see changes by workers.
+                    db.session.commit()
+                    status, msg = _task_status(paperid, version)
+                    stage = None
+                data = {'url': paper_url,
+                        'status': status.value,
+                        'stage': stage,
+                        'msg': msg}
+                if data != last:
+                    yield 'data: {}\n\n'.format(json.dumps(data))
+                    last = data
+                else:
+                    yield ': keepalive\n\n'
+                if status not in (TaskStatus.PENDING, TaskStatus.RUNNING):
+                    return
+                try:
+                    event = events.get(timeout=EVENTS_CHECK_SECONDS)
+                except queue.Empty:
+                    event = None
+        finally:
+            status_broker.unsubscribe(task_key, events)
+
+    return Response(stream_with_context(stream()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+# Maximum number of bytes of the log returned by get_progress.
+MAX_PROGRESS_BYTES = 32768
+_progress_pass_re = re.compile(r"Run number \d+ of rule '[^']*'")
+
+@home_bp.route('/tasks/<paperid>/<version>/<auth>/progress', methods=['GET'])
+def get_progress(paperid, version, auth):
+    """Return new output from latexmk while a compilation is running. The
+    client supplies offset from the previous response to receive only the
+    output that came after it. This returns a json object with 'offset',
+    'text' (at most the last MAX_PROGRESS_BYTES), 'running', and 'pass' if
+    latexmk started a new pass in text.
+    """
+    if not validate_hmac([paperid, version], auth):
+        return jsonify({'error': 'hmac is invalid'}), 403
+    if not validate_paperid(paperid) or not validate_version(version):
+        return jsonify({'error': 'invalid paperid or version'}), 400
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        offset = 0
+    log_file = Path(app.config['DATA_DIR']) / Path(paperid) / Path(version) / Path(LIVE_LOG)
+    try:
+        with log_file.open('rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            if offset > size: # the log was restarted.
+                offset = 0
+            start = max(offset, size - MAX_PROGRESS_BYTES)
+            f.seek(start)
+            data = f.read(size - start)
+    except FileNotFoundError:
+        return jsonify({'offset': offset,
+                        'text': '',
+                        'running': False,
+                        'pass': None})
+    text = data.decode('UTF-8', errors='replace')
+    passes = _progress_pass_re.findall(text)
+    return jsonify({'offset': start + len(data),
+                    'text': text,
+                    'running': True,
+                    'pass': passes[-1] if passes else None})
+
 @home_bp.route('/view/<paperid>/<version>/<auth>/main.pdf', methods=['GET'])
 def show_pdf(paperid,version, auth):
     if not validate_paperid(paperid):
@@ -887,8 +1002,7 @@ def view_results(paperid, version, auth):
         return render_template('message.html',
                                title='Paper was not compiled',
                                error='Paper was not compiled: no directory {}. This is a bug that should not exist any more.'.format(str(output_path)))
-    output_dir = paper_path / Path('output')
-    comp.output_files = sorted([str(p.relative_to(str(output_dir))) for p in output_dir.rglob('*') if p.is_file() and p.name != 'main.pdf'])
+    comp.output_files = [f['path'] for f in get_files(paper_path, 'output') if f['path'] != 'main.pdf']
     pdf_file = output_path / Path('main.pdf')
     log_file = output_path / Path('main.log')
     if pdf_file.is_file():
@@ -981,19 +1095,19 @@ def view_source(paperid, version, auth):
                                error = 'Invalid hmac')
     paper_dir = Path(app.config['DATA_DIR']) / Path(paperid) / Path(version)
     output_dir = paper_dir / Path('output')
-    output_files = sorted([str(p.relative_to(str(output_dir))) for p in output_dir.rglob('*') if p.is_file()])
     filename = request.args.to_dict().get('filename')
     if not filename:
-        data = {'input_files': output_files}
+        data = {'input_files': [f['path'] for f in get_files(paper_dir, 'output')]}
     else:
+        entry = get_file(paper_dir, 'output', filename)
         source_file = output_dir / Path(filename)
-        if not source_file.is_file():
+        if not entry or not source_file.is_file():
             return render_template('message.html',
                                    title='Missing filename',
                                    error='Missing filename parameter')
         else:
-            if source_file.stat().st_size > 10000000:
-                data = {'input_files': output_files,
+            if entry['size'] > 10000000:
+                data = {'input_files': [f['path'] for f in get_files(paper_dir, 'output')],
                         'message': 'File is too large to view'}
                 return render_template('view_source.html', **data)
             try:
@@ -1019,11 +1133,8 @@ def download_output_zipfile(version, paperid):
     output_dir =  paper_dir / Path('output')
     memory_file = BytesIO()
     with zipfile.ZipFile(memory_file, 'w') as zf:
-        for root, dirs, files in os.walk(output_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                archive_path = os.path.relpath(file_path, output_dir)
-                zf.write(file_path, archive_path)
+        for f in get_files(paper_dir, 'output'):
+            zf.write(output_dir / Path(f['path']), f['path'])
     memory_file.seek(0)
     return send_file(memory_file, download_name='output.zip', as_attachment=True)
 
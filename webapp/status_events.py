@@ -0,0 +1,73 @@
+"""An in-process publish/subscribe of compile status changes, so that the
+events route in routes.py can push them to the browser instead of the
+browser polling get_status. Events are published by the compile queue
+and by run_latex_task. Workers in another process (see worker.py) do not
+publish to this process, so subscribers should still check the database
+when they have not heard anything for a while.
+"""
+
+import queue
+import threading
+import time
+
+class StatusEvent:
+    """A status change of the compilation for a task_key. status is a
+    value of TaskStatus, and stage is one of 'queued', 'running',
+    'postprocessing', 'finished', or 'failed'."""
+    def __init__(self, task_key, status, stage, msg):
+        self.task_key = task_key
+        self.status = status
+        self.stage = stage
+        self.msg = msg
+        self.time = time.monotonic()
+
+    def __eq__(self, other):
+        return (isinstance(other, StatusEvent) and
+                (self.status, self.stage, self.msg) == (other.status, other.stage, other.msg))
+
+class StatusBroker:
+    def __init__(self, max_age=3600):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        # The last event for each task_key, so that a subscriber that
+        # arrives between events learns the current state.
+        self._last = {}
+        self.max_age = max_age
+
+    def publish(self, task_key, status, stage, msg):
+        event = StatusEvent(task_key, status, stage, msg)
+        with self._lock:
+            self._last[task_key] = event
+            subscribers = list(self._subscribers.get(task_key, []))
+            # Forget events nobody asked about.
+            if len(self._last) > 1000:
+                now = time.monotonic()
+                self._last = {k: e for k, e in self._last.items() if now - e.time < self.max_age}
+        for q in subscribers:
+            q.put(event)
+
+    def subscribe(self, task_key) -> queue.Queue:
+        """returns a queue that receives the events for task_key. The last
+        event published for it, if any, is already in the queue. Call
+        unsubscribe when done."""
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(task_key, []).append(q)
+            last = self._last.get(task_key)
+        if last and time.monotonic() - last.time < self.max_age:
+            q.put(last)
+        return q
+
+    def unsubscribe(self, task_key, q):
+        with self._lock:
+            subscribers = self._subscribers.get(task_key, [])
+            if q in subscribers:
+                subscribers.remove(q)
+            if not subscribers:
+                self._subscribers.pop(task_key, None)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum([len(s) for s in self._subscribers.values()])
+
+status_broker = StatusBroker()
@@ -1,44 +1,157 @@
-"""This defines the tasks to be run in executor.
+"""This defines the tasks to be run by the workers of the compile queue.
 """
 import json
 import logging
 import os
-import re
 from pathlib import Path
-from urllib.parse import urlencode
+import random
+import re
+import shutil
+import string
 import time
+from flask import current_app
 from .compiler import runner
-from . import db, task_queue
-#from .metadata import meta_parse
-from .metadata.latex.iacrcc.parser import meta_parse
-from .metadata.meta_parse import clean_abstract, extract_bibtex
-from .bibmarkup import bibtex_to_html, get_citation_map
-from .metadata.xml_meta import validate_abstract
-from .metadata.compilation import Compilation, Meta, CompileStatus, VersionEnum, CompileError, ErrorType, LicenseEnum
-from .log_parser import LatexLogParser, BibTexLogParser
-from .metadata.db_models import CompileRecord, TaskStatus, PaperStatus
+from .compiler.cache import CompileCache
+from .compiler import tracing
+from .compiler.tracing import span, annotate
+from . import db
+from .metrics import metrics
+from .status_events import status_broker
+from .remote_workers import run_remote
+from .metadata.compilation import Compilation, CompileError, ErrorType
+from .postprocess import process_output
+from .manifest import build_manifest, write_manifest, read_manifest
+from .metadata.db_models import CompileRecord, CompilationParts, TaskStatus, PaperStatus, Version
 from sqlalchemy import select, and_
 
-def is_fatal(err):
-    """This is used to classify log messages as "fatal" meaning they need to
-       be corrected by the author. Some are indications that the compilation
-       failed, but others like missing references are deemed fatal by this
-       implementation. This is a policy decision."""
-    if err.error_type in (ErrorType.METADATA_ERROR,
-                          ErrorType.LATEX_ERROR,
-                          ErrorType.REFERENCE_ERROR,
-                          ErrorType.SERVER_ERROR,
-                          ErrorType.BIBTEX_ERROR):
-        return True
-    # if err.error_type == ErrorType.OVERFULL_HBOX and err.severity > 40:
-    #     return True
-    # if err.error_type == ErrorType.OVERFULL_VBOX and err.severity > 100:
-    #     return True
-    if err.text == 'LaTeX Warning: There were undefined references.':
-        return True
-    return False
+# Fields of Compilation that depend only on the inputs to the compilation.
+# These are stored in the compile cache.
+CACHED_FIELDS = {'status', 'exit_code', 'compile_time', 'latex_passes', 'log', 'error_log',
+                 'warning_log', 'meta', 'output_files', 'bibtex', 'bibhtml'}
+# This should be incremented whenever the processing of output changes,
+# so that old cache entries are no longer used.
+CACHE_VERSION = 1
+
+_compile_cache = None
+# The output of latexmk is streamed to this file in the version directory
+# while it runs, so that progress can be shown.
+LIVE_LOG = 'latexmk.log'
+# Traces of the compilations of a version are appended to this file in
+# the version directory.
+TRACE_FILE = 'trace.jsonl'
+# Aux files from the last successful compilation of each version are kept
+# in snapshots in this directory next to the version directories, and
+# WARM_DIR/<version> is a symlink to the current snapshot of the version.
+WARM_DIR = 'warmstart'
+# Snapshots that are no longer current are removed after this long.
+WARM_SNAPSHOT_SECONDS = 3600
+# Each attempt at a compilation writes to its own output.<token>
+# directory in the version directory, which replaces output if the job
+# is still current when it finishes. The directories of attempts whose
+# worker died are removed after this long.
+ABANDONED_OUTPUT_SECONDS = 3600
+VERSIONS = [v.value for v in Version]
+
+def get_compile_cache():
+    """Return the CompileCache from the config, or None if it is disabled."""
+    global _compile_cache
+    cache_dir = current_app.config.get('COMPILE_CACHE_DIR')
+    if not cache_dir:
+        return None
+    if _compile_cache is None or _compile_cache.cache_dir != Path(cache_dir):
+        _compile_cache = CompileCache(cache_dir, current_app.config['COMPILE_CACHE_MAX_BYTES'])
+    return _compile_cache
+
+def _warm_seed(paper_path, version):
+    """returns the warm start snapshot to seed a compilation of version
+    with, or None. This is the last one saved by the same version, or
+    else the newest one from another version of the paper."""
+    version = Version(version).value
+    warm_root = Path(paper_path).parent / Path(WARM_DIR)
+    links = [warm_root / Path(v) for v in VERSIONS if v != version]
+    links = sorted([l for l in links if l.is_symlink()], key=lambda l: l.lstat().st_mtime, reverse=True)
+    for link in [warm_root / Path(version)] + links:
+        if link.is_symlink() and link.is_dir():
+            return link.resolve()
+    return None
+
+def _save_warm_start(output_path, paper_path, version, seed_dir, output):
+    """Keep the aux files from a successful compilation so that the next
+    compilation of the paper can start from them. The number of latex
+    passes from the last compilation that did not warm start is kept as
+    a baseline. The files are written to a new snapshot directory, and
+    the link warmstart/<version> is then switched to it. A compilation
+    that is seeding from the old snapshot, perhaps of another version,
+    still sees a complete set of files.
+    returns: the number of latex passes saved, or None if this was not a warm start."""
+    version = Version(version).value
+    passes = output.get('latex_passes')
+    passes_saved = None
+    warm_root = Path(paper_path).parent / Path(WARM_DIR)
+    try:
+        warm_root.mkdir(exist_ok=True)
+        baseline = passes
+        if output.get('warm_start') and seed_dir:
+            baseline = json.loads(Path(seed_dir, 'baseline.json').read_text(encoding='UTF-8')).get('latex_passes')
+            if baseline is not None and passes is not None:
+                passes_saved = max(0, baseline - passes)
+        token = ''.join(random.choice(string.ascii_lowercase) for n in range(12))
+        snapshot = warm_root / Path('{}-{}'.format(version, token))
+        snapshot.mkdir()
+        Path(snapshot, 'baseline.json').write_text(json.dumps({'latex_passes': baseline}), encoding='UTF-8')
+        for name in runner.WARM_START_FILES:
+            src = output_path / Path(name)
+            if src.is_file():
+                shutil.copyfile(src, snapshot / Path(name))
+        tmp_link = warm_root / Path('.{}-{}.tmp'.format(version, token))
+        os.symlink(snapshot.name, tmp_link)
+        os.replace(tmp_link, warm_root / Path(version))
+        _prune_warm_start(warm_root)
+    except Exception as e:
+        logging.warning('Unable to save warm start files: ' + str(e))
+    return passes_saved
+
+def _prune_warm_start(warm_root):
+    """Remove snapshots that no link points to once they are old enough
+    that no compilation is still seeding from them. Files from before
+    there were snapshots are removed."""
+    current = {l.resolve().name for l in warm_root.iterdir() if l.is_symlink()}
+    cutoff = time.time() - WARM_SNAPSHOT_SECONDS
+    for entry in warm_root.iterdir():
+        if entry.is_symlink():
+            continue
+        if entry.is_dir():
+            if entry.name not in current and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry, ignore_errors=True)
+        elif not entry.name.endswith('.tmp') or entry.stat().st_mtime < cutoff:
+            entry.unlink(missing_ok=True)
+
+def _replace_output(work_path, output_path):
+    """Move the output of this attempt into place, and remove the output of
+    the previous compilation and of attempts whose worker died."""
+    old_path = output_path.with_name(work_path.name + '.old')
+    if output_path.is_dir():
+        output_path.rename(old_path)
+    if work_path.is_dir():
+        work_path.rename(output_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    cutoff = time.time() - ABANDONED_OUTPUT_SECONDS
+    for entry in output_path.parent.glob(output_path.name + '.*'):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry, ignore_errors=True)
+
+def engine_from_cmd(cmd):
+    """Return the name of the latex engine that the latexmk command uses."""
+    for engine in ['lualatex', 'xelatex']:
+        if engine in cmd:
+            return engine
+    return 'pdflatex'
 
-def run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key):
+def input_size(input_path):
+    """Return the number of bytes in the files under input_path."""
+    return sum([f.stat().st_size for f in Path(input_path).rglob('*') if f.is_file()])
+
+def run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key, is_current=None):
     """Execute latex on input_path contents, writing into output_path.
     args:
        root_path: the root path of the flask app.
@@ -47,10 +160,23 @@ def run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key):
        paperid: unique id for paper
        version: a value of Version enum
        task_key: string from paper_key(paperid, version)
+       is_current: if given, a function that returns False if the result
+          is stale because another worker took over the job.
     returns:
        an array with possible 'error' strings.
     raises an exception if it cannot proceed.
     """
+    if not current_app.config.get('COMPILER_TRACING'):
+        return _run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key, is_current)
+    with tracing.trace('compile', task_key=task_key, engine=engine_from_cmd(cmd)) as trace:
+        errors = _run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key, is_current)
+    try:
+        tracing.JsonlExporter(Path(paper_path) / Path(TRACE_FILE)).export(trace)
+    except Exception as e:
+        logging.warning('Unable to save trace: ' + str(e))
+    return errors
+
+def _run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key, is_current):
     # The contract from compile.runner is that output may
     # eventually contain exit_code, log, and an array of warnings.
     # We may add fatal errors.
@@ -61,166 +187,126 @@ def run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key):
         paper_path = Path(paper_path)
         input_path = paper_path / Path('input')
         output_path = paper_path / Path('output')
+        # A worker that lost its lease on the job may still be writing to
+        # the directory of an earlier attempt.
+        token = ''.join(random.choice(string.ascii_lowercase) for n in range(12))
+        work_path = paper_path / Path('output.' + token)
+        # The manifest is written again when the output is in place. The
+        # hashes of input files that did not change are reused.
+        previous_manifest = read_manifest(paper_path)
+        # If the inputs are identical to an earlier compilation, then we
+        # reuse its output and skip docker.
+        cache = get_compile_cache()
+        cache_key = None
+        cached = None
+        if cache:
+            try:
+                with span('cache_get'):
+                    cache_key = runner.input_digest(input_path, cmd, doi, CACHE_VERSION)
+                    cached = cache.get(cache_key, work_path)
+                    annotate(hit=cached is not None)
+            except Exception as e:
+                logging.warning('Compile cache is unavailable: ' + str(e))
+        if cached is None:
+            seed_dir = None
+            if current_app.config.get('COMPILER_WARM_START'):
+                seed_dir = _warm_seed(paper_path, version)
+            try:
+                start_time = time.time()
+                engine = engine_from_cmd(cmd)
+                wall_limit = current_app.config.get('COMPILER_WALL_BUDGETS', {}).get(engine)
+                cpu_limit = current_app.config.get('COMPILER_CPU_BUDGETS', {}).get(engine)
+                # Remote workers do not use the warm start or the live log.
+                remote_output = run_remote(cmd, input_path, work_path,
+                                           wall_limit=wall_limit, cpu_limit=cpu_limit)
+                if remote_output is not None:
+                    output = remote_output
+                else:
+                    with span('run_latex'):
+                        output = runner.run_latex(cmd, input_path, work_path,
+                                                  seed_dir=seed_dir,
+                                                  log_path=paper_path / Path(LIVE_LOG),
+                                                  wall_limit=wall_limit,
+                                                  cpu_limit=cpu_limit)
+                # The contract is that output may contain exit_code, log, and
+                # an array of warnings.
+                end_time = time.time()
+                execution_time = round(end_time - start_time, 2)
+            except Exception as e:
+                logging.error('Exception running latex: ' + str(e))
+                output['errors'].append('Exception running latex: ' + str(e))
+                task_status = TaskStatus.FAILED_EXCEPTION
+            finally:
+                # The full log is kept in the compilation.
+                Path(paper_path, LIVE_LOG).unlink(missing_ok=True)
+        manifest = None
         try:
-            start_time = time.time()
-            output = runner.run_latex(cmd, input_path, output_path)
-            # The contract is that output may contain exit_code, log, and
-            # an array of warnings.
-            end_time = time.time()
-            execution_time = round(end_time - start_time, 2)
+            with span('build_manifest'):
+                manifest = build_manifest(paper_path, previous_manifest, output_dir=work_path)
         except Exception as e:
-            logging.error('Exception running latex: ' + str(e))
-            output['errors'].append('Exception running latex: ' + str(e))
-            task_status = TaskStatus.FAILED_EXCEPTION
+            logging.warning('Unable to scan for the manifest: ' + str(e))
         json_file = Path(paper_path) / Path('compilation.json')
         compilation = None
-        comprec = db.session.execute(select(CompileRecord).where(and_(CompileRecord.paperid==paperid,
-                                                                      CompileRecord.version==version))).scalar_one_or_none()
+        # The compilation is serialized once, for both compilation.json
+        # and the CompileRecord.
+        parts = None
+        with span('load_record'):
+            comprec = db.session.execute(select(CompileRecord).where(and_(CompileRecord.paperid==paperid,
+                                                                          CompileRecord.version==version))).scalar_one_or_none()
         try:
             if not comprec:
                 logging.error('no CompileRecord for {}'.format(paperid))
                 raise Exception('no CompileRecord')
-            compilation = Compilation.model_validate_json(comprec.result)
-            compilation.compile_time = execution_time
-            compilation.log = output.get('log', 'no log')
-            compilation.output_files = sorted([str(p.relative_to(str(output_path))) for p in output_path.rglob('*') if p.is_file()])
-            for warning in output.get('warnings', []):
-                compilation.warning_log.append(CompileError(error_type=ErrorType.SERVER_WARNING,
-                                                            logline=0,
-                                                            text=warning))
-            for error in output.get('errors', []):
-                compilation.error_log.append(CompileError(error_type=ErrorType.SERVER_ERROR,
-                                                          logline=0,
-                                                          text=error))
-            logfile = output_path / 'main.log'
-            if logfile.is_file():
-                # Note: the class_file will be updated when it runs.
-                logparser = LatexLogParser(main_file='main.tex', class_file='iacrcc.cls')
-                logparser.parse_file(logfile)
-                for error in logparser.errors:
-                    if is_fatal(error):
-                        compilation.error_log.append(error)
-                        compilation.status = CompileStatus.COMPILATION_ERRORS
-                    else:
-                        compilation.warning_log.append(error)
-                # Put reference errors at the end because they are
-                # usually caused by something else.
-                compilation.error_log.sort(key=lambda err: 1 if err.error_type == ErrorType.REFERENCE_ERROR else 0)
-                biblogfile = output_path / Path('main.blg')
-                if biblogfile.is_file():
-                    biblog_parser = BibTexLogParser()
-                    biblog_parser.parse_file(biblogfile)
-                    for error in biblog_parser.errors:
-                        if is_fatal(error):
-                            compilation.error_log.append(error)
-                            compilation.status = CompileStatus.COMPILATION_ERRORS
-                        else:
-                            compilation.warning_log.append(error)
-                else:
-                    compilation.warning_log.append(CompileError(error_type=ErrorType.BIBTEX_ERROR,
-                                                                logline=0,
-                                                                text='Unable to parse bibtex/biber log'))
-            if output.get('errors', []):
-                compilation.status = CompileStatus.COMPILATION_FAILED
-            compilation.exit_code = output.get('exit_code', -1)
-            if compilation.exit_code != 0:
-                compilation.status = CompileStatus.COMPILATION_FAILED
-                compilation.error_log.insert(0, CompileError(error_type=ErrorType.LATEX_ERROR,
-                                                             logline=0,
-                                                             text='Exit code of {} because the compilation failed'.format(compilation.exit_code)))
-            if compilation.status != CompileStatus.COMPILATION_FAILED:
-                try:
-                    extract_bibtex(root_path, output_path, compilation)
-                except Exception as eee:
-                    logging.error('error extracting: ' + str(eee))
-                    compilation.error_log.insert(0,
-                                                 CompileError(error_type=ErrorType.SERVER_ERROR,
-                                                             logline=0,
-                                                              text='Error extracting bibtex: {} This is a bug'.format(str(eee))))
-                try:
-                    cite_map = get_citation_map(output_path)
-                    bibtex_to_html(compilation, cite_map)
-                except Exception as eee:
-                    logging.error('error in html production: ' + str(eee))
-                    compilation.error_log.insert(0,
-                                                 CompileError(error_type=ErrorType.SERVER_ERROR,
-                                                             logline=0,
-                                                              text='Error producing html: {} This is a bug'.format(str(eee))))
-                # Look for metadata.
-                metafile = output_path / Path('main.meta')
-                if metafile.is_file():
-                    try:
-                        metastr = metafile.read_text(encoding='UTF-8', errors='replace')
-                        data = meta_parse.parse_meta(metastr)
-                        abstract_file = Path(output_path) / Path('main.abstract')
-                        if not abstract_file.is_file():
-                            compilation.status = CompileStatus.MISSING_ABSTRACT
-                            compilation.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
-                                                                      logline=0,
-                                                                      text='The textabstract environment is required.'))
-                        else:
-                            data['abstract'] = clean_abstract(abstract_file.read_text(encoding='UTF-8', errors='replace'))
-                            if not validate_abstract(data['abstract']):
-                                compilation.status = CompileStatus.MISSING_ABSTRACT
-                                compilation.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
-                                                                          logline=0,
-                                                                          text='The textabstract environment contains illegal macros or environments. See the HTML tab.'))
-                        if 'license' not in data:
-                            compilation.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
-                                                                      logline=0,
-                                                                      text='A license is required.'))
-                        else:
-                            try:
-                                # Translate license keys from iacrcc.cls to keys in LicenseEnum.
-                                data['license'] = LicenseEnum.license_from_iacrcc(data['license'])
-                            except ValueError as e:
-                                try:
-                                    data['license'] = LicenseEnum.license_from_spdx(data['license'])
-                                except ValueError as ee:
-                                    compilation.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
-                                                                              logline=0,
-                                                                              text='Unrecognized SPDX license identifier'))
-                        compilation.meta = Meta(**data)
-                        compilation.meta.DOI = doi
-                        # Check authors to see if they have ORCID and affiliations.
-                        for author in compilation.meta.authors:
-                            if not author.orcid:
-                                compilation.warning_log.insert(0, CompileError(error_type=ErrorType.METADATA_WARNING,
-                                                                               logline=0,
-                                                                               help='See <a target="_blank" href="https://orcid.org/orcid-search/search?{}">ORCID search</a> and <a target="_blank" href="https://publish.iacr.org/iacrcc">iacrcc latex documentation</a>.'.format(urlencode({'searchQuery': author.name})),
-                                                                               text='author {} is lacking an ORCID. They are strongly recommended for all authors.'.format(author.name)))
-                            if not author.affiliations:
-                                compilation.warning_log.insert(0, CompileError(error_type=ErrorType.METADATA_WARNING,
-                                                                               logline=0,
-                                                                               text='author {} is lacking an affiliation'.format(author.name)))
-                            else:
-                                for affindex in author.affiliations:
-                                    aff = compilation.meta.affiliations[affindex-1]
-                                    if not aff.ror:
-                                        compilation.warning_log.insert(0, CompileError(error_type=ErrorType.METADATA_WARNING,
-                                                                                       logline=0,
-                                                                                       text='affiliation {} may have a ROR ID'.format(aff.name),
-                                                                                       help='See <a href="https://ror.org/search?{}" target="_blank">ROR search</a> and <a target="_blank" href="https://publish.iacr.org/iacrcc">iacrcc latex documentation</a>.'.format(urlencode({'query': aff.name}))))
-                        if compilation.meta.version != VersionEnum.FINAL:
-                            compilation.status = CompileStatus.WRONG_VERSION
-                            compilation.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
-                                                                      logline=0,
-                                                                      text='Paper should use documentclass[version=final]',
-                                                                      help='See <a href="/iacrcc">the documentation for iacrcc.cls</a>'))
-                        elif compilation.error_log:
-                            compilation.status = CompileStatus.COMPILATION_ERRORS
-                        else:
-                            compilation.status = CompileStatus.COMPILATION_SUCCESS
-                    except Exception as me:
-                        compilation.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
-                                                                  logline=0,
-                                                                  text='Failure to extract metadata: ' + str(me)))
-                        compilation.status = CompileStatus.METADATA_PARSE_FAIL
-                else:
-                    compilation.status = CompileStatus.METADATA_FAIL
-                    compilation.error_log.append(CompileError(error_type=ErrorType.METADATA_ERROR,
-                                                              logline=0,
-                                                              text='No metadata file. Are you sure you used the correct document class?'))
+            compilation = comprec.get_result(db.session)
+            if cached is not None:
+                compilation = Compilation.model_validate(compilation.model_dump() | cached)
+            else:
+                status_broker.publish(task_key, TaskStatus.RUNNING.value, 'postprocessing',
+                                      'Processing the output')
+                with span('postprocess'):
+                    process_output(root_path, compilation, output, work_path, execution_time, doi,
+                                   output_files=[f['path'] for f in manifest['output']] if manifest else None)
+                if current_app.config.get('COMPILER_WARM_START') and compilation.exit_code == 0:
+                    with span('save_warm_start'):
+                        compilation.passes_saved = _save_warm_start(work_path, paper_path, version,
+                                                                                seed_dir, output)
+                if (cache_key and task_status == TaskStatus.FINISHED and not output.get('budget_exceeded') and
+                    not [e for e in compilation.error_log if e.error_type == ErrorType.SERVER_ERROR]):
+                    with span('cache_put'):
+                        cache.put(cache_key, work_path, compilation.model_dump(mode='json', include=CACHED_FIELDS))
+            parts = CompilationParts(compilation)
+        except Exception as e:
+            compilation.error_log.append(CompileError(error_type=ErrorType.SERVER_ERROR,
+                                                      logline=0,
+                                                      text='exception someplace: ' + str(e)))
+            parts = None
+        # The output, manifest.json and compilation.json are only written
+        # after this, because a newer compilation may own them.
+        if is_current and not is_current():
+            # A newer compilation owns the record now.
+            logging.warning('discarding stale result for {}'.format(task_key))
+            annotate(stale=True)
+            db.session.rollback()
+            shutil.rmtree(work_path, ignore_errors=True)
+            return output.get('errors', [])
+        try:
+            with span('replace_output'):
+                _replace_output(work_path, output_path)
+        except Exception as e:
+            logging.error('Unable to move the output into place: ' + str(e))
+            compilation.error_log.append(CompileError(error_type=ErrorType.SERVER_ERROR,
+                                                      logline=0,
+                                                      text='Unable to move the output into place'))
+            parts = None
+        if manifest:
+            try:
+                with span('write_manifest'):
+                    write_manifest(paper_path, manifest=manifest)
+            except Exception as e:
+                logging.warning('Unable to write manifest: ' + str(e))
+        if parts is None:
+            parts = CompilationParts(compilation)
+        try:
             # This is a legacy to attempt to fix issue #12. I gave up and
             # made it dependent on the value in the database, but we still
             # store the compilation.json file.
@@ -229,18 +315,37 @@ def run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key):
             # through the OS buffers. Otherwise the other thread
             # may not see the output from this file. As it turns out,
             # it still isn't seen so we switched to the database.
-            jfile = open(str(json_file.resolve()), 'w', encoding='UTF-8')
-            jfile.write(compilation.model_dump_json(indent=2, exclude_none=True))
-            jfile.flush()
-            os.fsync(jfile.fileno())
-            jfile.close()
+            # It is written to a temporary file and renamed, so that a
+            # reader never sees part of it.
+            with span('write_json'):
+                tmp_file = json_file.with_name(json_file.name + '.tmp')
+                jfile = open(str(tmp_file.resolve()), 'w', encoding='UTF-8')
+                jfile.write(parts.json())
+                jfile.flush()
+                with span('fsync'):
+                    os.fsync(jfile.fileno())
+                jfile.close()
+                os.replace(tmp_file, json_file)
         except Exception as e:
             compilation.error_log.append(CompileError(error_type=ErrorType.SERVER_ERROR,
                                                       logline=0,
                                                       text='exception someplace: ' + str(e)))
+            parts = CompilationParts(compilation)
         # Update the database record with the compilation and status.
-        comprec.result = compilation.model_dump_json(indent=2, exclude_none=True)
+        with span('store_record'):
+            comprec.set_result(db.session, parts)
         comprec.task_status = TaskStatus.FINISHED.value
+        comprec.compile_time = compilation.compile_time
+        comprec.latex_passes = compilation.latex_passes
+        comprec.engine = compilation.engine
+        if manifest:
+            comprec.input_size = sum([f['size'] for f in manifest['input']])
+        else:
+            comprec.input_size = input_size(input_path)
+        if compilation.resources:
+            comprec.cpu_time = compilation.resources.cpu_seconds
+            comprec.peak_memory = compilation.resources.peak_memory
+            comprec.io_bytes = compilation.resources.io_read_bytes + compilation.resources.io_write_bytes
         db.session.add(comprec)
         if compilation.meta:
             sql = select(PaperStatus).where(PaperStatus.paperid==paperid)
@@ -249,10 +354,10 @@ def run_latex_task(root_path, cmd, paper_path, paperid, doi, version, task_key):
             if compilation.meta.authors:
                 paper_status.authors = ', '.join([a.name for a in compilation.meta.authors])
             db.session.add(paper_status)
-        db.session.commit()
-        task_queue.pop(task_key, None)
+        with span('db_commit'):
+            db.session.commit()
+        metrics.record_compilation(compilation, cached=cached is not None)
     except Exception as e:
-        task_queue.pop(task_key, None)
         logging.error('ERROR in task: {}'.format(str(e)))
     return output.get('errors', [])
 
@@ -0,0 +1,70 @@
+"""A compile worker that runs outside of the web server. Set
+COMPILER_IN_PROCESS to false in the config of the web server, and start
+one or more of these with the same config:
+
+   python3 -m webapp.worker --config webapp/debug_config.json
+
+It claims jobs from the compile_job table (see job_queue.py) and runs
+tasks.run_latex_task on them. On SIGTERM or SIGINT it stops claiming
+jobs and exits after the running jobs finish. A second signal exits
+immediately, and the jobs that were running are picked up by another
+worker when their leases expire.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+import signal
+import sys
+import threading
+
+from webapp import config
+from webapp import create_app
+from webapp.compiler import runner
+from webapp.job_queue import compile_queue
+
+def main():
+    argparser = argparse.ArgumentParser(description='Run compile jobs from the compile_job table')
+    argparser.add_argument('--config',
+                           default='webapp/debug_config.json',
+                           help='JSON file with the Config, as in run.py.')
+    argparser.add_argument('--workers', type=int, default=None,
+                           help='number of concurrent compilations. Overrides COMPILER_WORKERS.')
+    argparser.add_argument('--drain_timeout', type=float, default=None,
+                           help='seconds to wait for running jobs at shutdown. By default it waits for all.')
+    args = argparser.parse_args()
+    config_file = Path(args.config)
+    if config_file.is_file():
+        conf = config.Config.model_validate_json(config_file.read_text(encoding='UTF-8'))
+    else: # in case the secrets are in the default file.
+        conf = config.Config()
+    # This process always runs the workers, even if web server processes do not.
+    conf.COMPILER_IN_PROCESS = True
+    if args.workers:
+        conf.COMPILER_WORKERS = args.workers
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+    shutdown = threading.Event()
+    def handle_signal(signum, frame):
+        if shutdown.is_set():
+            logging.warning('exiting without waiting for running jobs')
+            sys.exit(1)
+        logging.info('draining: no new jobs will be claimed')
+        shutdown.set()
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    # create_app starts the worker threads.
+    create_app(conf)
+    logging.info('started {} compile workers'.format(compile_queue.running()))
+    while not shutdown.wait(1):
+        if not compile_queue.running():
+            logging.error('all compile workers exited')
+            break
+    drained = compile_queue.stop(args.drain_timeout)
+    runner.close_pool()
+    if not drained:
+        logging.warning('some jobs were still running at exit')
+        sys.exit(1)
+    logging.info('all running jobs finished')
+
+if __name__ == '__main__':
+    main()